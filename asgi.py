@@ -0,0 +1,28 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+asgi.py - Entry point of the api for asgi servers, see "kcn daemon --server asgi"
+Set KAMINA_CONFIG_DIR to load the configuration from another directory.
+"""
+import os
+
+from backend.api import API
+from backend.asgi import ASGIApp
+
+APP = ASGIApp(API(os.environ.get("KAMINA_CONFIG_DIR")))
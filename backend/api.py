@@ -19,52 +19,536 @@ api.py - Routes for the kamina backend api
 """
 
 import os
+import json
+import time
+import functools
+import threading
 from pathlib import Path
-from flask import Flask
+from flask import Flask, Response, request, jsonify, abort, g
+from werkzeug.exceptions import HTTPException
 
+from backend.cursor import encode_cursor, decode_cursor, NUMBER
+from backend.cache import ResponseCache, make_etag
+from backend.limits import Limiter
 from storage.storage import Storage
+from storage.shards import Shards, UnknownCommunity
+from storage.database import ThreadNotFound, InvalidParent, SORT_COLUMNS, hot_at
+from storage.search import SearchUnavailable
+from storage.ipfs import IPFSUnavailable, IPFSError
+from storage.sync import KEY_SPACE, RANGE_PARTS
 from kamina.config import KaminaConfiguration
+from kamina import metrics
+
+REQUEST_SECONDS = metrics.Histogram("kamina_request_seconds", "Time spent in the api views",
+                                    ("endpoint",))
+REQUESTS = metrics.Counter("kamina_requests_total", "Answered api requests",
+                           ("endpoint", "status"))
+REQUESTS_IN_FLIGHT = metrics.Gauge("kamina_requests_in_flight", "Api requests being handled")
+OPEN_STREAMS = metrics.Gauge("kamina_event_streams", "Open thread event streams")
 
 
 class API:
     """Class which implements and manages the routes for the kamina api"""
-    def __init__(self):
+    def __init__(self, base_dir: str = None):
         # Create flask application
         self.app = Flask(__name__)
-        # Load basic configuration
-        self.conf = KaminaConfiguration(Path(os.path.abspath(__file__)).parents[1]).conf
-        # Initialize storage engine
-        self.storage = Storage(self.conf)
+        # Load basic configuration, from the repository unless told otherwise
+        if base_dir is None:
+            base_dir = Path(os.path.abspath(__file__)).parents[1]
+        self.conf = KaminaConfiguration(base_dir).conf
+        # Values of every uWSGI worker end up next to each other in node_dir
+        metrics.configure(str(Path(self.conf["general"]["node_dir"], "metrics")))
+        # Initialize storage engine, a shard per community, the own one of the node first
+        self.shards = Shards(self.conf)
+        self.storage = self.shards.get()
+        # Rendered bodies of the read endpoints
+        self.responses = ResponseCache(self.conf["api"]["response_cache_size"] * 1024 * 1024)
+        # Event streams served by flask hold a worker thread each, they are
+        # capped per process, the asgi server serves them from its loop
+        self.streams = 0
+        self.streams_lock = threading.Lock()
+
+        # Token buckets of the clients and requests in flight, shared by every worker
+        self.limiter = Limiter(self.conf, str(Path(self.conf["general"]["node_dir"], "limits")))
+
+        # Instrumented views, by the function they wrap
+        self._views = {}
 
         # Routes definitions
         routes = [
-            {"r": "/api", "m": ["GET"], "f": self.index},
-            {"r": "/api/", "m": ["GET"], "f": self.index},
-            {"r": "/api/make_post", "m": ["POST"], "f": self.make_post},
-            {"r": "/api/make_response", "m": ["POST"], "f": self.make_response},
-            {"r": "/api/get_single_thread", "m": ["GET"], "f": self.get_single_thread},
-            {"r": "/api/get_all_threads", "m": ["GET"], "f": self.get_all_threads}
+            {"r": "/api", "m": ["GET"], "f": self.index, "l": "read"},
+            {"r": "/api/", "m": ["GET"], "f": self.index, "l": "read"},
+            {"r": "/api/make_post", "m": ["POST"], "f": self.make_post, "l": "write"},
+            {"r": "/api/make_response", "m": ["POST"], "f": self.make_response, "l": "write"},
+            {"r": "/api/get_single_thread", "m": ["GET"], "f": self.get_single_thread,
+             "l": "read"},
+            {"r": "/api/get_all_threads", "m": ["GET"], "f": self.get_all_threads, "l": "read"},
+            {"r": "/api/search", "m": ["GET"], "f": self.search, "l": "read"},
+            {"r": "/api/threads/<int:thread_id>/events", "m": ["GET"], "f": self.thread_events,
+             "l": "stream"},
+            {"r": "/api/upload", "m": ["POST"], "f": self.upload, "l": "upload"},
+            {"r": "/api/media/<cid>", "m": ["GET"], "f": self.media, "l": "read"},
+            {"r": "/api/sync/log", "m": ["GET"], "f": self.sync_log, "l": "sync"},
+            {"r": "/api/sync/ranges", "m": ["GET"], "f": self.sync_ranges, "l": "sync"},
+            {"r": "/api/sync/entries", "m": ["GET"], "f": self.sync_entries, "l": "sync"},
+            # Scrapes are never limited, an overloaded node is when they matter most
+            {"r": "/metrics", "m": ["GET"], "f": self.export_metrics}
         ]
 
         # Register all routes
         for route in routes:
             self.add_route(route)
+        self.app.url_value_preprocessor(self._pull_community)
 
     def add_route(self, route):
-        self.app.add_url_rule(route["r"], view_func=route["f"], methods=route["m"])
+        # Routes sharing a view share its wrapper, flask wants a single function per endpoint
+        view = self._views.get(route["f"])
+        if view is None:
+            view = route["f"]
+            if route.get("l") is not None:
+                view = self._limit(route["l"], view)
+            view = self._views[route["f"]] = self._instrument(route["f"].__name__, view)
+        self.app.add_url_rule(route["r"], view_func=view, methods=route["m"])
+        # The other communities of the node are served under /c/<id>
+        if route["r"].startswith("/api"):
+            self.app.add_url_rule("/c/<community>" + route["r"], view_func=view,
+                                  methods=route["m"])
+
+    @staticmethod
+    def _pull_community(_, values):
+        """Take the community out of the url values, the views find it on g"""
+        g.community = values.pop("community", None) if values else None
+
+    def shard(self, community: str = None) -> Storage:
+        """Storage of a community, aborts with a 404 if the node doesn't host it"""
+        try:
+            return self.shards.get(community)
+        except UnknownCommunity:
+            abort(404)
+
+    def _storage(self) -> Storage:
+        """Storage of the community of the current request"""
+        return self.shard(g.community)
+
+    @staticmethod
+    def _instrument(name: str, view):
+        """Wrap a view to record its latency and status under the endpoint name"""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            status = 500
+            REQUESTS_IN_FLIGHT.inc()
+            try:
+                result = view(*args, **kwargs)
+                status = getattr(result, "status_code", 200)
+                return result
+            except HTTPException as error:
+                status = error.code
+                raise
+            finally:
+                REQUESTS_IN_FLIGHT.dec()
+                REQUEST_SECONDS.observe(time.perf_counter() - started, name)
+                REQUESTS.inc(name, status)
+        return wrapper
+
+    def _limit(self, rule: str, view):
+        """Wrap a view to refuse the requests of clients over the limits of rule"""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            refusal = self.limiter.check(rule, request, self._storage().writer.pending())
+            # Streams are capped on their own, and would hold their place for minutes
+            if refusal is None and rule != "stream":
+                if not self.limiter.enter():
+                    refusal = 503, self.limiter.retry_after
+                else:
+                    try:
+                        return view(*args, **kwargs)
+                    finally:
+                        self.limiter.leave()
+            if refusal is not None:
+                return self.refusal(*refusal)
+            return view(*args, **kwargs)
+        return wrapper
+
+    @staticmethod
+    def refusal(status: int, retry_after: int) -> Response:
+        """Answer of a request the limits turned down"""
+        response = Response(status=status)
+        response.headers["Retry-After"] = str(retry_after)
+        return response
 
     @staticmethod
     def index():
         return "TODO: Put some documentation related to the api here."
 
+    @staticmethod
+    def export_metrics():
+        """Every metric of every process, in the prometheus text format"""
+        return Response(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4")
+
+    @staticmethod
+    def _get_params() -> dict:
+        """Parameters of the current request, be it a json object or a form"""
+        params = request.get_json(silent=True)
+        if params is None:
+            return request.values
+        if not isinstance(params, dict):
+            abort(400)
+        return params
+
+    @staticmethod
+    def _get_int(params, name: str, required: bool = True):
+        value = params.get(name)
+        if value is None or value == "":
+            if required:
+                abort(400)
+            return None
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            abort(400)
+
+    @staticmethod
+    def _get_text(params, name: str) -> str:
+        value = params.get(name)
+        if not isinstance(value, str) or not value.strip():
+            abort(400)
+        return value
+
+    def _get_limit(self, default: str = "page_size", maximum: str = "max_page_size") -> int:
+        """Page size asked for by the client, within the configured bounds"""
+        limit = self._get_int(request.args, "limit", False) or self.conf["api"][default]
+        return min(max(limit, 1), self.conf["api"][maximum])
+
+    def _hot_now(self) -> float:
+        """Time hot scores are shown as of, it moves every hot_refresh seconds"""
+        refresh = self.conf["ranking"]["hot_refresh"]
+        return time.time() // refresh * refresh
+
+    @staticmethod
+    def _show_hot(thread: dict, now: float, half_life: float) -> None:
+        """
+        :param half_life: The one the stored score was computed with, until the
+                          daemon rescores them after a change of hot_half_life
+        """
+        thread["hot"] = hot_at(thread["hot"], now, half_life)
+
+    @staticmethod
+    def _get_cursor(size: int, types: tuple = None):
+        """Decoded cursor of the current request, None if it has none"""
+        if not request.args.get("cursor"):
+            return None
+        try:
+            return decode_cursor(request.args["cursor"], size, types)
+        except ValueError:
+            abort(400)
+
     def make_post(self):
-        pass
+        params = self._get_params()
+        thread_id, post_id = self._storage().make_post(self._get_text(params, "title"),
+                                                    self._get_text(params, "body"))
+        return jsonify(thread_id=thread_id, post_id=post_id)
 
     def make_response(self):
-        pass
+        params = self._get_params()
+        try:
+            post_id = self._storage().make_response(self._get_int(params, "thread_id"),
+                                                 self._get_int(params, "parent_id", False),
+                                                 self._get_text(params, "body"))
+        except ThreadNotFound:
+            abort(404)
+        except InvalidParent:
+            abort(400)
+        return jsonify(post_id=post_id)
+
+    def _cached_response(self, key: tuple, generation: int, render) -> Response:
+        """
+        Answer a read request from the response cache when possible
+        :param key: Cache key of the response, within the community of the request
+        :param generation: Current generation of the data behind the response
+        :param render: Callable returning the body as an iterable of str chunks
+        """
+        key = (g.community,) + key
+        etag = make_etag(key, generation)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            body = self.responses.get(key, generation)
+            if body is None:
+                # Streamed as it's rendered
+                response = Response(self.responses.capture(key, generation, render()),
+                                    mimetype="application/json")
+            else:
+                response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "public, max-age=%d" % self.conf["api"]["max_age"]
+        return response
 
     def get_all_threads(self):
-        pass
+        sort = request.args.get("sort") or "active"
+        if sort not in SORT_COLUMNS:
+            abort(400)
+        limit = self._get_limit()
+        cursor = request.args.get("cursor") or None
+        # Every sort key is a number, then comes the thread id
+        after = self._get_cursor(2, (NUMBER, int))
+        storage = self._storage()
+        now = self._hot_now()
+
+        def render():
+            # Ask for one extra thread to know whether there is a next page
+            threads = storage.get_all_threads(limit + 1, after, sort)
+            next_cursor = None
+            if len(threads) > limit:
+                del threads[limit:]
+                next_cursor = encode_cursor(threads[-1][SORT_COLUMNS[sort]], threads[-1]["id"])
+            half_life = storage.get_hot_half_life()
+            for thread in threads:
+                self._show_hot(thread, now, half_life)
+            return self._stream_threads(threads, next_cursor)
+
+        # Hot scores all decay alike, time alone never reorders a listing, it
+        # only changes the scores shown
+        return self._cached_response(("threads", sort, cursor, limit, now),
+                                     storage.generations.listing(), render)
+
+    @staticmethod
+    def _stream_threads(threads: list, next_cursor):
+        """Serialize a page of threads one thread at a time"""
+        yield '{"threads":['
+        for index, thread in enumerate(threads):
+            if index:
+                yield ","
+            yield json.dumps(thread, separators=(",", ":"))
+        yield '],"next":%s}' % json.dumps(next_cursor)
 
     def get_single_thread(self):
-        pass
+        thread_id = self._get_int(request.args, "id")
+        root = self._get_int(request.args, "root", False)
+        depth = self._get_int(request.args, "depth", False)
+        if depth is None:
+            depth = self.conf["api"]["thread_depth"]
+        limit = self._get_limit("thread_page_size", "max_thread_page_size")
+        cursor = request.args.get("cursor") or None
+        after = self._get_cursor(1, (str,))
+        storage = self._storage()
+        now = self._hot_now()
+
+        def render():
+            thread = storage.get_single_thread(thread_id, limit, max(depth, 0), root,
+                                                    after and after[0])
+            if thread is None:
+                abort(404)
+            if thread["next"] is not None:
+                thread["next"] = encode_cursor(thread["next"])
+            self._show_hot(thread, now, storage.get_hot_half_life())
+            return [json.dumps(thread, separators=(",", ":"))]
+
+        return self._cached_response(("thread", thread_id, root, depth, limit, cursor, now),
+                                     storage.generations.thread(thread_id), render)
+
+    def search(self):
+        text = request.args.get("q")
+        if text is None:
+            abort(400)
+        limit = self._get_limit()
+        after = self._get_cursor(2, (NUMBER, int))
+
+        try:
+            posts = self._storage().search(text, limit + 1, after)
+        except SearchUnavailable:
+            abort(503)
+        next_cursor = None
+        if len(posts) > limit:
+            del posts[limit:]
+            next_cursor = encode_cursor(posts[-1]["rank"], posts[-1]["id"])
+        return jsonify(posts=posts, next=next_cursor)
+
+    def sync_log(self):
+        after = self._get_int(request.args, "after", False) or 0
+        entries, head = self._storage().get_sync_log(after, self._get_limit("sync_page_size",
+                                                                            "sync_page_size"))
+        return jsonify(entries=entries, head=head)
+
+    def _get_key_range(self) -> tuple:
+        low = self._get_int(request.args, "low")
+        high = self._get_int(request.args, "high")
+        if not 0 <= low < high <= KEY_SPACE:
+            abort(400)
+        return low, high
+
+    def sync_ranges(self):
+        low, high = self._get_key_range()
+        parts = self._get_int(request.args, "parts", False) or RANGE_PARTS
+        ranges, head = self._storage().get_sync_ranges(low, high, min(max(parts, 1), 64))
+        return jsonify(ranges=ranges, head=head)
+
+    def sync_entries(self):
+        low, high = self._get_key_range()
+        return jsonify(entries=self._storage().get_sync_entries(
+            low, high, self._get_limit("sync_page_size", "sync_page_size")))
+
+    def check_upload(self, upload) -> None:
+        """Abort unless the request upload carries a file this node accepts"""
+        media = self.conf["media"]
+        if upload.mimetype not in media["types"]:
+            abort(415)
+        if upload.content_length is None:
+            abort(411)
+        if upload.content_length > media["max_upload_size"] * 1024 * 1024:
+            abort(413)
+
+    def upload(self):
+        """
+        Store the body of the request, a file of one of the accepted media types
+        The body is streamed into ipfs as it is read, never held in memory.
+        """
+        self.check_upload(request)
+        try:
+            cid = self._storage().add_upload(request.stream, request.content_length,
+                                             request.mimetype)
+        except (IPFSUnavailable, IPFSError):
+            abort(503)
+        except IOError:
+            # The client went away before sending everything
+            abort(400)
+        return jsonify(cid=cid, size=request.content_length)
+
+    def find_media(self, storage: Storage, cid: str, variant: str, path: str):
+        """
+        Look an upload, or one of its variants, up
+        :param storage: Storage of the community of the upload
+        :param variant: Name of the variant, None for the upload itself
+        :param path: Path of the upload, where a variant still being made redirects
+        :return: Tuple of (CID, media type) of the object to answer with, or
+                 the redirect response
+        """
+        if not cid.isalnum():
+            abort(404)
+        upload = storage.get_media(cid)
+        if upload is None:
+            abort(404)
+        media_type = upload[0]
+        if variant is not None:
+            if variant not in self.conf["media"]["variants"]:
+                abort(400)
+            derived = storage.get_media_variant(cid, variant)
+            if derived is None or derived[0] is None:
+                response = Response(status=307)
+                response.headers["Location"] = path
+                response.headers["Cache-Control"] = "no-store"
+                return response
+            cid, media_type = derived[0], derived[1]
+        return cid, media_type
+
+    @staticmethod
+    def media_response(cid: str, media_type: str, data: bytes) -> Response:
+        response = Response(data, mimetype=media_type)
+        # Content addressed, a CID never changes what it names
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        response.headers["ETag"] = '"%s"' % cid
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        return response
+
+    def media(self, cid: str):
+        """
+        An upload, or one of its variants when asked for one. A variant still
+        being made redirects to the upload itself.
+        """
+        storage = self._storage()
+        found = self.find_media(storage, cid, request.args.get("variant"), request.path)
+        if isinstance(found, Response):
+            return found
+        cid, media_type = found
+        try:
+            data = storage.get_object(cid)
+        except (IPFSUnavailable, IPFSError):
+            abort(503)
+        return self.media_response(cid, media_type, data)
+
+    def thread_events(self, thread_id: int):
+        """
+        Server-sent events stream of the new posts of a thread
+        Event ids are post ids, a client reconnecting with Last-Event-ID gets
+        the posts it missed first.
+        """
+        events = self.conf["events"]
+        storage = self._storage()
+        last_id = self.stream_start(storage, thread_id, request.headers)
+
+        with self.streams_lock:
+            if self.streams >= events["max_streams"]:
+                response = Response(status=503)
+                response.headers["Retry-After"] = str(events["retry"])
+                return response
+            self.streams += 1
+        OPEN_STREAMS.inc()
+
+        response = self.stream_response(self._stream_events(storage, thread_id, last_id))
+        # Runs even if the stream was never started, unlike the generator's finally
+        response.call_on_close(self._close_stream)
+        return response
+
+    def stream_start(self, storage: Storage, thread_id: int, headers) -> int:
+        """
+        Check the request for an event stream of a thread
+        :param headers: Headers of the request
+        :return: Id of the post the stream starts after, the one in the
+                 Last-Event-ID header of a client resuming, the last post
+                 of the thread otherwise
+        """
+        last_id = storage.get_last_post_id(thread_id)
+        if last_id is None:
+            abort(404)
+        if headers.get("Last-Event-ID"):
+            last_id = self._get_int(headers, "Last-Event-ID")
+        return last_id
+
+    @staticmethod
+    def stream_response(events) -> Response:
+        """Response sending the events of an iterable as they are produced"""
+        response = Response(events, mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
+    @staticmethod
+    def post_event(post: dict) -> str:
+        return "id: %d\nevent: post\ndata: %s\n\n" % (post["id"], json.dumps(
+            {"id": post["id"], "parent_id": post["parent_id"], "cid": post["cid"]},
+            separators=(",", ":")))
+
+    def _close_stream(self):
+        with self.streams_lock:
+            self.streams -= 1
+        OPEN_STREAMS.dec()
+
+    def _stream_events(self, storage: Storage, thread_id: int, after: int):
+        """
+        Yield the posts newer than after, then wait for more
+        The stream ends after max_lifetime seconds, the client reconnects
+        and resumes from its last event.
+        """
+        events = self.conf["events"]
+        deadline = time.monotonic() + events["max_lifetime"]
+        # Subscribed before the first read, so no post can slip in between
+        subscription = storage.events.subscribe(thread_id)
+        try:
+            yield "retry: %d\n\n" % (events["retry"] * 1000)
+            while True:
+                posts = storage.get_new_posts(thread_id, after, events["batch_size"])
+                for post in posts:
+                    yield self.post_event(post)
+                if posts:
+                    after = posts[-1]["id"]
+                    if len(posts) == events["batch_size"]:
+                        continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                # Waking up without news still reads the database, a lost
+                # notification costs at most a keepalive interval
+                if not subscription.wait(min(events["keepalive"], remaining)):
+                    yield ": keepalive\n\n"
+        finally:
+            storage.events.unsubscribe(subscription)
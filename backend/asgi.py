@@ -0,0 +1,349 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+asgi.py - Serve the kamina api from an event loop
+The routes waiting on ipfs, and the event streams waiting on new posts, run
+on the loop, as many of them at once as clients ask for. Every other route
+is answered by the flask app of API on a pool of threads, just as under
+uWSGI, they only wait on the database.
+"""
+
+import io
+import sys
+import json
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge, abort
+from werkzeug.routing import Map, Rule
+from werkzeug.wrappers import Request
+
+from backend.api import API, REQUEST_SECONDS, REQUESTS, REQUESTS_IN_FLIGHT, OPEN_STREAMS
+from storage.aio import AsyncStorage, AsyncIPFSClient
+from storage.ipfs import IPFSUnavailable, IPFSError
+
+# Bodies of the routes run by flask are read whole before it sees them
+MAX_BODY_SIZE = 1024 * 1024
+
+
+def wsgi_environ(scope: dict) -> dict:
+    """WSGI environ of the request of an ASGI http scope, with an empty body"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": "",
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope["http_version"],
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        key = name.decode("latin1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        value = value.decode("latin1")
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+async def receive_body(receive):
+    """Yield the chunks of the body of a request as they arrive"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        if message.get("body"):
+            yield message["body"]
+        if not message.get("more_body"):
+            return
+
+
+async def wait_disconnect(receive) -> None:
+    """Return once the client is gone, the body must have been read already"""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+class EventStream:
+    """Response of an event stream, its body is sent event by event"""
+    __slots__ = ("response", "events", "status_code")
+
+    def __init__(self, response: Response, events):
+        """
+        :param response: Status and headers of the stream
+        :param events: Async iterable of the events, as text
+        """
+        self.response = response
+        self.events = events
+        self.status_code = response.status_code
+
+
+class ASGIApp:
+    """
+    ASGI application serving the routes of an API instance
+    Uploads and media wait on ipfs through AsyncStorage, and event streams
+    wait for new posts, without holding a thread. They go through the same
+    limits and metrics as the flask views, except for the count of requests
+    in flight: that one bounds the threads busy with requests, and theirs
+    aren't. Event streams aren't capped by events.max_streams either, an
+    open one only costs a subscription.
+    """
+    def __init__(self, api: API):
+        self.api = api
+        settings = api.conf["asgi"]
+        ipfs = api.conf["ipfs"]
+        self.executor = ThreadPoolExecutor(max_workers=settings["threads"])
+        self.ipfs_conn = AsyncIPFSClient(ipfs["host"], ipfs["port"], settings["ipfs_pool_size"],
+                                         ipfs["timeout"])
+        # By community, see API.shard
+        self._storages = {}
+        rules = []
+        for prefix in ("", "/c/<community>"):
+            rules += [
+                Rule(prefix + "/api/upload", methods=["POST"], endpoint=("upload", "upload")),
+                Rule(prefix + "/api/media/<cid>", methods=["GET"], endpoint=("media", "read")),
+                Rule(prefix + "/api/threads/<int:thread_id>/events", methods=["GET"],
+                     endpoint=("thread_events", "stream")),
+            ]
+        self.routes = Map(rules)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            raise ValueError("Unsupported ASGI scope type: %s" % scope["type"])
+        environ = wsgi_environ(scope)
+        try:
+            (name, rule), args = self.routes.bind_to_environ(environ).match()
+        except HTTPException:
+            # Not one of ours, flask answers with the right error if it's no route at all
+            await self._call_flask(environ, receive, send)
+            return
+        handler = getattr(self, "_" + name)
+        response = await self._serve(name, rule, handler, Request(environ), receive,
+                                     args.pop("community", None), **args)
+        if isinstance(response, EventStream):
+            await self._send_stream(send, receive, response, environ)
+        else:
+            await self._send(send, response, environ)
+
+    def run(self, func, *args):
+        """
+        Call a blocking function on the executor
+        :return: Future of what it returns
+        """
+        return asyncio.get_event_loop().run_in_executor(self.executor,
+                                                        functools.partial(func, *args))
+
+    def storage(self, community: str = None) -> AsyncStorage:
+        """AsyncStorage of a community, aborts with a 404 if the node doesn't host it"""
+        storage = self._storages.get(community)
+        if storage is None:
+            storage = self._storages[community] = AsyncStorage(self.api.shard(community),
+                                                               self.executor, self.ipfs_conn)
+        return storage
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.ipfs_conn.close()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _serve(self, name: str, rule: str, handler, request: Request, receive,
+                     community: str, **args) -> Response:
+        """Run a handler behind the limits of rule, recording it under the endpoint name"""
+        started = time.perf_counter()
+        status = 500
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            try:
+                storage = self.storage(community)
+                refusal = self.api.limiter.check(rule, request,
+                                                 storage.storage.writer.pending())
+                if refusal is not None:
+                    response = self.api.refusal(*refusal)
+                else:
+                    response = await handler(storage, request, receive, **args)
+            except HTTPException as error:
+                response = error.get_response(request.environ)
+            status = response.status_code
+            return response
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            REQUEST_SECONDS.observe(time.perf_counter() - started, name)
+            REQUESTS.inc(name, status)
+
+    async def _upload(self, storage: AsyncStorage, request: Request, receive) -> Response:
+        """Same as API.upload, with the body streamed from the loop"""
+        self.api.check_upload(request)
+        try:
+            cid = await storage.add_upload(receive_body(receive), request.content_length,
+                                           request.mimetype)
+        except (IPFSUnavailable, IPFSError):
+            abort(503)
+        except IOError:
+            abort(400)
+        return Response(json.dumps({"cid": cid, "size": request.content_length}),
+                         mimetype="application/json")
+
+    async def _media(self, storage: AsyncStorage, request: Request, _, cid: str) -> Response:
+        """Same as API.media, with the object read from the loop"""
+        found = await self.run(self.api.find_media, storage.storage, cid,
+                               request.args.get("variant"), request.path)
+        if isinstance(found, Response):
+            return found
+        cid, media_type = found
+        try:
+            data = await storage.get_object(cid)
+        except (IPFSUnavailable, IPFSError):
+            abort(503)
+        return self.api.media_response(cid, media_type, data)
+
+    async def _thread_events(self, storage: AsyncStorage, request: Request, _,
+                             thread_id: int) -> EventStream:
+        """Same as API.thread_events, with the stream waiting on the loop"""
+        after = await self.run(self.api.stream_start, storage.storage, thread_id,
+                               request.headers)
+        return EventStream(self.api.stream_response(iter(())),
+                           self._stream_events(storage, thread_id, after))
+
+    async def _stream_events(self, storage: AsyncStorage, thread_id: int, after: int):
+        """Same as API._stream_events, waiting for new posts on the loop"""
+        events = self.api.conf["events"]
+        deadline = time.monotonic() + events["max_lifetime"]
+        bus = storage.storage.events
+        # Subscribed before the first read, so no post can slip in between
+        subscription = bus.subscribe(thread_id, asyncio.get_event_loop())
+        try:
+            yield "retry: %d\n\n" % (events["retry"] * 1000)
+            while True:
+                posts = await self.run(storage.storage.get_new_posts, thread_id, after,
+                                       events["batch_size"])
+                for post in posts:
+                    yield self.api.post_event(post)
+                if posts:
+                    after = posts[-1]["id"]
+                    if len(posts) == events["batch_size"]:
+                        continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                if not await subscription.wait(min(events["keepalive"], remaining)):
+                    yield ": keepalive\n\n"
+        finally:
+            bus.unsubscribe(subscription)
+
+    @staticmethod
+    async def _send_start(send, response: Response, environ: dict):
+        """
+        Send the status and headers of a response
+        :return: Its body, as an iterable of bytes
+        """
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        await send({
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [(name.lower().encode("latin1"), value.encode("latin1"))
+                        for name, value in headers],
+        })
+        return app_iter
+
+    async def _send(self, send, response: Response, environ: dict) -> None:
+        app_iter = await self._send_start(send, response, environ)
+        await send({"type": "http.response.body", "body": b"".join(app_iter)})
+
+    async def _send_stream(self, send, receive, stream: EventStream, environ: dict) -> None:
+        """Send the events of a stream as they come, until it ends or the client is gone"""
+        OPEN_STREAMS.inc()
+        try:
+            await self._send_start(send, stream.response, environ)
+
+            async def pump():
+                async for event in stream.events:
+                    await send({"type": "http.response.body", "body": event.encode("utf8"),
+                                "more_body": True})
+                await send({"type": "http.response.body", "body": b""})
+
+            pumping = asyncio.ensure_future(pump())
+            disconnected = asyncio.ensure_future(wait_disconnect(receive))
+            try:
+                await asyncio.wait((pumping, disconnected),
+                                   return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for task in (pumping, disconnected):
+                    task.cancel()
+                pumped, _ = await asyncio.gather(pumping, disconnected, return_exceptions=True)
+                # Unsubscribes, if the stream stopped between two events
+                await stream.events.aclose()
+            if isinstance(pumped, Exception):
+                raise pumped
+        finally:
+            OPEN_STREAMS.dec()
+
+    async def _call_flask(self, environ: dict, receive, send) -> None:
+        """Answer a request with the flask app, on a thread of the executor"""
+        body = bytearray()
+        async for chunk in receive_body(receive):
+            body += chunk
+            if len(body) > MAX_BODY_SIZE:
+                await self._send(send, RequestEntityTooLarge().get_response(environ), environ)
+                return
+        environ["wsgi.input"] = io.BytesIO(bytes(body))
+        environ["CONTENT_LENGTH"] = str(len(body))
+
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        def run():
+            result = self.api.app(environ, start_response)
+            try:
+                return b"".join(result)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+
+        content = await self.run(run)
+        status, headers = started
+        await send({
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [(name.lower().encode("latin1"), value.encode("latin1"))
+                        for name, value in headers],
+        })
+        await send({"type": "http.response.body", "body": content})
@@ -0,0 +1,91 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+cache.py - In-process cache of rendered api responses
+Entries are tagged with the generation of the data they were rendered from
+and are only served while that generation is still current. The etag of a
+response is made of the same, so it is known before the response is
+rendered, and the same in every worker.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from storage.cache import CacheStats
+
+
+def make_etag(key: tuple, generation: int) -> str:
+    """Etag of the response of key rendered at generation"""
+    return hashlib.sha1(repr((key, generation)).encode("utf8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU of rendered response bodies, bounded by their total size"""
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.stats = CacheStats("response")
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, generation: int):
+        """
+        Look a rendered response up
+        :return: Its body, None if missing or stale
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                self.stats.miss()
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hit()
+            return entry[1]
+
+    def put(self, key: tuple, generation: int, body: bytes) -> None:
+        """Store a rendered response"""
+        if len(body) > self.max_size:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self._entries[key] = (generation, body)
+            self.size += len(body)
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted[1])
+
+    def capture(self, key: tuple, generation: int, chunks):
+        """
+        Pass a streamed body through, storing it once it was fully sent
+        :param chunks: Iterable of str chunks
+        """
+        sent = []
+        size = 0
+        for chunk in chunks:
+            chunk = chunk.encode("utf8")
+            size += len(chunk)
+            if sent is not None:
+                sent.append(chunk)
+                if size > self.max_size:
+                    sent = None
+            yield chunk
+        if sent is not None:
+            self.put(key, generation, b"".join(sent))
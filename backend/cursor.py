@@ -0,0 +1,62 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+cursor.py - Opaque pagination cursors handed out by the api
+"""
+
+import base64
+import binascii
+import json
+
+# Sort keys which are numbers, json leaves an integral float an int
+NUMBER = (int, float)
+# sqlite integers are 64 bits
+INTEGER_RANGE = range(-(1 << 63), 1 << 63)
+
+
+def encode_cursor(*values) -> str:
+    """
+    Pack the sort key of the last row of a page into an opaque token
+    :param values: Sort key values, they must be json serializable
+    :return: Url safe token
+    """
+    raw = json.dumps(values, separators=(",", ":")).encode("utf8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str, size: int, types: tuple = None) -> tuple:
+    """
+    Unpack a token made by encode_cursor
+    :param token: Token sent by the client
+    :param size: Number of values the token must hold
+    :param types: Type, or tuple of types, every value must be of, in order
+    :return: Tuple of values, otherwise, ValueError
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(raw.decode("utf8"))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Malformed cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Malformed cursor")
+    if types is not None:
+        for value, expected in zip(values, types):
+            if isinstance(value, bool) or not isinstance(value, expected) \
+                    or isinstance(value, int) and value not in INTEGER_RANGE:
+                raise ValueError("Malformed cursor")
+    return tuple(values)
@@ -0,0 +1,244 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+limits.py - Rate limiting and load shedding of the api
+Clients get a token bucket per class of route. The buckets live in a memory
+mapped file shared by every uWSGI worker, so the allowance of a client is
+the same whichever worker answers it. Requests are also shed early, with a
+503, while the workers already serve as many of them as they should, or
+too many wait to be served.
+"""
+
+import os
+import math
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import threading
+
+try:
+    import uwsgi
+except ImportError:
+    # Only importable inside uWSGI workers
+    uwsgi = None
+
+# Tokens left, and the time they were counted at
+BUCKET = struct.Struct("=dd")
+# Requests being served by every worker: a slot per worker process, holding
+# its process id and its count
+WORKER_SLOTS = 256
+SLOT = struct.Struct("=qq")
+IN_FLIGHT = struct.Struct("=%dq" % (WORKER_SLOTS * 2))
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TokenBuckets:
+    """
+    Fixed size table of token buckets in a memory mapped file
+    Keys are hashed to slots, two keys sharing a slot share a bucket, which
+    can only make their limits stricter.
+    """
+    def __init__(self, path: str, slots: int):
+        self.slots = slots
+        size = slots * BUCKET.size
+        # Kept open, the byte range locks of a slot are taken on it
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        # fcntl locks only keep other processes out, not other threads
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        """
+        Take a token from the bucket of key
+        :param rate: Tokens added to the bucket every second
+        :param burst: Size of the bucket
+        :return: 0 if there was a token, otherwise, seconds until there is one
+        """
+        offset = zlib.crc32(key.encode("utf8")) % self.slots * BUCKET.size
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, BUCKET.size, offset)
+            try:
+                tokens, updated = BUCKET.unpack_from(self._map, offset)
+                now = time.time()
+                if updated:
+                    tokens = min(burst, tokens + max(now - updated, 0) * rate)
+                else:
+                    tokens = burst
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate
+                BUCKET.pack_into(self._map, offset, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, BUCKET.size, offset)
+        return wait
+
+
+class InFlightTable:
+    """
+    Requests being served by every worker, each one writes its own count in
+    a shared file and reads the others. A worker claims a slot of its own
+    the first time it counts a request, under a lock of the whole file: a
+    free one, or the one of a worker which is gone, whose count is dropped
+    along, so workers that died in the middle of a request never add up.
+    """
+    def __init__(self, path: str):
+        # Kept open, the lock of the whole file is taken on it
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            # Only a new file, or one of another size, is cleared
+            if os.fstat(self._fd).st_size != IN_FLIGHT.size:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, IN_FLIGHT.size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, IN_FLIGHT.size)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._offset = None
+        self._count = 0
+
+    def _claim(self):
+        """
+        :return: Offset of the slot of this process, None if every slot is taken
+        """
+        pid = os.getpid()
+        claimed = None
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            for offset in range(0, IN_FLIGHT.size, SLOT.size):
+                owner = SLOT.unpack_from(self._map, offset)[0]
+                # A slot still under our pid was left by a dead process it was reused from
+                if owner and (owner == pid or not _alive(owner)):
+                    SLOT.pack_into(self._map, offset, 0, 0)
+                    owner = 0
+                if owner == 0 and claimed is None:
+                    SLOT.pack_into(self._map, offset, pid, 0)
+                    claimed = offset
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        return claimed
+
+    def add(self, amount: int) -> int:
+        """
+        Change the count of this worker
+        :return: Requests being served by every worker, this one included
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # A new worker, or one respawned in place of a dead one
+                self._pid = os.getpid()
+                self._offset = self._claim()
+                self._count = 0
+            self._count += amount
+            if self._offset is not None:
+                SLOT.pack_into(self._map, self._offset, self._pid, self._count)
+        return sum(IN_FLIGHT.unpack_from(self._map)[1::2])
+
+
+def listen_backlog() -> int:
+    """Connections waiting for a worker, 0 when not running under uWSGI"""
+    if uwsgi is None:
+        return 0
+    try:
+        return uwsgi.listen_queue()
+    except (AttributeError, SystemError):
+        # Unknown to old uWSGI releases and to platforms without tcp_info
+        return 0
+
+
+class Limiter:
+    """Decide, before its view runs, whether a request is served"""
+    def __init__(self, settings: dict, directory: str):
+        limits = settings["limits"]
+        self.rate_limiting = limits["rate_limiting"]
+        self.rules = limits["rules"]
+        self.client_header = limits["client_header"]
+        self.proxy_hops = limits["proxy_hops"]
+        self.max_backlog = limits["max_backlog"]
+        self.max_pending_writes = limits["max_pending_writes"]
+        self.max_in_flight = limits["max_in_flight"]
+        self.retry_after = limits["retry_after"]
+        os.makedirs(directory, exist_ok=True)
+        self.buckets = TokenBuckets(os.path.join(directory, "buckets"), limits["slots"])
+        self.in_flight = InFlightTable(os.path.join(directory, "in_flight"))
+
+    def client(self, request) -> str:
+        """
+        Address of the client, as told by the proxies in front of the api if there are
+        Every proxy appends the address it got the request from, only the last
+        proxy_hops of them are ours: the addresses before those come from the
+        client, which could make up a new one for every request.
+        """
+        if self.client_header:
+            forwarded = request.headers.get(self.client_header)
+            if forwarded:
+                addresses = [address.strip() for address in forwarded.split(",")]
+                return addresses[-min(self.proxy_hops, len(addresses))]
+        return request.remote_addr or ""
+
+    def check(self, rule: str, request, pending_writes: int) -> tuple:
+        """
+        :param rule: Name of the rule of the route
+        :param pending_writes: Writes of this process waiting for their commit
+        :return: Tuple of (http status, seconds the client should wait), None
+                 if the request may go on
+        """
+        if self.max_backlog and listen_backlog() > self.max_backlog:
+            return 503, self.retry_after
+        if rule == "write" and self.max_pending_writes \
+                and pending_writes > self.max_pending_writes:
+            return 503, self.retry_after
+        if self.rate_limiting:
+            limit = self.rules[rule]
+            wait = self.buckets.take("%s %s" % (rule, self.client(request)),
+                                     limit["rate"], limit["burst"])
+            if wait:
+                return 429, max(int(math.ceil(wait)), 1)
+        return None
+
+    def enter(self) -> bool:
+        """
+        Count a request in, unless max_in_flight of them are already being served
+        :return: Whether the request may go on, leave() must follow if it does
+        """
+        if not self.max_in_flight:
+            return True
+        if self.in_flight.add(1) > self.max_in_flight:
+            self.in_flight.add(-1)
+            return False
+        return True
+
+    def leave(self) -> None:
+        if self.max_in_flight:
+            self.in_flight.add(-1)
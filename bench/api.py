@@ -0,0 +1,251 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+api.py - Mixed read/write load test of the api
+Drives wsgi.APP either in-process or through a local uWSGI started from
+conf/uwsgi.yaml, or asgi.APP through uvicorn as "kcn daemon --server asgi"
+runs it, with a fake ipfs daemon standing in for the real one.
+
+    python -m bench.api [--mode inprocess|uwsgi|asgi] [--duration S] [--concurrency N]
+                        [--threads N] [--mix make_post=5,make_response=15,...]
+                        [--output results.json]
+"""
+
+import os
+import sys
+import time
+import random
+import signal
+import socket
+import argparse
+import threading
+import subprocess
+
+import yaml
+
+from bench.common import BASE_DIR, bench_environment, new_results, summarize, write_results
+
+DEFAULT_MIX = "make_post=5,make_response=15,get_all_threads=40,get_single_thread=40"
+
+
+class InProcessClient:
+    """Calls the flask application directly, no network involved"""
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path: str) -> int:
+        response = self.client.get(path)
+        response.get_data()
+        return response.status_code
+
+    def post(self, path: str, data: dict) -> int:
+        response = self.client.post(path, data=data)
+        response.get_data()
+        return response.status_code
+
+
+class HTTPClient:
+    """
+    Http client of a running server
+    The uWSGI http router of conf/uwsgi.yaml closes connections after every
+    response, so one is opened per request, as real clients would.
+    """
+    def __init__(self, base_url: str):
+        import requests
+        self.base_url = base_url
+        self.requests = requests
+
+    def get(self, path: str) -> int:
+        return self.requests.get(self.base_url + path).status_code
+
+    def post(self, path: str, data: dict) -> int:
+        return self.requests.post(self.base_url + path, data=data).status_code
+
+
+class Workload:
+    """Picks operations according to the mix and keeps track of known threads"""
+    def __init__(self, mix: dict, seed: int):
+        self.operations = list(mix)
+        self.weights = [mix[name] for name in self.operations]
+        self.random = random.Random(seed)
+        self.thread_count = 0
+        self.lock = threading.Lock()
+
+    def seed(self, client, threads: int) -> None:
+        for index in range(threads):
+            client.post("/api/make_post", {"title": "Seed thread %d" % index,
+                                           "body": "Seed body %d" % index})
+        self.thread_count = threads
+
+    def run_one(self, client, rand: random.Random) -> tuple:
+        operation = rand.choices(self.operations, self.weights)[0]
+        thread_id = rand.randint(1, max(self.thread_count, 1))
+        if operation == "make_post":
+            status = client.post("/api/make_post", {"title": "Bench thread",
+                                                    "body": "Bench body %f" % rand.random()})
+            with self.lock:
+                self.thread_count += 1
+        elif operation == "make_response":
+            status = client.post("/api/make_response", {"thread_id": thread_id,
+                                                        "body": "Bench reply %f" % rand.random()})
+        elif operation == "get_all_threads":
+            status = client.get("/api/get_all_threads")
+        else:
+            status = client.get("/api/get_single_thread?id=%d" % thread_id)
+        return operation, status
+
+
+def run_load(make_client, workload: Workload, concurrency: int, duration: float) -> dict:
+    latencies = {name: [] for name in workload.operations}
+    errors = {name: 0 for name in workload.operations}
+    deadline = time.monotonic() + duration
+
+    def worker(index: int):
+        client = make_client()
+        rand = random.Random(workload.random.random() + index)
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            operation, status = workload.run_one(client, rand)
+            elapsed = time.perf_counter() - start
+            latencies[operation].append(elapsed)
+            if status >= 400:
+                errors[operation] += 1
+
+    started = time.monotonic()
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    every = [sample for samples in latencies.values() for sample in samples]
+    results = {"elapsed_s": elapsed, "throughput_rps": len(every) / elapsed,
+               "all": summarize(every), "operations": {}}
+    for name, samples in latencies.items():
+        results["operations"][name] = dict(summarize(samples), errors=errors[name])
+    return results
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_uwsgi(base_dir: str, port: int) -> subprocess.Popen:
+    """Start uWSGI with conf/uwsgi.yaml, moved to another port and config dir"""
+    with open(os.path.join(BASE_DIR, "conf", "uwsgi.yaml"), "rt") as uwsgi_file:
+        uwsgi_conf = yaml.safe_load(uwsgi_file)
+    options = uwsgi_conf["uwsgi"]
+    options["http"] = "127.0.0.1:%d" % port
+    options["chdir"] = BASE_DIR
+    options.pop("stats", None)
+    if not os.path.isdir(os.path.join(BASE_DIR, options.get("virtualenv", ""))):
+        options.pop("virtualenv", None)
+    conf_path = os.path.join(base_dir, "uwsgi.yaml")
+    with open(conf_path, "wt") as uwsgi_file:
+        yaml.safe_dump(uwsgi_conf, uwsgi_file, default_flow_style=False)
+
+    env = os.environ.copy()
+    env["KAMINA_CONFIG_DIR"] = base_dir
+    process = subprocess.Popen(["uwsgi", "-y", conf_path], env=env, cwd=base_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return _wait_listening(process, port, "uwsgi")
+
+
+def start_asgi(base_dir: str, port: int) -> subprocess.Popen:
+    """Start uvicorn with the asgi section of the configuration, moved to another port"""
+    with open(os.path.join(base_dir, "conf", "kamina.yaml"), "rt") as conf_file:
+        asgi = yaml.safe_load(conf_file)["asgi"]
+    env = os.environ.copy()
+    env["KAMINA_CONFIG_DIR"] = base_dir
+    process = subprocess.Popen(["uvicorn", "asgi:APP", "--host", "127.0.0.1",
+                                "--port", str(port), "--workers", str(asgi["workers"]),
+                                "--no-access-log"], env=env, cwd=BASE_DIR,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return _wait_listening(process, port, "uvicorn")
+
+
+def _wait_listening(process: subprocess.Popen, port: int, name: str) -> subprocess.Popen:
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("%s exited with code %d" % (name, process.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("%s didn't start listening in time" % name)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Api load test")
+    parser.add_argument("--mode", choices=["inprocess", "uwsgi", "asgi"], default="inprocess")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of load.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients.")
+    parser.add_argument("--threads", type=int, default=1000, help="Threads created up front.")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Weight of every operation.")
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--output", help="Also write the results to this json file.")
+    options = parser.parse_args()
+
+    mix = {}
+    for item in options.mix.split(","):
+        name, _, weight = item.partition("=")
+        mix[name.strip()] = float(weight)
+    workload = Workload(mix, options.seed)
+
+    results = new_results("api", mode=options.mode, duration=options.duration,
+                          concurrency=options.concurrency, threads=options.threads,
+                          mix=mix, seed=options.seed)
+    with bench_environment() as (base_dir, fake_ipfs):
+        server_process = None
+        if options.mode == "inprocess":
+            os.environ["KAMINA_CONFIG_DIR"] = base_dir
+            sys.path.insert(0, BASE_DIR)
+            from wsgi import APP
+
+            def make_client():
+                return InProcessClient(APP)
+        else:
+            port = _free_port()
+            if options.mode == "uwsgi":
+                server_process = start_uwsgi(base_dir, port)
+            else:
+                server_process = start_asgi(base_dir, port)
+
+            def make_client():
+                return HTTPClient("http://127.0.0.1:%d" % port)
+        try:
+            workload.seed(make_client(), options.threads)
+            results["load"] = run_load(make_client, workload, options.concurrency,
+                                       options.duration)
+            results["ipfs_calls"] = dict(fake_ipfs.calls)
+        finally:
+            if server_process is not None:
+                server_process.send_signal(signal.SIGQUIT if options.mode == "uwsgi"
+                                           else signal.SIGTERM)
+                server_process.wait()
+    write_results(results, options.output)
+
+
+if __name__ == "__main__":
+    main()
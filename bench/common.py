@@ -0,0 +1,117 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+common.py - Helpers shared by the benchmarks
+Results are plain json files, compare two of them with bench.compare.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import contextlib
+from pathlib import Path
+
+import yaml
+
+from utils.fake_ipfs import FakeIPFS
+
+BASE_DIR = str(Path(os.path.abspath(__file__)).parents[1])
+
+
+def percentile(samples: list, pct: float) -> float:
+    """Nearest rank percentile of an already sorted list"""
+    if not samples:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(samples) + 0.5)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+def summarize(samples: list) -> dict:
+    """Latency summary of a list of durations in seconds, reported in ms"""
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "min_ms": samples[0] * 1000 if samples else 0.0,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": samples[-1] * 1000 if samples else 0.0,
+    }
+
+
+def time_calls(func, runs: int) -> dict:
+    """Call func runs times and summarize how long each call took"""
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def new_results(benchmark: str, **parameters) -> dict:
+    return {
+        "benchmark": benchmark,
+        "parameters": parameters,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def write_results(results: dict, output: str = None) -> None:
+    """Print the results and, if asked to, save them as json"""
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print(text)
+    if output:
+        with open(output, "wt") as result_file:
+            result_file.write(text + "\n")
+
+
+@contextlib.contextmanager
+def bench_environment(fake_ipfs: FakeIPFS = None):
+    """
+    Throwaway configuration directory whose node_dir is a temporary
+    directory and whose ipfs daemon is a running FakeIPFS
+    :param fake_ipfs: Daemon to use, shared by several nodes, a new one if None
+    :return: Tuple of (base dir to pass to KaminaConfiguration, FakeIPFS)
+    """
+    base_dir = tempfile.mkdtemp(prefix="kamina-bench-")
+    own_ipfs = fake_ipfs is None
+    if own_ipfs:
+        fake_ipfs = FakeIPFS().start()
+    try:
+        shutil.copytree(os.path.join(BASE_DIR, "conf"), os.path.join(base_dir, "conf"),
+                        ignore=shutil.ignore_patterns(".*"))
+        conf_path = os.path.join(base_dir, "conf", "kamina.yaml")
+        with open(conf_path, "rt") as conf_file:
+            conf = yaml.safe_load(conf_file)
+        conf["general"]["node_dir"] = os.path.join(base_dir, "node")
+        conf["ipfs"]["port"] = fake_ipfs.port
+        # Every simulated client comes from the same address
+        conf["limits"]["rate_limiting"] = False
+        with open(conf_path, "wt") as conf_file:
+            yaml.safe_dump(conf, conf_file, default_flow_style=False)
+        yield base_dir, fake_ipfs
+    finally:
+        if own_ipfs:
+            fake_ipfs.stop()
+        shutil.rmtree(base_dir, ignore_errors=True)
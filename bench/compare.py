@@ -0,0 +1,67 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+compare.py - Compare two benchmark result files, before and after a change
+
+    python -m bench.compare before.json after.json
+"""
+
+import sys
+import json
+import argparse
+
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    """Every numeric value of the results, keyed by its dotted path"""
+    values = {}
+    for key, value in results.items():
+        path = prefix + key
+        if isinstance(value, dict):
+            values.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare two benchmark results")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    options = parser.parse_args()
+
+    with open(options.before, "rt") as before_file:
+        before = json.load(before_file)
+    with open(options.after, "rt") as after_file:
+        after = json.load(after_file)
+    if before.get("benchmark") != after.get("benchmark"):
+        print("Results come from different benchmarks", file=sys.stderr)
+        sys.exit(1)
+
+    before_values = flatten(before)
+    after_values = flatten(after)
+    width = max((len(path) for path in before_values), default=0)
+    for path in sorted(set(before_values) & set(after_values)):
+        if path.startswith("parameters."):
+            continue
+        old, new = before_values[path], after_values[path]
+        change = "%+.1f%%" % ((new - old) / old * 100) if old else "n/a"
+        print("%-*s %12.3f %12.3f %9s" % (width, path, old, new, change))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+records.py - Size and speed of post records, json (version 1) against binary (version 2)
+
+    python -m bench.records [--runs N] [--output results.json]
+"""
+
+import time
+import argparse
+
+from bench.common import new_results, write_results
+from storage import records
+from storage.records import PostRecord, ThreadRecord, JSON_VERSION, RECORD_VERSION
+
+CID = "bafk" + "0" * 64
+BODY_SIZES = {"small": 200, "medium": 4096, "large": 256 * 1024}
+
+
+def per_call_us(func, runs: int) -> float:
+    """Best of five rounds of runs calls, microseconds per call"""
+    best = None
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(runs):
+            func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / runs * 1e6
+
+
+def bench_record(record: PostRecord, runs: int) -> dict:
+    results = {}
+    for name, version in (("json", JSON_VERSION), ("binary", RECORD_VERSION)):
+        data = records.encode(record, version)
+        results[name] = {
+            "bytes": len(data),
+            "encode_us": per_call_us(lambda: records.encode(record, version), runs),
+            # Fields only, what the sync log and the api look at most of the time
+            "decode_us": per_call_us(lambda: records.decode(data), runs),
+            "decode_text_us": per_call_us(lambda: records.decode(data).decode_body(), runs),
+        }
+    for measure in ("bytes", "encode_us", "decode_us", "decode_text_us"):
+        results["binary_to_json_" + measure] = (results["binary"][measure]
+                                                / results["json"][measure])
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Post record serialization benchmarks")
+    parser.add_argument("--runs", type=int, default=2000, help="Calls per round of a measure.")
+    parser.add_argument("--output", help="Also write the results to this json file.")
+    options = parser.parse_args()
+
+    results = new_results("records", runs=options.runs)
+    # Text with quotes, newlines and non ascii characters, json escapes some of it
+    text = "Réponse \"citée\"\n> avec du code\n\tif (x) { return; }\n"
+    for name, size in BODY_SIZES.items():
+        body = (text * (size // len(text) + 1))[:size]
+        runs = max(options.runs * BODY_SIZES["small"] // size, 20)
+        results["post_" + name] = bench_record(
+            PostRecord("0f" * 16, time.time(), body, CID, CID), runs)
+    results["thread"] = bench_record(
+        ThreadRecord("0f" * 16, time.time(), text * 4, "A thread title"), options.runs)
+    write_results(results, options.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+startup.py - Import time and startup benchmark of the kcn cli
+Every measure runs in a fresh interpreter, so nothing is ever served from
+an already populated sys.modules.
+
+    python -m bench.startup [--runs N] [--output results.json] [--max-ms MS]
+"""
+
+import sys
+import time
+import argparse
+import subprocess
+
+from bench.common import BASE_DIR, new_results, summarize, write_results
+
+# Modules on the path of a kcn invocation, measured one by one
+MODULES = [
+    "kamina.process",
+    "kamina.config",
+    "kamina.cli",
+    "kamina.supervisor",
+    "kamina.cli_commands.basic",
+    "kamina.cli_commands.advanced",
+    "storage.storage",
+    "backend.api",
+]
+
+# Full kcn invocations, none of them may touch the network or the node
+COMMANDS = [
+    ["--help"],
+    ["init", "--help"],
+    ["daemon", "--help"],
+]
+
+IMPORT_SNIPPET = ("import time, sys; start = time.perf_counter(); import %s; "
+                  "sys.stdout.write(repr(time.perf_counter() - start))")
+
+
+def measure_import(module: str, runs: int) -> dict:
+    """Time 'import module' in a fresh interpreter"""
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", IMPORT_SNIPPET % module],
+                                         cwd=BASE_DIR)
+        samples.append(float(output))
+    return summarize(samples)
+
+
+def measure_command(args: list, runs: int) -> dict:
+    """Time a whole kcn run, interpreter startup included"""
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "kcn"] + args, cwd=BASE_DIR, check=True,
+                       stdout=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def run(runs: int) -> dict:
+    results = new_results("startup", runs=runs)
+    results["baseline"] = measure_command(["--version"], runs)
+    results["imports"] = {}
+    results["commands"] = {}
+    for module in MODULES:
+        results["imports"][module] = measure_import(module, runs)
+    for args in COMMANDS:
+        results["commands"][" ".join(args)] = measure_command(args, runs)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="kcn startup benchmark")
+    parser.add_argument("--runs", type=int, default=10, help="Runs per measure.")
+    parser.add_argument("--output", help="Also write the results to this json file.")
+    parser.add_argument("--max-ms", type=float,
+                        help="Exit with 1 if a kcn command takes longer (p50) than this.")
+    options = parser.parse_args()
+
+    results = run(options.runs)
+    write_results(results, options.output)
+
+    if options.max_ms is not None:
+        slow = [command for command, measure in results["commands"].items()
+                if measure["p50_ms"] > options.max_ms]
+        if slow:
+            print("Slower than %.0fms: %s" % (options.max_ms, ", ".join(slow)), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
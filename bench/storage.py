@@ -0,0 +1,133 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+storage.py - Micro-benchmarks of Storage and KaminaConfiguration
+
+    python -m bench.storage [--runs N] [--threads N] [--output results.json]
+"""
+
+import os
+import time
+import shutil
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.common import bench_environment, new_results, summarize, time_calls, write_results
+from kamina.config import KaminaConfiguration, CACHE_FILE
+from storage.storage import Storage
+
+
+def bench_configuration(base_dir: str, runs: int) -> dict:
+    cache_path = os.path.join(base_dir, "conf", CACHE_FILE)
+
+    def cold():
+        if os.path.exists(cache_path):
+            os.unlink(cache_path)
+        KaminaConfiguration(base_dir)
+
+    return {
+        "cold": time_calls(cold, runs),
+        "cached": time_calls(lambda: KaminaConfiguration(base_dir), runs),
+    }
+
+
+def bench_concurrent_writes(storage: Storage, thread_id: int, runs: int, clients: int) -> dict:
+    """Replies from several threads at once, the case group commit is meant for"""
+    samples = []
+
+    def client():
+        for _ in range(runs // clients):
+            start = time.perf_counter()
+            storage.make_response(thread_id, None, "Concurrent reply")
+            samples.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=client) for _ in range(clients)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return summarize(samples)
+
+
+def bench_storage(base_dir: str, runs: int, threads: int) -> dict:
+    conf = KaminaConfiguration(base_dir).conf
+    storage = Storage(conf)
+    # Seeded concurrently, so the writes are grouped in few commits
+    with ThreadPoolExecutor(64) as seeders:
+        list(seeders.map(lambda index: storage.make_post(
+            "Thread %d" % index, "Body of thread %d about kernels" % index), range(threads)))
+    thread_id = storage.make_post("Busy thread", "Many replies")[0]
+    for _ in range(100):
+        storage.make_response(thread_id, None, "A reply about kernels")
+    last_page = storage.get_all_threads(threads)[-1]
+    last_hot_page = storage.get_all_threads(threads, sort="hot")[-1]
+
+    blobs = [os.urandom(4096) for _ in range(64)]
+    cids = storage.add_objects(blobs)
+    cache_dir = storage.cache.disk.directory
+
+    def cat_from_disk():
+        storage.cache.memory.clear()
+        storage.get_object(cids[0])
+
+    def cat_from_ipfs():
+        storage.cache.memory.clear()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        storage.get_objects(cids)
+
+    return {
+        "make_post": time_calls(lambda: storage.make_post("Title", "Body"), runs),
+        "make_response": time_calls(lambda: storage.make_response(thread_id, None, "Reply"),
+                                    runs),
+        "make_response_concurrent": bench_concurrent_writes(storage, thread_id, runs, 8),
+        "get_all_threads_first_page": time_calls(lambda: storage.get_all_threads(50), runs),
+        "get_all_threads_last_page": time_calls(
+            lambda: storage.get_all_threads(50, (last_page["last_activity"], last_page["id"])),
+            runs),
+        "get_all_threads_hot_first_page": time_calls(
+            lambda: storage.get_all_threads(50, sort="hot"), runs),
+        "get_all_threads_hot_last_page": time_calls(
+            lambda: storage.get_all_threads(50, (last_hot_page["hot"], last_hot_page["id"]),
+                                            "hot"), runs),
+        "get_single_thread_100_posts": time_calls(lambda: storage.get_single_thread(thread_id, 200, 8),
+                                                  runs),
+        "search": time_calls(lambda: storage.search("kernels", 50), runs),
+        "get_object_memory": time_calls(lambda: storage.get_object(cids[0]), runs),
+        "get_object_disk": time_calls(cat_from_disk, runs),
+        "get_objects_64_from_ipfs": time_calls(cat_from_ipfs, max(runs // 10, 1)),
+        "add_objects_64": time_calls(lambda: storage.add_objects(blobs), max(runs // 10, 1)),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Storage micro-benchmarks")
+    parser.add_argument("--runs", type=int, default=200, help="Calls per measure.")
+    parser.add_argument("--threads", type=int, default=10000, help="Threads created up front.")
+    parser.add_argument("--output", help="Also write the results to this json file.")
+    options = parser.parse_args()
+
+    results = new_results("storage", runs=options.runs, threads=options.threads)
+    with bench_environment() as (base_dir, _):
+        results["configuration"] = bench_configuration(base_dir, options.runs)
+        results["storage"] = bench_storage(base_dir, options.runs, options.threads)
+    write_results(results, options.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+sync.py - Replication between two local nodes sharing a fake ipfs daemon
+
+    python -m bench.sync [--threads N] [--replies N] [--output results.json]
+
+Both nodes are served over http on 127.0.0.1 and start with posts of their
+own. They first meet by comparing their post sets, then B pulls the new
+posts of A incrementally. The posts of both nodes are compared at the end,
+a mismatch fails the run.
+"""
+
+import sys
+import logging
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+from bench.common import bench_environment, new_results, write_results
+from backend.api import API
+from storage.database import get_connection, database_path
+from storage.outbox import OutboxDrainer
+from storage.storage import Storage
+from storage.sync import Replicator
+from utils.fake_ipfs import FakeIPFS
+
+SELECT_POSTS = ("SELECT p.cid, p.body, parent.cid FROM posts p "
+                "LEFT JOIN posts parent ON parent.id = p.parent_id ORDER BY p.cid")
+
+
+def seed(storage: Storage, threads: int, replies: int) -> None:
+    """Threads with replies nested a few levels deep"""
+    def thread(index):
+        thread_id, post_id = storage.make_post("Thread %d" % index, "Opening post %d" % index)
+        parents = [post_id]
+        for reply in range(replies):
+            parent = parents[reply // 3] if reply else post_id
+            parents.append(storage.make_response(thread_id, parent, "Reply %d.%d" % (index, reply)))
+
+    with ThreadPoolExecutor(32) as seeders:
+        list(seeders.map(thread, range(threads)))
+
+
+def posts_of(settings: dict) -> list:
+    conn, lock = get_connection(database_path(settings))
+    with lock:
+        return conn.execute(SELECT_POSTS).fetchall()
+
+
+def timed_sync(replicator: Replicator, peer: str, full: bool) -> dict:
+    start = time.perf_counter()
+    imported = replicator.sync_peer(peer, full)
+    return {"imported": imported, "seconds": time.perf_counter() - start}
+
+
+def serve(api: API):
+    """Serve an api on a free port, returns the server and its base url"""
+    server = make_server("127.0.0.1", 0, api.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d" % server.server_port
+
+
+def bench_sync(threads: int, replies: int) -> dict:
+    # Request lines of the peer apis would drown the results
+    logging.getLogger("werkzeug").disabled = True
+    fake_ipfs = FakeIPFS().start()
+    try:
+        with bench_environment(fake_ipfs) as (base_a, _), bench_environment(fake_ipfs) as (base_b, _):
+            api_a, api_b = API(base_a), API(base_b)
+            server_a, peer_a = serve(api_a)
+            server_b, peer_b = serve(api_b)
+            replicator_a = Replicator(api_a.storage, api_a.conf)
+            replicator_b = Replicator(api_b.storage, api_b.conf)
+            drainer_a = OutboxDrainer(api_a.storage, api_a.conf)
+            drainer_b = OutboxDrainer(api_b.storage, api_b.conf)
+            try:
+                seed(api_a.storage, threads, replies)
+                # Posts of its own make B compare ranges when it first meets A
+                seed(api_b.storage, max(threads // 10, 1), replies)
+                start = time.perf_counter()
+                published = drainer_a.drain() + drainer_b.drain()
+                publish = {"published": published, "seconds": time.perf_counter() - start}
+                cats = fake_ipfs.calls.get("/api/v0/cat", 0)
+                first = timed_sync(replicator_b, peer_a, False)
+                first_back = timed_sync(replicator_a, peer_b, False)
+                seed(api_a.storage, max(threads // 10, 1), replies)
+                drainer_a.drain()
+                incremental = timed_sync(replicator_b, peer_a, False)
+                unchanged = timed_sync(replicator_b, peer_a, True)
+                fetched = fake_ipfs.calls.get("/api/v0/cat", 0) - cats
+                in_sync = posts_of(api_a.conf) == posts_of(api_b.conf)
+            finally:
+                server_a.shutdown()
+                server_b.shutdown()
+    finally:
+        fake_ipfs.stop()
+    return {"publish": publish, "first_sync": first, "first_sync_back": first_back,
+            "incremental_sync": incremental, "full_sync_unchanged": unchanged,
+            "objects_fetched": fetched, "in_sync": in_sync}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replication between two local nodes")
+    parser.add_argument("--threads", type=int, default=500, help="Threads seeded on node A.")
+    parser.add_argument("--replies", type=int, default=10, help="Replies in each thread.")
+    parser.add_argument("--output", help="Save the results to this json file.")
+    args = parser.parse_args()
+
+    results = new_results("sync", threads=args.threads, replies=args.replies)
+    results["results"] = bench_sync(args.threads, args.replies)
+    write_results(results, args.output)
+    if not results["results"]["in_sync"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,16 +19,33 @@
 cli_commands.py: Class containing the command line commands - ipfs version
 """
 
-from kamina.cli_commands.basic import BasicCommands
-from kamina.cli_commands.advanced import AdvancedCommands
 from kamina.process import KaminaProcess
 
 
 class CliCommands:
-    """Cli commands for managing the community node"""
+    """
+    Cli commands for managing the community node
+    The command classes are only imported by the commands using them, so
+    running one command doesn't pay for the dependencies of all the others.
+    """
     def __init__(self, kamina_process: KaminaProcess):
-        self.basic_cmd = BasicCommands(kamina_process)
-        self.adv_cmd = AdvancedCommands(kamina_process)
+        self.kamina_process = kamina_process
+        self._basic_cmd = None
+        self._adv_cmd = None
+
+    @property
+    def basic_cmd(self):
+        if self._basic_cmd is None:
+            from kamina.cli_commands.basic import BasicCommands
+            self._basic_cmd = BasicCommands(self.kamina_process)
+        return self._basic_cmd
+
+    @property
+    def adv_cmd(self):
+        if self._adv_cmd is None:
+            from kamina.cli_commands.advanced import AdvancedCommands
+            self._adv_cmd = AdvancedCommands(self.kamina_process)
+        return self._adv_cmd
 
     def init(self, install_ipfs: bool) -> None:
         """
@@ -38,9 +55,44 @@ class CliCommands:
         """
         self.basic_cmd.setup_community_node(install_ipfs)
 
-    def daemon(self) -> None:
+    def daemon(self, server: str = None) -> None:
         """
         Start community daemon
+        :param server: Server of the api, "uwsgi" or "asgi", the configured one if None
+        :return: None
+        """
+        self.adv_cmd.start_community_daemon(server)
+
+    def reindex(self) -> None:
+        """
+        Rebuild the search index
+        :return: None
+        """
+        self.adv_cmd.rebuild_search_index()
+
+    def sync(self, full: bool, peers: list) -> None:
+        """
+        Replicate posts from peer nodes
+        :param full: Compare the whole post sets instead of the new log entries
+        :param peers: Base urls of the peers, the configured ones if empty
+        :return: None
+        """
+        self.adv_cmd.sync_with_peers(full, peers)
+
+    def export_archive(self, path: str, community: str = None) -> None:
+        """
+        Export a community to an archive
+        :param path: File of the archive, an incomplete one is finished
+        :param community: Id of a hosted community, the own one of the node if None
+        :return: None
+        """
+        self.adv_cmd.export_archive(path, community)
+
+    def import_archive(self, path: str, community: str = None) -> None:
+        """
+        Import an archive into a community
+        :param path: File of the archive
+        :param community: Id of a hosted community, the own one of the node if None
         :return: None
         """
-        self.adv_cmd.start_community_daemon()
+        self.adv_cmd.import_archive(path, community)
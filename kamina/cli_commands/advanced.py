@@ -26,13 +26,10 @@ import logging
 import sys
 import os
 import time
-import urllib.request
-import urllib.error
 from pathlib import PurePath
 
-import ipfsapi
-
 from kamina.process import KaminaProcess
+from kamina.supervisor import Supervisor, SupervisedChild
 
 
 class AdvancedCommands:
@@ -92,28 +89,75 @@ class AdvancedCommands:
             )
         return ipfs_process
 
-    def _start_api_server(self) -> subprocess.Popen:
+    def _start_api_server(self, server: str) -> subprocess.Popen:
         self.logger.debug("Starting api server...")
-        uwsgi_command = "uwsgi -y conf/uwsgi.yaml"
+        if server == "asgi":
+            asgi = self.settings["asgi"]
+            server_command = ("uvicorn asgi:APP --host %s --port %d --workers %d "
+                              "--timeout-graceful-shutdown %d --no-access-log"
+                              % (asgi["host"], asgi["port"], asgi["workers"],
+                                 asgi["graceful_timeout"]))
+        else:
+            server_command = "uwsgi -y conf/uwsgi.yaml"
         if self.verbose:
-            uwsgi_process = subprocess.Popen(
-                uwsgi_command.split(),
+            server_process = subprocess.Popen(
+                server_command.split(),
                 preexec_fn=os.setpgrp
             )
         else:
-            uwsgi_process = subprocess.Popen(
-                uwsgi_command.split(),
+            server_process = subprocess.Popen(
+                server_command.split(),
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.DEVNULL,
                 preexec_fn=os.setpgrp
             )
-        return uwsgi_process
+        return server_process
+
+    def _ipfs_ready(self) -> bool:
+        from storage.ipfs import IPFSClient, IPFSUnavailable, IPFSError
+        ipfs = self.settings["ipfs"]
+        try:
+            IPFSClient(ipfs["host"], ipfs["port"], 1, 1).version()
+        except (IPFSUnavailable, IPFSError):
+            return False
+        return True
+
+    def _api_reload_signal(self, server: str):
+        """
+        Signal making the api server reload its configuration, None if it can't
+        Graceful reload: workers finish their requests, the socket stays open.
+        uvicorn only handles SIGHUP while it supervises several workers, a
+        single one would be killed by it.
+        """
+        if server == "asgi" and self.settings["asgi"]["workers"] < 2:
+            self.logger.info("The api server runs a single asgi worker, it only reads "
+                             "configuration changes once restarted")
+            return None
+        return signal.SIGHUP
+
+    @staticmethod
+    def _api_ready(port: int) -> bool:
+        import urllib.request
+        import urllib.error
+        try:
+            with urllib.request.urlopen("http://127.0.0.1:%d/api/" % port,
+                                        timeout=1) as response:
+                return response.code == 200
+        except (urllib.error.URLError, OSError):
+            return False
 
-    def start_community_daemon(self):
+    def start_community_daemon(self, server: str = None):
         """
         Starts both the flask api server and the ipfs daemon server
         In charge of handling some end signals
+        :param server: "uwsgi" or "asgi", the one set in the daemon section if None
         """
+        server = server or self.settings["daemon"]["server"]
+        if server not in ("uwsgi", "asgi"):
+            self.logger.error("Unknown api server %r, it's either uwsgi or asgi", server)
+            sys.exit(1)
+        # The port of uWSGI is set in uwsgi.yaml
+        api_port = self.settings["asgi"]["port"] if server == "asgi" else 1337
         self.logger.info("Starting community daemon...")
         # Setup signal handlers
         self.process.setup_sighandlers()
@@ -124,58 +168,174 @@ class AdvancedCommands:
             sys.exit(1)
 
         community_dir_path = shlex.quote(self.settings["general"]["node_dir"])
-        # Flags for process control
-        ipfs_started = False
-        api_started = False
-        all_good = False
-
-        # Variables in order to terminate processes
-        ipfs_process = None
-        api_process = None
-
-        while self.process.running:
-            # This way we start processes only once
-            if not ipfs_started:
-                ipfs_process = self._start_ipfs_daemon(community_dir_path, ipfs_binary)
-                # Wait for ipfs to start
-                while not ipfs_started:
-                    try:
-                        # TODO: Add port configuration functionality
-                        ipfsapi.connect('127.0.0.1', 5001)
-                    except ipfsapi.exceptions.ConnectionError:
-                        continue
-                    else:
-                        ipfs_started = True
-                    time.sleep(0.01)
-
-            if not api_started:
-                api_process = self._start_api_server()
-                # Wait for uwsgi to start
-                while not api_started:
-                    try:
-                        with urllib.request.urlopen("http://127.0.0.1:1337/api/") as response:
-                            if response.code != 200:
-                                continue
-                    except urllib.error.URLError:
-                        continue
-                    else:
-                        api_started = True
-                    time.sleep(0.01)
-
-            if not all_good:
-                # If we reach this point, everything went fine
-                all_good = True
-                self.logger.info("Community daemon started")
-                self.logger.info("- Flask listening on port 1337")
-                self.logger.info("- IPFS listening on port 5001")
-
-            time.sleep(0.01)  # Avoid 100% CPU usage
-
-        # Now send end signal to all processes
-        self.logger.debug("Stopping ipfs daemon...")
-        ipfs_process.terminate()
-        ipfs_process.wait()
-        self.logger.debug("Stopping api server...")
-        api_process.send_signal(signal.SIGQUIT)
-        api_process.wait()
+        daemon_settings = self.settings["daemon"]
+        supervisor = Supervisor(self.process, daemon_settings["ready_timeout"],
+                                daemon_settings["restart_limit"],
+                                daemon_settings["restart_window"])
+        supervisor.add(SupervisedChild(
+            "IPFS daemon",
+            lambda: self._start_ipfs_daemon(community_dir_path, ipfs_binary),
+            self._ipfs_ready
+        ))
+        supervisor.add(SupervisedChild(
+            "API server",
+            lambda: self._start_api_server(server),
+            lambda: self._api_ready(api_port),
+            # uWSGI stops at once on SIGQUIT, uvicorn lets requests finish on SIGTERM
+            stop_signal=signal.SIGQUIT if server == "uwsgi" else signal.SIGTERM,
+            reload_signal=self._api_reload_signal(server)
+        ))
+
+        # Background tasks of every community, they all have start() and stop()
+        tasks = []
+
+        def on_ready():
+            from kamina import metrics
+            from storage.outbox import OutboxDrainer
+            from storage.media import MediaWorker
+            from storage.ranking import Ranker
+            from storage.sync import Replicator, SyncTask
+            self.logger.info("Community daemon started")
+            self.logger.info("- Api served by %s on port %d", server, api_port)
+            self.logger.info("- IPFS listening on port %d", self.settings["ipfs"]["port"])
+            # The outbox metrics are served by the api along with its own
+            metrics.configure(str(PurePath(self.settings["general"]["node_dir"], "metrics")))
+            for storage in self._get_shards().all():
+                tasks.append(OutboxDrainer(storage, self.settings))
+                tasks.append(MediaWorker(storage, self.settings))
+                tasks.append(Ranker(storage, self.settings))
+                if self.settings["sync"]["peers"]:
+                    tasks.append(SyncTask(Replicator(storage, self.settings),
+                                          self.settings["sync"]["interval"]))
+            for task in tasks:
+                task.start()
+            if self.settings["general"]["communities"]:
+                self.logger.info("- Hosting %d more communities",
+                                 len(self.settings["general"]["communities"]))
+            if self.settings["sync"]["peers"]:
+                self.logger.info("- Syncing with %d peers", len(self.settings["sync"]["peers"]))
+
+        healthy = supervisor.run(on_ready)
+        for task in tasks:
+            task.stop()
         self.logger.info("Stopped community daemon")
+        if not healthy:
+            sys.exit(1)
+
+    def rebuild_search_index(self) -> None:
+        """
+        Build the full text index again from the posts in the local databases
+        The databases of the communities are rebuilt at the same time, a
+        process each, up to one per core.
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        from storage.database import database_path
+        from storage.search import rebuild_index, SearchUnavailable
+        from storage.shards import check_communities
+
+        self.logger.info("Rebuilding search index...")
+        started = time.monotonic()
+        paths = [database_path(self.settings, community) for community in
+                 [None] + check_communities(self.settings["general"]["communities"])]
+        try:
+            if len(paths) == 1:
+                indexed = rebuild_index(paths[0])
+            else:
+                # Never forked, the logging listener thread holds locks
+                with ProcessPoolExecutor(min(len(paths), os.cpu_count() or 1),
+                                         mp_context=multiprocessing.get_context("forkserver")) \
+                        as pool:
+                    indexed = sum(pool.map(rebuild_index, paths))
+        except SearchUnavailable:
+            self.logger.error("Your sqlite library was built without fts5, unable to search")
+            sys.exit(1)
+        self.logger.info("Indexed %d posts in %.1fs", indexed, time.monotonic() - started)
+
+    def _get_shards(self):
+        from storage.shards import Shards
+        return Shards(self.settings)
+
+    def sync_with_peers(self, full: bool, peers: list) -> None:
+        """
+        Publish the local posts and pull the missing ones from peers, once
+        :param full: Compare the whole post sets instead of the new log entries
+        :param peers: Base urls of the peer nodes, the configured ones if empty
+        """
+        from storage.ipfs import IPFSUnavailable, IPFSError
+        from storage.outbox import OutboxDrainer
+        from storage.sync import Replicator
+
+        peers = peers or self.settings["sync"]["peers"]
+        if not peers:
+            self.logger.error("No peers to sync with, add some to the sync section of kamina.yaml")
+            sys.exit(1)
+        started = time.monotonic()
+        published = imported = 0
+        try:
+            for storage in self._get_shards().all():
+                published += OutboxDrainer(storage, self.settings).drain()
+                imported += Replicator(storage, self.settings).sync_all(peers, full)
+            if published:
+                self.logger.info("Published %d posts", published)
+        except (IPFSUnavailable, IPFSError) as error:
+            self.logger.error("Unable to reach the ipfs daemon: %s", error)
+            sys.exit(1)
+        self.logger.info("Imported %d posts from %d peers in %.1fs", imported, len(peers),
+                         time.monotonic() - started)
+
+    def _get_shard(self, community: str = None):
+        from storage.shards import UnknownCommunity
+        try:
+            return self._get_shards().get(community)
+        except UnknownCommunity:
+            self.logger.error("Unknown community %r, add it to general.communities "
+                              "of kamina.yaml", community)
+            sys.exit(1)
+
+    def export_archive(self, path: str, community: str = None) -> None:
+        """
+        Publish the local posts, then write the posts and uploads of a community to an archive
+        :param path: File of the archive, an incomplete one is finished
+        :param community: Id of a hosted community, the own one of the node if None
+        """
+        from storage.archive import Exporter, ArchiveError
+        from storage.ipfs import IPFSUnavailable, IPFSError
+        from storage.outbox import OutboxDrainer
+
+        storage = self._get_shard(community)
+        started = time.monotonic()
+        try:
+            # Posts without a CID yet would be left out
+            OutboxDrainer(storage, self.settings).drain()
+            posts, uploads = Exporter(storage, self.settings).export(path)
+        except (IPFSUnavailable, IPFSError) as error:
+            self.logger.error("Unable to reach the ipfs daemon: %s", error)
+            sys.exit(1)
+        except ArchiveError as error:
+            self.logger.error("Unable to export to %s: %s", path, error)
+            sys.exit(1)
+        self.logger.info("Exported %d posts and %d uploads to %s in %.1fs", posts, uploads,
+                         path, time.monotonic() - started)
+
+    def import_archive(self, path: str, community: str = None) -> None:
+        """
+        Load the posts and uploads of an archive into a community, and add them to ipfs
+        :param path: File of the archive
+        :param community: Id of a hosted community, the own one of the node if None
+        """
+        from storage.archive import Importer, ArchiveError
+        from storage.ipfs import IPFSUnavailable, IPFSError
+
+        storage = self._get_shard(community)
+        started = time.monotonic()
+        try:
+            posts, uploads = Importer(storage, self.settings).import_archive(path)
+        except (IPFSUnavailable, IPFSError) as error:
+            self.logger.error("Unable to reach the ipfs daemon: %s", error)
+            sys.exit(1)
+        except ArchiveError as error:
+            self.logger.error("Unable to import %s: %s", path, error)
+            sys.exit(1)
+        self.logger.info("Imported %d posts and %d uploads from %s in %.1fs", posts, uploads,
+                         path, time.monotonic() - started)
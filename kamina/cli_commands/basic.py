@@ -29,12 +29,31 @@ import logging
 import sys
 from pathlib import PurePath
 
-import requests
-from tqdm import tqdm
-
 from kamina.process import KaminaProcess
 
 
+def ipfs_archive_name(version: str) -> str:
+    """Name of the go-ipfs release archive for the current platform"""
+    system = platform.system()
+    arch = platform.machine()
+    extension = "tar.gz"
+
+    # Replace the system name
+    if system == "Linux":
+        system = "linux"
+    elif system == "Windows":
+        system = "windows"
+        extension = "zip"  # The windows binary uses another extension
+
+    # Replace the arch
+    if arch == "x86_64":
+        arch = "amd64"
+    elif arch == "i386":
+        arch = "386"
+
+    return "go-ipfs_%s_%s-%s.%s" % (version, system, arch, extension)
+
+
 class BasicCommands:
     """Basic commands for managing the -community node."""
     def __init__(self, kamina_process: KaminaProcess):
@@ -111,47 +130,58 @@ class BasicCommands:
     def _install_ipfs(self, install_dir: str) -> None:
         """
         Download the correct ipfs binary for your platform
+        The archive is kept in the download cache, keyed by version and
+        platform, and only downloaded again if it is missing or damaged. It is
+        only ever used once it matches the digest configured for it, or else
+        the one published next to it.
         :return: None
         """
-        # Download to a temporary directory
-        system = platform.system()
-        arch = platform.machine()
-        extension = "tar.gz"
-
-        # Replace the system name
-        if system == "Linux":
-            system = "linux"
-        elif system == "Windows":
-            system = "windows"
-            extension = "zip"  # The windows binary uses another extension
-
-        # Replace the arch
-        if arch == "x86_64":
-            arch = "amd64"
-        elif arch == "i386":
-            arch = "386"
+        from tqdm import tqdm
+        from kamina.download import Download, DownloadError, file_digest, published_digest
+
+        ipfs = self.settings["ipfs"]
+        version = ipfs["version"]
+        archive_name = ipfs_archive_name(version)
+        cache_dir = str(PurePath(ipfs["download_cache"], "go-ipfs", version))
+        archive = str(PurePath(cache_dir, archive_name))
+        download_url = "%s/go-ipfs/%s/%s" % (ipfs["dist_url"].rstrip("/"), version,
+                                             archive_name)
+        algorithm, expected = "sha256", (ipfs["sha256"] or {}).get(archive_name)
+        if expected is None:
+            try:
+                algorithm, expected = published_digest(download_url, ipfs["timeout"])
+            except DownloadError as error:
+                self.logger.error("%s, add the sha256 digest of '%s' to the ipfs section "
+                                  "of kamina.yaml to install it", error, archive_name)
+                sys.exit(1)
 
-        temp_dl_dir = tempfile.TemporaryDirectory()
-        temp_dl_filename = "go-ipfs_v0.4.14_%s-%s.%s" % (system, arch, extension)
-        temp_dl_file_location = str(PurePath(temp_dl_dir.name, temp_dl_filename))
-        download_url = "https://dist.ipfs.io/go-ipfs/v0.4.14/%s" % temp_dl_filename
-        # Now download the file
-        response = requests.get(download_url, stream=True)
-        total_size = int(response.headers.get("content-length", 0))
-        with open(temp_dl_file_location, "wb") as file:
+        if os.path.exists(archive):
+            if file_digest(archive, algorithm) == expected.lower():
+                self.logger.debug("Using cached archive '%s'", archive)
+            else:
+                self.logger.warning("Cached archive '%s' is damaged, downloading it again",
+                                    archive)
+                os.unlink(archive)
+        if not os.path.exists(archive):
+            os.makedirs(cache_dir, exist_ok=True)
+            self.logger.debug("Downloading %s", download_url)
+            pbar = None
             if self.debug or self.verbose:
                 # Show a nice progress bar
-                pbar = tqdm(total=total_size, unit="B", unit_scale=True)
-                for data in response.iter_content(1024):
-                    file.write(data)
-                    pbar.update(1024)
-                pbar.close()
-            else:
-                for data in response.iter_content():
-                    file.write(data)
+                pbar = tqdm(unit="B", unit_scale=True)
+            try:
+                Download(download_url, archive, ipfs["download_connections"],
+                         ipfs["timeout"], pbar).run(expected, algorithm)
+            except DownloadError as error:
+                self.logger.error("%s", error)
+                sys.exit(1)
+            finally:
+                if pbar is not None:
+                    pbar.close()
 
         # Extract it
+        temp_dl_dir = tempfile.TemporaryDirectory()
         self.logger.debug("Extracting downloaded binary...")
-        shutil.unpack_archive(temp_dl_file_location, temp_dl_dir.name)
+        shutil.unpack_archive(archive, temp_dl_dir.name)
         self.logger.debug("Copying files to '%s'...", install_dir)
         shutil.copytree(str(PurePath(temp_dl_dir.name, "go-ipfs")), install_dir)
@@ -22,17 +22,29 @@ settings.py - Load and parse configuration files
 
 import sys
 import os
+import json
+import tempfile
 import logging
 import logging.config
 import logging.handlers
 from pathlib import Path, PurePath
 
-import yaml
+from kamina import logqueue
+
+# Parsed and substituted configuration, saved next to the yaml files
+CACHE_FILE = ".kamina-conf.cache.json"
+SOURCE_FILES = ("kamina.yaml", "logging.yaml")
+
+
+class ConfigurationError(Exception):
+    """Raised when a configuration file can't be parsed"""
 
 
 class KaminaConfiguration:
     """
     Helper class to load and parse config files in conf folder
+    Parsing yaml is slow, so the parsed result is cached on disk and only
+    parsed again once one of the files changes.
     """
     def __init__(self, base_dir: str):
         # TODO: Set needed defaults
@@ -40,23 +52,116 @@ class KaminaConfiguration:
         self.base_dir = base_dir
         self.conf_dir = PurePath(base_dir, "conf")
         self.logger = logging.getLogger()
+        self.overrides = []
+        self._source_key = None
         if not os.path.exists(self.conf_dir):
             print(self.conf_dir)
             print("Config dir not found")
             sys.exit(1)
-        self._setup_logger()
-        self._load_conf()
-        self.conf = self._replace_vars(self.conf)  # Damn recursion lol
+        try:
+            snapshot = self._load_snapshot()
+        except ConfigurationError as error:
+            print(error)
+            sys.exit(1)
+        self._apply(snapshot)
+
+    def set_override(self, section: str, key: str, value) -> None:
+        """
+        Force a setting, whatever the config files say, across reloads
+        Used by the command line flags.
+        """
+        self.overrides.append((section, key, value))
+        self.conf[section][key] = value
+
+    def reload(self) -> bool:
+        """
+        Reload the configuration files if they changed, updating conf in place
+        so everybody holding a reference to it sees the new values.
+        :return: True if something was reloaded
+        """
+        try:
+            if self._get_source_key() == self._source_key:
+                return False
+            snapshot = self._load_snapshot()
+        except (ConfigurationError, OSError) as error:
+            self.logger.error("Not reloading configuration: %s", error)
+            return False
+        self._apply(snapshot)
+        self.logger.info("Configuration reloaded")
+        return True
 
-    def _setup_logger(self):
-        # Try to open logging config
-        with open(PurePath(self.conf_dir, "logging.yaml"), "rt") as log_cfg:
+    def _apply(self, snapshot: dict) -> None:
+        self._source_key = snapshot["key"]
+        self._setup_logger(snapshot["logging"])
+        conf = snapshot["kamina"]
+        for section, key, value in self.overrides:
+            conf[section][key] = value
+        # Background threads read conf all along: its sections are swapped one
+        # by one, never leaving it without one of them, even for an instant
+        self.conf.update(conf)
+        for section in set(self.conf) - set(conf):
+            del self.conf[section]
+        troubleshoot = self.conf.get("troubleshoot", {})
+        if troubleshoot.get("debug") or troubleshoot.get("verbose"):
+            self.logger.setLevel(logging.DEBUG)
+
+    def _get_source_key(self) -> list:
+        """What the cached snapshot depends on: source files and home directory"""
+        key = [str(Path.home())]
+        for name in SOURCE_FILES:
+            stat = os.stat(str(PurePath(self.conf_dir, name)))
+            key.append([name, stat.st_mtime_ns, stat.st_size])
+        return key
+
+    def _load_snapshot(self) -> dict:
+        key = self._get_source_key()
+        cache_path = str(PurePath(self.conf_dir, CACHE_FILE))
+        try:
+            with open(cache_path, "rt") as cache:
+                snapshot = json.load(cache)
+            if snapshot.get("key") == key:
+                return snapshot
+        except (OSError, ValueError):
+            pass
+
+        snapshot = {
+            "key": key,
+            "logging": self._parse("logging.yaml"),
+            "kamina": self._replace_vars(self._parse("kamina.yaml")),
+        }
+        self._save_snapshot(cache_path, snapshot)
+        return snapshot
+
+    @staticmethod
+    def _save_snapshot(cache_path: str, snapshot: dict) -> None:
+        # Written atomically, other processes may be reading it right now
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path),
+                                                 prefix=".tmp-")
+        except OSError:
+            return  # Read only conf dir, live without the cache
+        try:
+            with os.fdopen(handle, "wt") as temp:
+                json.dump(snapshot, temp)
+            os.replace(temp_path, cache_path)
+        except (OSError, TypeError, ValueError):
+            os.unlink(temp_path)
+
+    def _parse(self, name: str) -> dict:
+        import yaml
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        with open(str(PurePath(self.conf_dir, name)), "rt") as cfg:
             try:
-                logging_conf = yaml.load(log_cfg)
+                return yaml.load(cfg, Loader=loader)
             except yaml.YAMLError:
-                print("Error parsing logging configuration.")
-                sys.exit(1)
+                raise ConfigurationError("Error parsing %s" % name)
 
+    def _setup_logger(self, logging_conf: dict):
+        # The queue settings are ours, dictConfig doesn't know about them
+        logging_conf = dict(logging_conf)
+        queue_conf = logging_conf.pop("queue", {})
+        # Flush what the previous handlers still have to write before replacing them
+        logqueue.stop_all()
         # Setup logging
         try:
             logging.config.dictConfig(logging_conf)
@@ -65,19 +170,14 @@ class KaminaConfiguration:
             self._setup_logger_defaults()
         else:
             self.logger = logging.getLogger("kamina")
+        # Slow handlers (disk, syslog) run in a background thread, off the request path
+        logqueue.install([logging.getLogger(), self.logger], queue_conf.get("size", 10000))
 
     def _setup_logger_defaults(self):
         self.logger = logging.getLogger("kamina")
-        self.logger.addHandler(logging.StreamHandler(sys.stdout))
-        self.logger.addHandler(logging.FileHandler(PurePath(self.base_dir, "kamina.log")))
-
-    def _load_conf(self):
-        with open(PurePath(self.conf_dir, "kamina.yaml"), "rt") as cfg:
-            try:
-                self.conf = yaml.load(cfg)
-            except yaml.YAMLError:
-                self.logger.error("Error parsing kamina.yaml")
-                sys.exit(1)
+        if not self.logger.handlers:
+            self.logger.addHandler(logging.StreamHandler(sys.stdout))
+            self.logger.addHandler(logging.FileHandler(PurePath(self.base_dir, "kamina.log")))
 
     def _replace_vars(self, config: dict):
         """
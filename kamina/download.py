@@ -0,0 +1,276 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+download.py - Parallel and resumable downloads of release archives
+A file is fetched in parts over several connections with http range
+requests. The parts already written are recorded next to the partial file,
+so an interrupted download starts again where it stopped. A release archive
+is checked against the digest its dist server publishes, unless one is given.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 1 << 20
+PART_SIZE = 4 << 20
+# Digests dist.json may list, the strongest first
+DIGEST_ALGORITHMS = ("sha512", "sha256")
+
+
+class DownloadError(Exception):
+    """Raised when a download fails or doesn't match its checksum"""
+
+
+class SourceChanged(DownloadError):
+    """Raised when the file changed upstream since the parts already written"""
+
+
+def file_digest(path: str, algorithm: str = "sha256") -> str:
+    """Hex digest of a file, with any algorithm of hashlib"""
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sha256_file(path: str) -> str:
+    """Hex SHA-256 digest of a file"""
+    return file_digest(path, "sha256")
+
+
+def _find_digest(entry, name: str):
+    """Digest of the entry of dist.json whose link is the archive name, None if there is none"""
+    if isinstance(entry, dict):
+        link = entry.get("link")
+        if isinstance(link, str) and link.rsplit("/", 1)[-1] == name:
+            for algorithm in DIGEST_ALGORITHMS:
+                if isinstance(entry.get(algorithm), str):
+                    return algorithm, entry[algorithm].lower()
+        entries = entry.values()
+    elif isinstance(entry, list):
+        entries = entry
+    else:
+        return None
+    for child in entries:
+        found = _find_digest(child, name)
+        if found is not None:
+            return found
+    return None
+
+
+def published_digest(url: str, timeout: float = 30) -> tuple:
+    """
+    Digest of a release archive, as published by its dist server
+    The <archive>.sha512 checksum file is read first, then the dist.json
+    listing the archives of the release.
+    :param url: Url of the archive
+    :return: Tuple of (hashlib algorithm, hex digest), otherwise, DownloadError
+    """
+    name = url.rsplit("/", 1)[-1]
+    try:
+        response = requests.get(url + ".sha512", timeout=timeout)
+        if response.status_code == 200:
+            # sha512sum output, the digest then the file name
+            digest = (response.text.split() or [""])[0].lower()
+            if len(digest) == hashlib.sha512().digest_size * 2:
+                return "sha512", digest
+        response = requests.get(url.rsplit("/", 1)[0] + "/dist.json", timeout=timeout)
+        if response.status_code == 200:
+            found = _find_digest(response.json(), name)
+            if found is not None:
+                return found
+    except (requests.RequestException, ValueError) as error:
+        raise DownloadError("Unable to read the published digest of %s: %s" % (url, error))
+    raise DownloadError("No digest of %s is published next to it" % url)
+
+
+class Download:
+    """
+    Download of one url into a file
+    The file is written as <destination>.part, and only moved into place once
+    complete and checked. <destination>.part.json lists the finished parts.
+    """
+    def __init__(self, url: str, destination: str, connections: int = 4,
+                 timeout: float = 30, progress=None):
+        """
+        :param url: Url of the file
+        :param destination: Path the file is saved to
+        :param connections: Parts fetched at the same time
+        :param timeout: Seconds to wait for the server, per request
+        :param progress: Progress bar to keep up to date, anything with a total
+                         attribute, an update(bytes) and a reset() method, like tqdm
+        """
+        self.url = url
+        self.destination = destination
+        self.partial = destination + ".part"
+        self.state_path = destination + ".part.json"
+        self.connections = max(connections, 1)
+        self.timeout = timeout
+        self.progress = progress
+        self.logger = logging.getLogger("kamina")
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._session.mount(url, HTTPAdapter(pool_maxsize=self.connections))
+
+    def run(self, digest: str, algorithm: str = "sha256") -> str:
+        """
+        Download the file, resuming a previous attempt if there is one
+        If the file changed upstream, the parts already written are thrown
+        away and the download starts over, once.
+        :param digest: Expected hex digest, the download is discarded if it differs
+        :param algorithm: Hashlib algorithm of the digest
+        :return: The hex digest of the file, otherwise, DownloadError
+        """
+        try:
+            try:
+                self._fetch()
+            except SourceChanged:
+                self.logger.warning("%s changed since the download started, starting over",
+                                    self.url)
+                self._discard()
+                if self.progress is not None:
+                    self.progress.reset()
+                self._fetch()
+        except requests.RequestException as error:
+            raise DownloadError("Failed to download %s: %s" % (self.url, error))
+        finally:
+            self._session.close()
+
+        actual = file_digest(self.partial, algorithm)
+        if actual != digest.lower():
+            self._discard()
+            raise DownloadError("Checksum mismatch for %s: expected %s, got %s"
+                                % (self.url, digest, actual))
+        os.replace(self.partial, self.destination)
+        if os.path.exists(self.state_path):
+            os.unlink(self.state_path)
+        return actual
+
+    def _fetch(self) -> None:
+        size, validator, ranges = self._probe()
+        if ranges and size:
+            self._fetch_parts(size, validator)
+        else:
+            self._fetch_whole()
+
+    def _probe(self) -> tuple:
+        """Size of the file, its validator and whether the server serves ranges"""
+        response = self._session.head(self.url, allow_redirects=True, timeout=self.timeout)
+        if response.status_code >= 400:
+            # Some servers refuse HEAD, a plain download still works there
+            return 0, None, False
+        size = int(response.headers.get("Content-Length", 0))
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        return size, validator, response.headers.get("Accept-Ranges") == "bytes"
+
+    def _load_state(self, size: int, validator) -> set:
+        """Parts already written, if the partial file is of this same file"""
+        try:
+            with open(self.state_path, "rt") as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            return set()
+        if (state.get("url") != self.url or state.get("size") != size
+                or state.get("validator") != validator or state.get("part_size") != PART_SIZE
+                or not os.path.exists(self.partial)):
+            return set()
+        return set(state.get("done", []))
+
+    def _save_state(self, size: int, validator, done: set) -> None:
+        temp = self.state_path + ".tmp"
+        with open(temp, "wt") as state_file:
+            json.dump({"url": self.url, "size": size, "validator": validator,
+                       "part_size": PART_SIZE, "done": sorted(done)}, state_file)
+        os.replace(temp, self.state_path)
+
+    def _fetch_parts(self, size: int, validator) -> None:
+        done = self._load_state(size, validator)
+        if not done:
+            with open(self.partial, "wb") as file:
+                file.truncate(size)
+        parts = [(index, index * PART_SIZE, min((index + 1) * PART_SIZE, size) - 1)
+                 for index in range((size + PART_SIZE - 1) // PART_SIZE)]
+        pending = [part for part in parts if part[0] not in done]
+        if done:
+            self.logger.info("Resuming download of %s, %d of %d parts left",
+                             self.url, len(pending), len(parts))
+        if self.progress is not None:
+            self.progress.total = size
+            self.progress.update(sum(end - start + 1 for index, start, end in parts
+                                     if index in done))
+
+        def fetch(part: tuple) -> None:
+            index, start, end = part
+            self._fetch_range(start, end, validator)
+            with self._lock:
+                done.add(index)
+                self._save_state(size, validator, done)
+
+        with ThreadPoolExecutor(self.connections) as pool:
+            # list() makes the first failure raise here
+            list(pool.map(fetch, pending))
+
+    def _fetch_range(self, start: int, end: int, validator) -> None:
+        headers = {"Range": "bytes=%d-%d" % (start, end)}
+        if validator is not None:
+            # The whole file is sent back if it changed in the meantime
+            headers["If-Range"] = validator
+        with self._session.get(self.url, headers=headers, stream=True,
+                               timeout=self.timeout) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                if validator is not None:
+                    # If-Range didn't match: the whole new file is being sent
+                    raise SourceChanged(self.url)
+                raise DownloadError("%s ignored the range request" % self.url)
+            written = 0
+            with open(self.partial, "r+b") as file:
+                file.seek(start)
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    file.write(chunk)
+                    written += len(chunk)
+                    if self.progress is not None:
+                        self.progress.update(len(chunk))
+        if written != end - start + 1:
+            raise DownloadError("Short read from %s" % self.url)
+
+    def _fetch_whole(self) -> None:
+        """Single stream download, for servers without range requests"""
+        self._discard()
+        with self._session.get(self.url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            if self.progress is not None:
+                self.progress.total = int(response.headers.get("Content-Length", 0))
+            with open(self.partial, "wb") as file:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    file.write(chunk)
+                    if self.progress is not None:
+                        self.progress.update(len(chunk))
+
+    def _discard(self) -> None:
+        for path in (self.partial, self.state_path):
+            if os.path.exists(path):
+                os.unlink(path)
@@ -0,0 +1,205 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+logqueue.py - Keep slow log handlers off the request path
+The configured handlers run in a listener thread of their own, callers only
+append records to a bounded queue. When the queue is full records are dropped,
+counted and reported once the listener catches up.
+"""
+
+import os
+import time
+import atexit
+import logging
+import logging.handlers
+import threading
+from collections import deque
+
+from kamina.metrics import Counter
+
+LOG_RECORDS_DROPPED = Counter("kamina_log_records_dropped_total",
+                              "Log records dropped by a full queue or by sampling", ("reason",))
+
+FLUSH_DELAY = 0.05
+REPORT_INTERVAL = 1.0
+
+# Every installed queue handler, to stop their listeners on reload and exit
+_QUEUE_HANDLERS = []
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Rate limit noisy records, at most rate per second with bursts of burst
+    from each call site. Records above level always pass.
+    """
+    def __init__(self, rate: float = 10.0, burst: int = 20, level="DEBUG"):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.level = level if isinstance(level, int) else logging.getLevelName(level)
+        self.sampled = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.level:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self.sampled += 1
+                LOG_RECORDS_DROPPED.inc("sampled")
+                return False
+            self._buckets[key] = (tokens - 1, now)
+        return True
+
+
+class _Listener:
+    """
+    Thread handing queued records to the handlers
+    Woken up by the first record after an idle period, it then waits
+    FLUSH_DELAY so the records piling up meanwhile are handled in one go,
+    callers hardly ever pay for waking it up. Dropped records are reported
+    once it caught up, at most every REPORT_INTERVAL seconds.
+    """
+    def __init__(self, queue_handler):
+        self.queue_handler = queue_handler
+        self.records = queue_handler.records
+        self.reported = 0
+        self.last_report = 0.0
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self._thread = threading.Thread(target=self._run, name="kamina-log", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self.stopping:
+            self.wakeup.wait()
+            time.sleep(FLUSH_DELAY)
+            self.wakeup.clear()
+            self._drain()
+        self._drain()
+        self._report(True)
+
+    def _drain(self) -> None:
+        while True:
+            try:
+                record = self.records.popleft()
+            except IndexError:
+                break
+            self._handle(record)
+        self._report()
+
+    def _handle(self, record: logging.LogRecord) -> None:
+        for handler in self.queue_handler.targets:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _report(self, force: bool = False) -> None:
+        dropped = self.queue_handler.dropped
+        now = time.monotonic()
+        if dropped == self.reported or (now - self.last_report < REPORT_INTERVAL and not force):
+            return
+        self._handle(logging.LogRecord("kamina", logging.WARNING, __file__, 0,
+                                       "Dropped %d log records, the logging queue was full",
+                                       (dropped - self.reported,), None))
+        self.reported = dropped
+        self.last_report = now
+
+    def stop(self) -> None:
+        self.stopping = True
+        self.wakeup.set()
+        self._thread.join()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue records for handlers run by a listener thread
+    The listener is started lazily in every process, threads don't survive
+    the fork of uWSGI workers.
+    """
+    def __init__(self, handlers: list, size: int):
+        super().__init__(None)
+        self.targets = handlers
+        self.size = size
+        self.records = deque()
+        self.dropped = 0
+        self._pid = None
+        self._listener = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                # Records queued, or dropped, before the fork belong to the parent
+                self.records = deque()
+                self.dropped = 0
+                self._listener = _Listener(self)
+                self._pid = os.getpid()
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self._ensure_listener()
+        # Serialized by the handler lock, no need for one of our own
+        if len(self.records) >= self.size:
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.inc("queue_full")
+            return
+        self.records.append(record)
+        if not self._listener.wakeup.is_set():
+            self._listener.wakeup.set()
+
+    def stop(self) -> None:
+        """Handle every queued record and stop the listener"""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                self._listener.stop()
+            self._pid = None
+
+
+def install(loggers: list, size: int) -> None:
+    """
+    Move the handlers of each logger behind a queue handler of its own
+    :param loggers: Loggers already configured with their handlers
+    :param size: Maximum number of records waiting in each queue
+    """
+    for logger in loggers:
+        handlers = [handler for handler in logger.handlers
+                    if not isinstance(handler, DroppingQueueHandler)]
+        if not handlers:
+            continue
+        for handler in handlers:
+            logger.removeHandler(handler)
+        queue_handler = DroppingQueueHandler(handlers, size)
+        logger.addHandler(queue_handler)
+        _QUEUE_HANDLERS.append(queue_handler)
+
+
+def stop_all() -> None:
+    """Flush every queue, before exiting or replacing the handlers"""
+    while _QUEUE_HANDLERS:
+        _QUEUE_HANDLERS.pop().stop()
+
+
+atexit.register(stop_all)
@@ -0,0 +1,377 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+metrics.py - Counters, gauges and histograms shared across uWSGI workers
+Every process writes its values to its own memory mapped file, the
+/metrics endpoint adds up the files of all the processes. Until configure()
+is called values are only kept in memory, which is what the cli wants.
+"""
+
+import os
+import json
+import bisect
+import mmap
+import time
+import struct
+import threading
+import functools
+
+HEADER = struct.Struct("=Q")
+KEY_SIZE = struct.Struct("=I")
+VALUE = struct.Struct("=d")
+INITIAL_SIZE = 64 * 1024
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MappedValues:
+    """
+    Append only key -> float store in a memory mapped file
+    Layout: used bytes, then (key size, key padded to 8 bytes, value) entries.
+    An entry is complete before the used bytes header covers it, so readers
+    in other processes never see half an entry.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._positions = {}
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size < INITIAL_SIZE:
+                os.ftruncate(fd, INITIAL_SIZE)
+                size = INITIAL_SIZE
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._used = HEADER.unpack_from(self._map, 0)[0] or HEADER.size
+        for key, _, position in read_entries(self._map, self._used):
+            self._positions[key] = position
+
+    def _grow(self, needed: int) -> None:
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+        self._map.close()
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def _append(self, key: str) -> int:
+        encoded = key.encode("utf8")
+        padded = len(encoded) + (-(KEY_SIZE.size + len(encoded)) % 8)
+        entry_size = KEY_SIZE.size + padded + VALUE.size
+        if self._used + entry_size > len(self._map):
+            self._grow(self._used + entry_size)
+        KEY_SIZE.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + KEY_SIZE.size:self._used + KEY_SIZE.size + len(encoded)] = encoded
+        position = self._used + KEY_SIZE.size + padded
+        VALUE.pack_into(self._map, position, 0.0)
+        self._used += entry_size
+        HEADER.pack_into(self._map, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def add(self, key: str, amount: float) -> None:
+        position = self._positions.get(key)
+        if position is None:
+            position = self._append(key)
+        VALUE.pack_into(self._map, position,
+                        VALUE.unpack_from(self._map, position)[0] + amount)
+
+    def set(self, key: str, value: float) -> None:
+        position = self._positions.get(key)
+        if position is None:
+            position = self._append(key)
+        VALUE.pack_into(self._map, position, value)
+
+
+def read_entries(buffer, used: int):
+    """Yield the (key, value, value position) entries of a MappedValues buffer"""
+    position = HEADER.size
+    while position < used:
+        key_size = KEY_SIZE.unpack_from(buffer, position)[0]
+        start = position + KEY_SIZE.size
+        key = bytes(buffer[start:start + key_size]).decode("utf8")
+        value_position = start + key_size + (-(KEY_SIZE.size + key_size) % 8)
+        yield key, VALUE.unpack_from(buffer, value_position)[0], value_position
+        position = value_position + VALUE.size
+
+
+class MemoryValues:
+    """Same interface as MappedValues, for processes that don't share metrics"""
+    def __init__(self):
+        self.values = {}
+
+    def add(self, key: str, amount: float) -> None:
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def set(self, key: str, value: float) -> None:
+        self.values[key] = value
+
+
+class Registry:
+    """Every declared metric, plus the storage of the values of this process"""
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.directory = None
+        self._values = MemoryValues()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def configure(self, directory: str) -> None:
+        """
+        Share the values of this process, and of its forks, through directory
+        Files left by dead processes are removed, so counters start over along
+        with the daemon like prometheus expects.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".metrics") and not _pid_alive(int(name.split(".")[0])):
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except OSError:
+                    pass
+        with self._lock:
+            self.directory = directory
+            self._pid = None
+
+    def _store(self):
+        # uWSGI forks its workers after loading the app, each gets its own file
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            if self.directory is None:
+                self._values = MemoryValues()
+            else:
+                self._values = MappedValues(os.path.join(self.directory,
+                                                         "%d.metrics" % self._pid))
+        return self._values
+
+    def add(self, key: str, amount: float) -> None:
+        with self._lock:
+            self._store().add(key, amount)
+
+    def add_many(self, amounts: tuple) -> None:
+        """Add several (key, amount) pairs under a single lock"""
+        with self._lock:
+            store = self._store()
+            for key, amount in amounts:
+                store.add(key, amount)
+
+    def set(self, key: str, value: float) -> None:
+        with self._lock:
+            self._store().set(key, value)
+
+    def register(self, metric) -> None:
+        self.metrics.append(metric)
+
+    def add_collector(self, collector) -> None:
+        """
+        Add a callable run on every scrape, it gets the summed up values
+        and returns extra exposition lines
+        """
+        self.collectors.append(collector)
+
+    def _collect_values(self) -> tuple:
+        """Sum the values of every process, gauges only from live processes"""
+        with self._lock:
+            if self.directory is None:
+                return dict(self._store().values), {}
+        totals = {}
+        gauges = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith(".metrics"):
+                continue
+            pid = int(name.split(".")[0])
+            alive = _pid_alive(pid)
+            try:
+                with open(os.path.join(self.directory, name), "rb") as metrics_file:
+                    buffer = metrics_file.read()
+            except OSError:
+                continue
+            if len(buffer) < HEADER.size:
+                continue
+            used = min(HEADER.unpack_from(buffer, 0)[0], len(buffer))
+            for key, value, _ in read_entries(buffer, used):
+                if key.startswith('["gauge"'):
+                    if alive:
+                        gauges[key] = gauges.get(key, 0.0) + value
+                else:
+                    totals[key] = totals.get(key, 0.0) + value
+        return totals, gauges
+
+    def render(self) -> str:
+        """Metrics in the prometheus text exposition format"""
+        totals, gauges = self._collect_values()
+        totals.update(gauges)
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(totals))
+        for collector in self.collectors:
+            lines.extend(collector(totals))
+        return "\n".join(lines) + "\n"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+REGISTRY = Registry()
+
+
+def configure(directory: str) -> None:
+    REGISTRY.configure(directory)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """Base of the metric types, values are keyed by kind, name and labels"""
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._keys = {}
+        REGISTRY.register(self)
+
+    def _key(self, label_values: tuple, suffix: str = "") -> str:
+        key = self._keys.get((label_values, suffix))
+        if key is None:
+            key = json.dumps([self.kind, self.name + suffix, list(label_values)])
+            self._keys[(label_values, suffix)] = key
+        return key
+
+    def series(self, totals: dict, suffix: str = "") -> dict:
+        """Values of one suffix of this metric, keyed by label values"""
+        prefix = '["%s", "%s", ' % (self.kind, self.name + suffix)
+        series = {}
+        for key, value in totals.items():
+            if key.startswith(prefix):
+                series[tuple(json.loads(key)[2])] = value
+        return series
+
+    def _header(self) -> list:
+        return ["# HELP %s %s" % (self.name, self.documentation),
+                "# TYPE %s %s" % (self.name, self.kind)]
+
+    def render(self, totals: dict) -> list:
+        lines = self._header()
+        for label_values, value in sorted(self.series(totals).items()):
+            lines.append("%s%s %s" % (self.name, _format_labels(self.labels, label_values),
+                                      _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount: float = 1.0) -> None:
+        REGISTRY.add(self._key(label_values), amount)
+
+
+class Gauge(Metric):
+    """Summed across live processes"""
+    kind = "gauge"
+
+    def inc(self, *label_values, amount: float = 1.0) -> None:
+        REGISTRY.add(self._key(label_values), amount)
+
+    def dec(self, *label_values, amount: float = 1.0) -> None:
+        REGISTRY.add(self._key(label_values), -amount)
+
+    def set(self, *label_values, value: float) -> None:
+        REGISTRY.set(self._key(label_values), value)
+
+
+class Histogram(Metric):
+    """Buckets are stored per bucket and made cumulative when rendered"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._histogram_keys = {}
+
+    def _keys_for(self, label_values: tuple) -> tuple:
+        keys = self._histogram_keys.get(label_values)
+        if keys is None:
+            keys = ([self._key(label_values + (index,), "_bucket")
+                     for index in range(len(self.buckets))],
+                    self._key(label_values, "_sum"),
+                    self._key(label_values, "_count"))
+            self._histogram_keys[label_values] = keys
+        return keys
+
+    def observe(self, value: float, *label_values) -> None:
+        buckets, sum_key, count_key = self._keys_for(label_values)
+        index = bisect.bisect_left(self.buckets, value)
+        REGISTRY.add_many(((buckets[index], 1.0), (sum_key, value), (count_key, 1.0)))
+
+    def time(self, *label_values):
+        """Decorator timing every call of the decorated function"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *label_values)
+            return wrapper
+        return decorator
+
+    def render(self, totals: dict) -> list:
+        lines = self._header()
+        buckets = self.series(totals, "_bucket")
+        sums = self.series(totals, "_sum")
+        for label_values, count in sorted(self.series(totals, "_count").items()):
+            cumulative = 0.0
+            for index, bound in enumerate(self.buckets):
+                cumulative += buckets.get(label_values + (index,), 0.0)
+                bound_label = 'le="%s"' % ("+Inf" if bound == float("inf") else repr(bound))
+                lines.append("%s_bucket%s %s" % (
+                    self.name, _format_labels(self.labels, label_values, bound_label),
+                    _format_value(cumulative)))
+            labels = _format_labels(self.labels, label_values)
+            lines.append("%s_sum%s %s" % (self.name, labels,
+                                          _format_value(sums.get(label_values, 0.0))))
+            lines.append("%s_count%s %s" % (self.name, labels, _format_value(count)))
+        return lines
@@ -30,16 +30,34 @@ class KaminaProcess:
 
     # Not providing any defaults here, as an instance needs at least some conf
     # and a logger to speak out to.
-    def __init__(self, conf: dict) -> None:
+    def __init__(self, conf: dict, kamina_conf=None) -> None:
         self.running = True
+        self.reload_requested = False
         self.conf = conf
+        self.kamina_conf = kamina_conf
         self.logger = logging.getLogger("kamina")
 
     def setup_sighandlers(self):
         # Set up some signal handlers
         signal.signal(signal.SIGINT, self._exit_gracefully)
         signal.signal(signal.SIGTERM, self._exit_gracefully)
-        signal.signal(signal.SIGHUP, self._exit_gracefully)
+        signal.signal(signal.SIGHUP, self._request_reload)
+
+    def reload(self) -> None:
+        """
+        Reload configuration and logging in place, called by the main loop
+        once it notices reload_requested
+        """
+        self.reload_requested = False
+        if self.kamina_conf is not None:
+            self.kamina_conf.reload()
+
+    def _request_reload(self, *_):
+        """
+        Handler for SIGHUP, the reload itself is done outside of the handler
+        """
+        self.logger.info("Received hangup signal, reloading configuration...")
+        self.reload_requested = True
 
     def _exit_gracefully(self, *_):
         """
@@ -0,0 +1,224 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+supervisor.py - Event driven supervision of the daemon child processes
+The supervisor sleeps until a child exits or a signal arrives, so an idle
+daemon doesn't wake up at all. Children are watched through a pidfd where the
+platform has them (linux 5.3 and later), through SIGCHLD otherwise.
+"""
+
+import os
+import time
+import signal
+import selectors
+import logging
+import subprocess
+from collections import deque
+
+from kamina.process import KaminaProcess
+
+
+class ChildNotReady(Exception):
+    """Raised when a child doesn't pass its readiness probe in time"""
+
+
+class SupervisedChild:
+    """
+    A child process along with the way to start, probe and stop it
+    :param start: Callable returning a started subprocess.Popen
+    :param probe: Callable returning True once the child is serving
+    :param reload_signal: Signal making the child reload its configuration,
+                          None if it has nothing to reload
+    """
+    def __init__(self, name: str, start, probe, stop_signal: int = signal.SIGTERM,
+                 reload_signal: int = None):
+        self.name = name
+        self.start = start
+        self.probe = probe
+        self.stop_signal = stop_signal
+        self.reload_signal = reload_signal
+        self.process = None
+        self.pidfd = None
+        self.restarts = deque()
+
+
+class Supervisor:
+    """Start children in order, restart them when they die and stop them on exit"""
+    def __init__(self, kamina_process: KaminaProcess, ready_timeout: float,
+                 restart_limit: int, restart_window: float):
+        self.process = kamina_process
+        self.ready_timeout = ready_timeout
+        self.restart_limit = restart_limit
+        self.restart_window = restart_window
+        self.logger = logging.getLogger("kamina")
+        self.children = []
+        self.failed = False
+        self._selector = None
+        self._wakeup_r = None
+        self._wakeup_w = None
+        self._use_pidfd = hasattr(os, "pidfd_open")
+
+    def add(self, child: SupervisedChild) -> None:
+        self.children.append(child)
+
+    def _setup_wakeup(self) -> None:
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        if not self._use_pidfd:
+            self._watch_sigchld()
+        signal.set_wakeup_fd(self._wakeup_w)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+    def _watch_sigchld(self) -> None:
+        # Python only writes to the wakeup fd for signals it has a handler for
+        signal.signal(signal.SIGCHLD, lambda *_: None)
+        self._use_pidfd = False
+
+    def _teardown_wakeup(self) -> None:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for child in self.children:
+            self._unwatch(child)
+        self._selector.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def _watch(self, child: SupervisedChild) -> None:
+        """Wake up when the child exits, its pidfd becomes readable then"""
+        if not self._use_pidfd:
+            return
+        try:
+            child.pidfd = os.pidfd_open(child.process.pid)
+        except OSError as error:
+            # Kernels older than 5.3 lack the system call
+            self.logger.debug("No pidfd for %s (%s), watching SIGCHLD", child.name, error)
+            self._watch_sigchld()
+            return
+        self._selector.register(child.pidfd, selectors.EVENT_READ)
+
+    def _unwatch(self, child: SupervisedChild) -> None:
+        if child.pidfd is None:
+            return
+        if child.pidfd in self._selector.get_map():
+            self._selector.unregister(child.pidfd)
+        os.close(child.pidfd)
+        child.pidfd = None
+
+    def _wait(self, timeout=None) -> None:
+        """Block until a child exits, a signal arrives or timeout seconds have passed"""
+        for key, _ in self._selector.select(timeout):
+            if key.fd != self._wakeup_r:
+                # Stays readable until closed, the exit is noticed by poll() from now on
+                self._selector.unregister(key.fd)
+                continue
+            try:
+                while os.read(self._wakeup_r, 512):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def _launch(self, child: SupervisedChild) -> None:
+        """Start a child and block until its probe passes"""
+        started = time.monotonic()
+        self._unwatch(child)
+        child.process = child.start()
+        self._watch(child)
+        delay = 0.01
+        while self.process.running:
+            if child.probe():
+                self.logger.info("%s ready in %.2fs", child.name, time.monotonic() - started)
+                return
+            if child.process.poll() is not None:
+                raise ChildNotReady("%s exited with code %d while starting"
+                                    % (child.name, child.process.returncode))
+            if time.monotonic() - started > self.ready_timeout:
+                raise ChildNotReady("%s not ready after %ds" % (child.name, self.ready_timeout))
+            self._wait(delay)
+            delay = min(delay * 2, 1.0)
+
+    def _restart(self, child: SupervisedChild) -> None:
+        now = time.monotonic()
+        while child.restarts and now - child.restarts[0] > self.restart_window:
+            child.restarts.popleft()
+        if len(child.restarts) >= self.restart_limit:
+            self.logger.error("%s restarted %d times in %ds, giving up",
+                              child.name, len(child.restarts), self.restart_window)
+            self.failed = True
+            self.process.running = False
+            return
+        child.restarts.append(now)
+        self.logger.warning("%s exited with code %d, restarting it",
+                            child.name, child.process.returncode)
+        self._launch(child)
+
+    def run(self, on_ready=None) -> bool:
+        """
+        Supervise the children until the kamina process stops running
+        :param on_ready: Called once every child passed its probe
+        :return: False if a child couldn't be started or kept alive
+        """
+        self._setup_wakeup()
+        try:
+            started = time.monotonic()
+            for child in self.children:
+                self._launch(child)
+            if self.process.running:
+                self.logger.info("All children ready in %.2fs", time.monotonic() - started)
+                if on_ready is not None:
+                    on_ready()
+
+            # Only sleep after a look finding nothing to do: wakeups consumed
+            # while a child was launched may have been for any child, or a reload
+            while self.process.running:
+                if self.process.reload_requested:
+                    self._reload()
+                exited = [child for child in self.children if child.process.poll() is not None]
+                for child in exited:
+                    if self.process.running:
+                        self._restart(child)
+                if self.process.running and not exited:
+                    self._wait()
+        except ChildNotReady as error:
+            self.logger.error(str(error))
+            self.failed = True
+        finally:
+            self._stop_all()
+            self._teardown_wakeup()
+        return not self.failed
+
+    def _reload(self) -> None:
+        self.process.reload()
+        for child in self.children:
+            if child.reload_signal is not None and child.process.poll() is None:
+                self.logger.debug("Reloading %s...", child.name)
+                child.process.send_signal(child.reload_signal)
+
+    def _stop_all(self) -> None:
+        for child in reversed(self.children):
+            if child.process is None or child.process.poll() is not None:
+                continue
+            self.logger.debug("Stopping %s...", child.name)
+            child.process.send_signal(child.stop_signal)
+            try:
+                child.process.wait(self.ready_timeout)
+            except subprocess.TimeoutExpired:
+                self.logger.warning("%s didn't stop in time, killing it", child.name)
+                child.process.kill()
+                child.process.wait()
@@ -0,0 +1,261 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+aio.py - Storage for code running on an event loop
+Objects are read from and added to ipfs without blocking the loop, over a
+pool of connections of its own, so a slow daemon costs a coroutine per call
+instead of a thread. The database and the object cache are local and quick,
+their calls run on the threads of an executor.
+"""
+
+import json
+import time
+import asyncio
+import functools
+
+from storage.ipfs import IPFSUnavailable, IPFSError, StreamBody, IPFS_SECONDS, IPFS_IN_FLIGHT
+from storage.storage import Storage, STORAGE_SECONDS
+
+
+class AsyncIPFSClient:
+    """
+    Talks to the ipfs http api from an event loop
+    At most pool_size connections are open at once, calls beyond that wait
+    for a free one without holding anything but their coroutine. The session
+    is created by the first call, within the loop it belongs to, aiohttp is
+    imported along with it.
+    """
+    def __init__(self, host: str, port: int, pool_size: int, timeout: float):
+        self.base_url = "http://%s:%d/api/v0/" % (host, port)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            import aiohttp
+            # Waiting for a connection of the pool doesn't count against timeout
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout,
+                                            sock_read=self.timeout)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size), timeout=timeout)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, command: str, params=None, data=None, headers=None) -> bytes:
+        import aiohttp
+        started = time.perf_counter()
+        IPFS_IN_FLIGHT.inc()
+        try:
+            async with self._get_session().post(self.base_url + command, params=params,
+                                                data=data, headers=headers) as response:
+                status = response.status
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise IPFSUnavailable(str(error) or type(error).__name__)
+        finally:
+            IPFS_IN_FLIGHT.dec()
+            IPFS_SECONDS.observe(time.perf_counter() - started, command)
+        if status != 200:
+            message = body.decode("utf8", "replace")
+            try:
+                message = json.loads(message).get("Message", message)
+            except (ValueError, AttributeError):
+                pass
+            raise IPFSError("%s: %s" % (command, message))
+        return body
+
+    async def version(self) -> dict:
+        return json.loads((await self._request("version")).decode("utf8"))
+
+    async def cat(self, cid: str) -> bytes:
+        """
+        Fetch the content of an object
+        :param cid: CID of the object
+        :return: Content of the object
+        """
+        return await self._request("cat", params={"arg": cid})
+
+    async def cat_many(self, cids: list) -> list:
+        """
+        Fetch several objects at once, at most pool_size requests are in flight
+        :param cids: CIDs of the objects
+        :return: Contents, in the same order as cids
+        """
+        return list(await asyncio.gather(*[self.cat(cid) for cid in cids]))
+
+    async def add_many(self, blobs: list) -> list:
+        """
+        Add several objects in a single multipart request
+        :param blobs: Contents of the objects
+        :return: CIDs, in the same order as blobs
+        """
+        import aiohttp
+        if not blobs:
+            return []
+        form = aiohttp.FormData()
+        for index, blob in enumerate(blobs):
+            form.add_field("file", blob, filename=str(index),
+                           content_type="application/octet-stream")
+        body = await self._request("add", params={"pin": "true"}, data=form)
+        cids = [None] * len(blobs)
+        for line in body.decode("utf8").splitlines():
+            if line:
+                added = json.loads(line)
+                cids[int(added["Name"])] = added["Hash"]
+        if None in cids:
+            raise IPFSError("add: the daemon didn't return every CID")
+        return cids
+
+    async def add(self, blob: bytes) -> str:
+        return (await self.add_many([blob]))[0]
+
+    async def add_stream(self, chunks, length: int) -> str:
+        """
+        Add an object received chunk by chunk, never holding more than a chunk of it
+        :param chunks: Async iterable of the bytes of the object
+        :param length: Size of the object
+        :return: CID of the object, otherwise, IOError if the chunks end early
+        """
+        body = StreamBody(None, length)
+
+        async def produce():
+            yield body.head
+            left = length
+            async for chunk in chunks:
+                chunk = chunk[:left]
+                left -= len(chunk)
+                yield chunk
+                if not left:
+                    break
+            if left:
+                body.missing = left
+                raise IOError("Stream ended %d bytes early" % left)
+            yield body.tail
+
+        try:
+            # Sent with a Content-Length rather than chunked, as StreamBody is
+            response = await self._request("add", params={"pin": "true"}, data=produce(), headers={
+                "Content-Type": "multipart/form-data; boundary=%s" % body.boundary,
+                "Content-Length": str(len(body))})
+        except IPFSUnavailable:
+            if body.missing:
+                # The stream is at fault, not the daemon
+                raise IOError("Stream ended %d bytes early" % body.missing)
+            raise
+        for line in response.decode("utf8").splitlines():
+            if line:
+                return json.loads(line)["Hash"]
+        raise IPFSError("add: the daemon didn't return a CID")
+
+
+class AsyncStorage:
+    """
+    The calls of Storage which wait on ipfs, as coroutines
+    Anything else Storage does is local, run() moves it off the loop. The
+    ipfs client can be shared by the shards of several communities.
+    """
+    def __init__(self, storage: Storage, executor, ipfs_conn: AsyncIPFSClient):
+        self.storage = storage
+        self.executor = executor
+        self.ipfs_conn = ipfs_conn
+
+    def run(self, func, *args):
+        """
+        Call a blocking function on the executor
+        :return: Future of what it returns
+        """
+        return asyncio.get_event_loop().run_in_executor(self.executor,
+                                                        functools.partial(func, *args))
+
+    async def get_object(self, cid: str) -> bytes:
+        """
+        Read an object from ipfs, going through the object cache first
+        :param cid: CID of the object
+        :return: Content of the object
+        """
+        if not cid.isalnum():
+            raise ValueError("Invalid CID: %r" % cid)
+        started = time.perf_counter()
+        try:
+            data = await self.run(self.storage.cache.get, cid)
+            if data is None:
+                data = await self.ipfs_conn.cat(cid)
+                await self.run(self.storage.cache.put, cid, data)
+            return data
+        finally:
+            STORAGE_SECONDS.observe(time.perf_counter() - started, "get_object")
+
+    async def get_objects(self, cids: list) -> list:
+        """
+        Read several objects, the ones missing from the cache are fetched concurrently
+        :param cids: CIDs of the objects
+        :return: Contents, in the same order as cids
+        """
+        for cid in cids:
+            if not cid.isalnum():
+                raise ValueError("Invalid CID: %r" % cid)
+        started = time.perf_counter()
+        try:
+            objects = await self.run(lambda: [self.storage.cache.get(cid) for cid in cids])
+            missing = [cid for cid, data in zip(cids, objects) if data is None]
+            if missing:
+                fetched = dict(zip(missing, await self.ipfs_conn.cat_many(missing)))
+                await self.run(lambda: [self.storage.cache.put(cid, data)
+                                        for cid, data in fetched.items()])
+                objects = [fetched[cid] if data is None else data
+                           for cid, data in zip(cids, objects)]
+            return objects
+        finally:
+            STORAGE_SECONDS.observe(time.perf_counter() - started, "get_objects")
+
+    async def add_objects(self, blobs: list) -> list:
+        """
+        Publish several objects to ipfs in a single request
+        :param blobs: Contents of the objects
+        :return: CIDs, in the same order as blobs
+        """
+        started = time.perf_counter()
+        try:
+            cids = await self.ipfs_conn.add_many(blobs)
+            await self.run(lambda: [self.storage.cache.put(cid, blob)
+                                    for cid, blob in zip(cids, blobs)])
+            return cids
+        finally:
+            STORAGE_SECONDS.observe(time.perf_counter() - started, "add_objects")
+
+    async def add_upload(self, chunks, length: int, media_type: str) -> str:
+        """
+        Stream an upload into ipfs and ask for the variants of images
+        :param chunks: Async iterable of the bytes of the upload
+        :param length: Size of the upload
+        :param media_type: Its media type, as told by the client
+        :return: CID of the upload
+        """
+        started = time.perf_counter()
+        try:
+            cid = await self.ipfs_conn.add_stream(chunks, length)
+            # Waits for the group commit, like any write
+            await self.run(self.storage.record_upload, cid, media_type, length)
+            return cid
+        finally:
+            STORAGE_SECONDS.observe(time.perf_counter() - started, "add_upload")
@@ -0,0 +1,429 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+archive.py - A whole community in a single file, to export and import
+A new node can load a community from an archive instead of pulling every
+record from its peers a batch at a time. Archives are written append only,
+in frames, and closed by an index of the frames:
+
+    header | frame ... | index | footer
+
+    header: b"KARC" | version (1 byte) | archive id (16 bytes)
+    frame:  kind (1 byte) | position (8 bytes) | length of the CID (1 byte) |
+            length of the data (4 bytes) | CID | data
+    index:  0xff | entry ..., every entry is the header of a frame, with the
+            offset of the frame in place of its position, then its CID
+    footer: offset of the index (8 bytes) | number of entries (8 bytes) |
+            archive id (16 bytes) | b"KEND"
+
+Post records come first, in sync log order, so a post always follows its
+thread and parent. Then come the uploads: the blobs of an upload and of its
+variants, then a media frame describing them, in (created, CID) order. The
+position of a post frame is its sync log seq, the one of an upload frame
+counts the uploads, so an interrupted export goes on after the last complete
+post, or after the creation time and CID of the last complete upload.
+"""
+
+import os
+import json
+import mmap
+import uuid
+import struct
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+
+from storage.database import get_connection
+from storage.ipfs import IPFSUnavailable, IPFSError
+from storage.media import insert_media, set_variant
+from storage.sync import decode_record, import_post, UPSERT_STATE
+
+MAGIC = b"KARC"
+END_MAGIC = b"KEND"
+ARCHIVE_VERSION = 1
+HEADER = struct.Struct(">4sB16s")
+FRAME = struct.Struct(">BQBI")
+ENTRY = struct.Struct(">BQBI")
+FOOTER = struct.Struct(">QQ16s4s")
+KIND_POST = 1
+KIND_BLOB = 2
+KIND_MEDIA = 3
+KIND_INDEX = 0xff
+FRAME_KINDS = (KIND_POST, KIND_BLOB, KIND_MEDIA)
+# An import transaction also ends once its frames hold that many bytes
+CHUNK_BYTES = 32 * 1024 * 1024
+
+SELECT_UPLOADS = ("SELECT cid, type, size, created FROM media WHERE (created, cid) > (?, ?) "
+                  "ORDER BY created, cid LIMIT ?")
+SELECT_VARIANTS = ("SELECT variant, cid, type FROM media_variants "
+                   "WHERE source_cid = ? AND cid IS NOT NULL ORDER BY variant")
+
+
+class ArchiveError(Exception):
+    """Raised when a file isn't an archive, or not a complete one"""
+
+
+def parse_header(data: bytes) -> bytes:
+    """
+    :return: The archive id, otherwise, ArchiveError
+    """
+    if len(data) < HEADER.size:
+        raise ArchiveError("Not an archive")
+    magic, version, archive_id = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ArchiveError("Not an archive")
+    if version != ARCHIVE_VERSION:
+        raise ArchiveError("Unsupported archive version %d" % version)
+    return archive_id
+
+
+def parse_footer(data: bytes, archive_id: bytes):
+    """
+    :param data: The last FOOTER.size bytes of the archive
+    :return: Tuple of (offset of the index, number of entries), None if the archive isn't closed
+    """
+    if len(data) < FOOTER.size:
+        return None
+    index_offset, count, footer_id, end_magic = FOOTER.unpack_from(data)
+    if end_magic != END_MAGIC or footer_id != archive_id:
+        return None
+    return index_offset, count
+
+
+def scan_frames(archive, end: int):
+    """
+    Walk the frames of an archive, reading their headers and skipping their data
+    Stops at the index, or at a frame cut short by an interrupted export.
+    :param archive: Archive file, opened for reading
+    :param end: Offset the frames must end before
+    :return: Generator of (offset, kind, position, CID, length of the data)
+    """
+    offset = HEADER.size
+    while offset + FRAME.size <= end:
+        archive.seek(offset)
+        kind, position, cid_length, length = FRAME.unpack(archive.read(FRAME.size))
+        if kind not in FRAME_KINDS:
+            return
+        frame_end = offset + FRAME.size + cid_length + length
+        if frame_end > end:
+            return
+        cid = archive.read(cid_length).decode("ascii")
+        yield offset, kind, position, cid, length
+        offset = frame_end
+
+
+def write_frame(archive, kind: int, position: int, cid: str, data: bytes) -> None:
+    cid = cid.encode("ascii")
+    archive.write(FRAME.pack(kind, position, len(cid), len(data)))
+    archive.write(cid)
+    archive.write(data)
+
+
+def import_media(conn, now: float, cid: str, media_type: str, size: int, created: float,
+                 variants: list, requested: tuple) -> None:
+    """
+    Write an upload and the variants archived along with it
+    :param variants: List of (variant, CID, media type) from the archive
+    :param requested: Variants to ask the daemon for, the ones missing from the archive are made
+    """
+    names = tuple(dict.fromkeys(requested + tuple(variant[0] for variant in variants)))
+    insert_media(conn, created, cid, media_type, size, names)
+    for variant, variant_cid, variant_type in variants:
+        set_variant(conn, now, cid, variant, variant_cid, variant_type, None)
+
+
+def save_position(conn, now: float, name: str, position: int) -> None:
+    conn.execute(UPSERT_STATE, (name, json.dumps(position)))
+
+
+class Exporter:
+    """
+    Write the posts and uploads of a storage shard to an archive
+    Records and blobs are read batch_size at a time, from the object cache or
+    from ipfs without going into the cache, and written out at once, so the
+    size of the community never matters to memory.
+    """
+    def __init__(self, storage, settings: dict):
+        self.storage = storage
+        self.batch_size = settings["archive"]["batch_size"]
+        self.logger = logging.getLogger("kamina")
+
+    def export(self, path: str) -> tuple:
+        """
+        Write an archive, or finish one an earlier export left incomplete
+        :param path: File of the archive
+        :return: Tuple of (posts, uploads) written, otherwise, ArchiveError
+        """
+        with open(path, "r+b" if os.path.exists(path) else "w+b") as archive:
+            size = archive.seek(0, os.SEEK_END)
+            if size == 0:
+                archive_id = uuid.uuid4().bytes
+                archive.write(HEADER.pack(MAGIC, ARCHIVE_VERSION, archive_id))
+                size = HEADER.size
+            else:
+                archive.seek(0)
+                archive_id = parse_header(archive.read(HEADER.size))
+                archive.seek(max(size - FOOTER.size, 0))
+                if parse_footer(archive.read(FOOTER.size), archive_id) is not None:
+                    self.logger.info("%s is already complete", path)
+                    return 0, 0
+            last_post = uploads_written = 0
+            last_upload = (0.0, "")
+            uploads_started = False
+            resume = HEADER.size
+            for offset, kind, position, cid, length in scan_frames(archive, size):
+                frame_end = offset + FRAME.size + len(cid) + length
+                if kind == KIND_POST:
+                    last_post, resume = position, frame_end
+                else:
+                    uploads_started = True
+                    if kind == KIND_MEDIA:
+                        archive.seek(frame_end - length)
+                        created = msgpack.unpackb(archive.read(length), raw=False)[2]
+                        last_upload, uploads_written = (created, cid), position
+                        resume = frame_end
+            if resume > HEADER.size:
+                self.logger.info("Resuming the export to %s", path)
+            # Drop what follows the last complete post or upload
+            archive.truncate(resume)
+            archive.seek(resume)
+            posts = 0 if uploads_started else self._write_posts(archive, last_post)
+            uploads = self._write_uploads(archive, last_upload, uploads_written)
+            self._write_index(archive, path, archive_id)
+            archive.flush()
+            os.fsync(archive.fileno())
+        return posts, uploads
+
+    def _fetch(self, cids: list) -> list:
+        """
+        Read objects from the cache or from ipfs
+        :return: Contents, in the same order as cids, None for the ones ipfs doesn't have
+        """
+        objects = [self.storage.cache.get(cid) for cid in cids]
+        missing = [cid for cid, data in zip(cids, objects) if data is None]
+        if not missing:
+            return objects
+        ipfs_conn = self.storage.ipfs_conn
+        try:
+            fetched = dict(zip(missing, ipfs_conn.cat_many(missing)))
+        except (IPFSUnavailable, IPFSError):
+            # Unless the daemon is down, some objects are gone, only those are left out
+            ipfs_conn.version()
+            fetched = {}
+            for cid in missing:
+                try:
+                    fetched[cid] = ipfs_conn.cat(cid)
+                except (IPFSUnavailable, IPFSError) as error:
+                    self.logger.warning("Leaving out %s, unable to read it: %s", cid, error)
+        return [fetched.get(cid) if data is None else data for cid, data in zip(cids, objects)]
+
+    def _write_posts(self, archive, after: int) -> int:
+        written = 0
+        while True:
+            entries, _ = self.storage.sync_log.entries(after, self.batch_size)
+            if not entries:
+                return written
+            for (seq, cid), data in zip(entries, self._fetch([cid for _, cid in entries])):
+                if data is not None:
+                    write_frame(archive, KIND_POST, seq, cid, data)
+                    written += 1
+            after = entries[-1][0]
+
+    def _write_uploads(self, archive, after: tuple, position: int) -> int:
+        """
+        :param after: Tuple of (creation time, CID) of the last upload already written
+        :param position: Number of uploads already written
+        """
+        written = 0
+        conn, lock = get_connection(self.storage.media.path)
+        while True:
+            with lock:
+                uploads = conn.execute(SELECT_UPLOADS, after + (self.batch_size,)).fetchall()
+            if not uploads:
+                return written
+            for cid, media_type, size, created in uploads:
+                with lock:
+                    variants = conn.execute(SELECT_VARIANTS, (cid,)).fetchall()
+                # One upload at a time, they are up to max_upload_size each
+                blobs = self._fetch([cid] + [variant[1] for variant in variants])
+                if blobs[0] is None:
+                    continue
+                position += 1
+                write_frame(archive, KIND_BLOB, position, cid, blobs[0])
+                kept = []
+                for variant, blob in zip(variants, blobs[1:]):
+                    if blob is not None:
+                        write_frame(archive, KIND_BLOB, position, variant[1], blob)
+                        kept.append(list(variant))
+                write_frame(archive, KIND_MEDIA, position, cid,
+                            msgpack.packb([media_type, size, created, kept], use_bin_type=True))
+                written += 1
+            after = (uploads[-1][3], uploads[-1][0])
+
+    @staticmethod
+    def _write_index(archive, path: str, archive_id: bytes) -> None:
+        """Close the archive with the index of its frames, read back from a second handle"""
+        index_offset = archive.tell()
+        archive.write(bytes((KIND_INDEX,)))
+        archive.flush()
+        count = 0
+        with open(path, "rb") as frames:
+            for offset, kind, _, cid, length in scan_frames(frames, index_offset):
+                cid = cid.encode("ascii")
+                archive.write(ENTRY.pack(kind, offset, len(cid), length))
+                archive.write(cid)
+                count += 1
+        archive.write(FOOTER.pack(index_offset, count, archive_id, END_MAGIC))
+
+
+class Importer:
+    """
+    Load an archive into a storage shard
+    The archive is memory mapped and read through its index. workers threads
+    decode the frames and add them to ipfs ahead of the writer, which loads
+    them in archive order, transaction_size frames per transaction. The
+    position reached in the index is saved by the same transaction, so an
+    interrupted import goes on right where it stopped, and importing an
+    archive twice writes nothing the second time.
+    """
+    def __init__(self, storage, settings: dict):
+        self.storage = storage
+        self.transaction_size = settings["archive"]["transaction_size"]
+        self.workers = settings["archive"]["workers"]
+        self.variants = tuple(settings["media"]["variants"])
+        self.logger = logging.getLogger("kamina")
+
+    def import_archive(self, path: str) -> tuple:
+        """
+        :param path: File of the archive
+        :return: Tuple of (posts, uploads) imported, otherwise, ArchiveError
+        """
+        with open(path, "rb") as archive_file:
+            if os.fstat(archive_file.fileno()).st_size < HEADER.size + FOOTER.size:
+                raise ArchiveError("%s is not a complete archive" % path)
+            archive = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return self._load(archive, path)
+        finally:
+            archive.close()
+
+    def _load(self, archive: mmap.mmap, path: str) -> tuple:
+        archive_id = parse_header(archive[:HEADER.size])
+        index_end = len(archive) - FOOTER.size
+        footer = parse_footer(archive[index_end:], archive_id)
+        if footer is None or not HEADER.size <= footer[0] < index_end \
+                or archive[footer[0]] != KIND_INDEX:
+            raise ArchiveError("%s is not a complete archive, export it again to finish it"
+                               % path)
+        index_offset, count = footer
+        state = "import:%s" % archive_id.hex()
+        position = self.storage.sync_log.get_state(state, index_offset + 1)
+        if position >= index_end:
+            self.logger.info("%s is already imported", path)
+            return 0, 0
+        self.logger.debug("Loading %d frames from %s", count, path)
+        posts = uploads = 0
+        chunks = self._chunks(archive, position, index_offset, index_end)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                # Keep every worker busy, but never more chunks in memory than workers
+                while len(pending) < self.workers:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    pending.append((executor.submit(self._prepare, archive, chunk[0]),
+                                    chunk[1]))
+                if not pending:
+                    break
+                future, end = pending.popleft()
+                operations = future.result()
+                operations.append((save_position, (state, end)))
+                results = self.storage.database.run_batch(operations)
+                for (func, args), (result, error) in zip(operations, results):
+                    if error is not None:
+                        self.logger.warning("Ignoring post %s, its thread or parent is unknown",
+                                            args[0])
+                    elif func is import_media:
+                        uploads += 1
+                    elif result is not None:
+                        self.storage.generations.touch_thread(result[0])
+                        posts += 1
+        self.storage.generations.touch_listing()
+        return posts, uploads
+
+    def _chunks(self, archive: mmap.mmap, position: int, frames_end: int, index_end: int):
+        """
+        Split the index into the frames of one transaction each
+        :return: Generator of (list of (kind, offset of the data, length, CID), position
+                 in the index after the chunk)
+        """
+        chunk = []
+        size = 0
+        while position < index_end:
+            if position + ENTRY.size > index_end:
+                raise ArchiveError("Truncated index entry at %d" % position)
+            kind, offset, cid_length, length = ENTRY.unpack_from(archive, position)
+            cid = archive[position + ENTRY.size:position + ENTRY.size + cid_length]
+            position += ENTRY.size + cid_length
+            start = offset + FRAME.size + cid_length
+            if kind not in FRAME_KINDS or offset < HEADER.size or start + length > frames_end:
+                raise ArchiveError("Bad index entry before %d" % position)
+            chunk.append((kind, start, length, cid.decode("ascii")))
+            size += length
+            if len(chunk) >= self.transaction_size or size >= CHUNK_BYTES:
+                yield chunk, position
+                chunk = []
+                size = 0
+        if chunk:
+            yield chunk, position
+
+    def _prepare(self, archive: mmap.mmap, chunk: list) -> list:
+        """
+        Decode the frames of a chunk and add its records and blobs to ipfs, runs in a worker
+        :return: List of (function, args) to write
+        """
+        operations = []
+        objects = []
+        for kind, start, length, cid in chunk:
+            data = archive[start:start + length]
+            try:
+                if kind == KIND_MEDIA:
+                    media_type, size, created, variants = msgpack.unpackb(data, raw=False)
+                    requested = self.variants if media_type.startswith("image/") else ()
+                    operations.append((import_media, (cid, media_type, int(size),
+                                                      float(created),
+                                                      [tuple(v) for v in variants], requested)))
+                    continue
+                if kind == KIND_POST:
+                    operations.append((import_post, (cid, decode_record(data))))
+            except (ValueError, TypeError, AttributeError):
+                self.logger.warning("Ignoring malformed frame %s", cid)
+                continue
+            objects.append((cid, data))
+        rejected = set()
+        if objects:
+            added = self.storage.ipfs_conn.add_many([data for _, data in objects])
+            for (cid, _), added_cid in zip(objects, added):
+                if added_cid != cid:
+                    self.logger.warning("Ignoring %s, its content doesn't match its CID", cid)
+                    rejected.add(cid)
+        return [operation for operation in operations if operation[1][0] not in rejected]
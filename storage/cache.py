@@ -0,0 +1,266 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+cache.py - Two-tier cache of ipfs objects, keyed by their CID
+Objects behind a CID never change, so nothing here is ever invalidated,
+entries only go away when a tier runs out of room.
+"""
+
+import os
+import mmap
+import fcntl
+import struct
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+
+from kamina.metrics import REGISTRY, Counter
+
+CACHE_REQUESTS = Counter("kamina_cache_requests_total", "Cache lookups by cache and result",
+                         ("cache", "result"))
+
+# Bytes held by a disk cache, in a file of its directory every process maps
+SIZE = struct.Struct("=q")
+SIZE_FILE = ".size"
+
+
+def _hit_ratios(totals: dict) -> list:
+    """Hit ratio of every cache, computed from the lookups of every process"""
+    lookups = CACHE_REQUESTS.series(totals)
+    lines = ["# HELP kamina_cache_hit_ratio Share of cache lookups that were hits",
+             "# TYPE kamina_cache_hit_ratio gauge"]
+    for cache in sorted({cache for cache, _ in lookups}):
+        hits = lookups.get((cache, "hit"), 0.0)
+        total = hits + lookups.get((cache, "miss"), 0.0)
+        lines.append('kamina_cache_hit_ratio{cache="%s"} %s'
+                     % (cache, hits / total if total else 0.0))
+    return lines
+
+
+REGISTRY.add_collector(_hit_ratios)
+
+
+class CacheStats:
+    """Hit and miss counters of a cache tier, also exported as metrics under name"""
+    __slots__ = ("name", "hits", "misses")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self) -> None:
+        self.hits += 1
+        CACHE_REQUESTS.inc(self.name, "hit")
+
+    def miss(self) -> None:
+        self.misses += 1
+        CACHE_REQUESTS.inc(self.name, "miss")
+
+    def as_dict(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "ratio": self.hits / total if total else 0.0}
+
+
+class MemoryCache:
+    """LRU of hot objects, bounded by the total size of the objects it holds"""
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.stats = CacheStats("memory")
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cid: str):
+        with self._lock:
+            data = self._entries.get(cid)
+            if data is None:
+                self.stats.miss()
+                return None
+            self._entries.move_to_end(cid)
+            self.stats.hit()
+            return data
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def put(self, cid: str, data: bytes) -> None:
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            if cid in self._entries:
+                self._entries.move_to_end(cid)
+                return
+            self._entries[cid] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class DiskCache:
+    """
+    Object files under a directory shared by every process of the node
+    Files are written atomically, so readers never see a partial object, and
+    the least recently used ones are removed once the directory grows past
+    max_size. The size of the directory is counted in a memory mapped file
+    of its own, so that every process writing to it adds up to the same
+    total, and it is only changed and evicted from under a lock of that file.
+    """
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.stats = CacheStats("disk")
+        self.logger = logging.getLogger("kamina")
+        os.makedirs(directory, exist_ok=True)
+        # Kept open, the lock guarding the size is taken on it
+        self._fd = os.open(os.path.join(directory, SIZE_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            fresh = os.fstat(self._fd).st_size < SIZE.size
+            if fresh:
+                os.ftruncate(self._fd, SIZE.size)
+            self._map = mmap.mmap(self._fd, SIZE.size)
+            if fresh:
+                # The directory may hold objects cached before the size was kept
+                SIZE.pack_into(self._map, 0, self._scan_size())
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        # fcntl locks only keep other processes out, not other threads
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        """Bytes held by the directory, as counted by every process"""
+        return SIZE.unpack_from(self._map)[0]
+
+    def _path(self, cid: str) -> str:
+        return os.path.join(self.directory, cid[-2:], cid)
+
+    def get(self, cid: str):
+        path = self._path(cid)
+        try:
+            with open(path, "rb") as cached:
+                data = cached.read()
+        except OSError:
+            self.stats.miss()
+            return None
+        # The mtime doubles as the last access time for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.stats.hit()
+        return data
+
+    def put(self, cid: str, data: bytes) -> None:
+        path = self._path(cid)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(handle, "wb") as temp:
+                temp.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            self.logger.warning("Unable to write %s to the disk cache", cid)
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            return
+
+        # An object written by two processes at once is counted twice, the
+        # count only ever runs ahead of the directory until the next eviction
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                size = self.size + len(data)
+                if size > self.max_size:
+                    size = self._evict()
+                SIZE.pack_into(self._map, 0, size)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _entries(self) -> list:
+        entries = []
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith(".tmp-"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:  # Removed by another process meanwhile
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self) -> int:
+        """
+        Remove the least recently used objects until only 90% of max_size is used
+        :return: Bytes left in the directory
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_size * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+        return total
+
+
+class ObjectCache:
+    """Memory tier in front of the disk tier"""
+    def __init__(self, directory: str, memory_size: int, disk_size: int):
+        self.memory = MemoryCache(memory_size)
+        self.disk = DiskCache(directory, disk_size)
+
+    def get(self, cid: str):
+        """
+        Look an object up, memory first
+        :param cid: CID of the object
+        :return: The object bytes, None if neither tier has it
+        """
+        data = self.memory.get(cid)
+        if data is None:
+            data = self.disk.get(cid)
+            if data is not None:
+                self.memory.put(cid, data)
+        return data
+
+    def put(self, cid: str, data: bytes) -> None:
+        self.memory.put(cid, data)
+        self.disk.put(cid, data)
+
+    def stats(self) -> dict:
+        return {"memory": self.memory.stats.as_dict(), "disk": self.disk.stats.as_dict()}
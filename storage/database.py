@@ -0,0 +1,518 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+database.py - Local sqlite index of the community threads and posts
+"""
+
+import os
+import math
+import time
+import sqlite3
+import threading
+import logging
+from pathlib import PurePath
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_activity REAL NOT NULL,
+    post_count INTEGER NOT NULL DEFAULT 0,
+    hot REAL
+);
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY,
+    thread_id INTEGER NOT NULL REFERENCES threads (id),
+    parent_id INTEGER REFERENCES posts (id),
+    body TEXT NOT NULL,
+    created REAL NOT NULL,
+    cid TEXT,
+    path TEXT,
+    depth INTEGER NOT NULL DEFAULT 0,
+    reply_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS posts_thread_idx ON posts (thread_id, id);
+CREATE INDEX IF NOT EXISTS posts_parent_idx ON posts (parent_id);
+CREATE INDEX IF NOT EXISTS threads_activity_idx ON threads (last_activity, id);
+CREATE INDEX IF NOT EXISTS posts_cid_idx ON posts (cid);
+
+-- Replication, see sync.py. The log lists every CID the node knows in the
+-- order it learnt them, key is a hash of the CID used to compare ranges.
+CREATE TABLE IF NOT EXISTS sync_log (
+    seq INTEGER PRIMARY KEY,
+    cid TEXT NOT NULL UNIQUE,
+    key INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sync_log_key_idx ON sync_log (key, seq, cid);
+CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+-- Uploaded files, and the images derived from them, see media.py. A variant
+-- without a CID nor an error is waiting for the daemon to make it.
+CREATE TABLE IF NOT EXISTS media (
+    cid TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS media_variants (
+    source_cid TEXT NOT NULL REFERENCES media (cid),
+    variant TEXT NOT NULL,
+    cid TEXT,
+    type TEXT,
+    error TEXT,
+    requested REAL NOT NULL,
+    PRIMARY KEY (source_cid, variant)
+);
+CREATE INDEX IF NOT EXISTS media_created_idx ON media (created, cid);
+CREATE INDEX IF NOT EXISTS media_variants_pending_idx ON media_variants (requested)
+    WHERE cid IS NULL AND error IS NULL;
+
+-- Hot scores, see ranking.py. half_life is the one the scores are computed
+-- with, rescored the id of the last thread rescored since it last changed.
+CREATE TABLE IF NOT EXISTS ranking_state (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+# Reply trees are stored as materialized paths: the path of a post is the
+# path of its parent followed by its own id, PATH_WIDTH hex digits each. Sorting
+# a thread by path walks its tree depth first, a subtree is a range of paths
+# and the index also covers depth, so a few levels of it are one range scan.
+PATH_WIDTH = 12
+PATH_END = "~"  # Sorts after every path character
+TREE_SCHEMA = """
+CREATE INDEX IF NOT EXISTS posts_tree_idx ON posts (thread_id, path, depth);
+"""
+# The hot score of a thread is log2 of the sum, over its posts, of
+# 2 ^ ((created - HOT_EPOCH) / half_life): every post counts for half as
+# much each half_life seconds. All the scores decay at the same pace, so
+# their order only changes when a post is added, which adds its term to the
+# score of its thread. Threads are listed by any of these columns, the
+# scores are only brought to the present, with hot_at, to be shown.
+HOT_EPOCH = 1514764800.0  # 2018-01-01
+DEFAULT_HALF_LIFE = 12 * 3600.0
+SORT_COLUMNS = {"active": "last_activity", "hot": "hot", "new": "created"}
+RANKING_SCHEMA = """
+CREATE INDEX IF NOT EXISTS threads_hot_idx ON threads (hot, id);
+CREATE INDEX IF NOT EXISTS threads_created_idx ON threads (created, id);
+"""
+SCHEMA_VERSION = 2
+
+# Posts written before reply trees were indexed, see _migrate
+TREE_COLUMNS = ("ALTER TABLE posts ADD COLUMN path TEXT",
+                "ALTER TABLE posts ADD COLUMN depth INTEGER NOT NULL DEFAULT 0",
+                "ALTER TABLE posts ADD COLUMN reply_count INTEGER NOT NULL DEFAULT 0")
+BACKFILL_TREE = """
+CREATE TEMP TABLE tree_backfill AS
+WITH RECURSIVE tree (id, path, depth) AS (
+    SELECT id, printf('%012x', id), 0 FROM posts WHERE parent_id IS NULL
+    UNION ALL
+    SELECT posts.id, tree.path || printf('%012x', posts.id), tree.depth + 1
+    FROM posts JOIN tree ON posts.parent_id = tree.id
+)
+SELECT id, path, depth FROM tree;
+CREATE UNIQUE INDEX temp.tree_backfill_idx ON tree_backfill (id);
+UPDATE posts SET
+    path = (SELECT path FROM tree_backfill WHERE tree_backfill.id = posts.id),
+    depth = (SELECT depth FROM tree_backfill WHERE tree_backfill.id = posts.id),
+    reply_count = (SELECT count(*) FROM posts AS replies WHERE replies.parent_id = posts.id);
+DROP TABLE tree_backfill;
+"""
+# Threads written before they were ranked, see _migrate
+HOT_COLUMN = "ALTER TABLE threads ADD COLUMN hot REAL"
+BACKFILL_HOT = ("UPDATE threads SET hot = (SELECT hot_score(created, (SELECT value FROM "
+                "ranking_state WHERE name = 'half_life')) FROM posts "
+                "WHERE thread_id = threads.id)")
+
+# Full text index of the posts, only the opening post of a thread carries
+# its title. Kept up to date by a trigger, so it is written in the very
+# same transaction as the post. Contentless, the text lives in posts.
+# The templates also make the index a rebuild fills, see search.py.
+SEARCH_TABLE = "CREATE VIRTUAL TABLE IF NOT EXISTS %(table)s USING fts5 (title, body, content='')"
+SEARCH_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS %(table)s_insert AFTER INSERT ON posts BEGIN
+    INSERT INTO %(table)s (rowid, title, body) VALUES (
+        new.id,
+        CASE WHEN new.parent_id IS NULL AND NOT EXISTS (
+            SELECT 1 FROM posts WHERE thread_id = new.thread_id AND id < new.id
+        ) THEN (SELECT title FROM threads WHERE id = new.thread_id) ELSE '' END,
+        new.body
+    );
+END
+"""
+SEARCH_SCHEMA = ";".join((
+    SEARCH_TABLE % {"table": "posts_fts"},
+    SEARCH_TRIGGER % {"table": "posts_fts"},
+    "CREATE TABLE IF NOT EXISTS search_state (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+))
+
+# Statements are kept as module constants so sqlite3's statement cache
+# hands back the same prepared statement on every call.
+SELECT_THREADS = {sort: ("SELECT id, title, created, last_activity, post_count, hot "
+                         "FROM threads ORDER BY %s DESC, id DESC LIMIT ?" % column)
+                  for sort, column in SORT_COLUMNS.items()}
+SELECT_THREADS_AFTER = {sort: ("SELECT id, title, created, last_activity, post_count, hot "
+                               "FROM threads WHERE (%s, id) < (?, ?) "
+                               "ORDER BY %s DESC, id DESC LIMIT ?" % (column, column))
+                        for sort, column in SORT_COLUMNS.items()}
+SELECT_THREAD = ("SELECT id, title, created, last_activity, post_count, hot FROM threads "
+                 "WHERE id = ?")
+SELECT_TREE = ("SELECT id, thread_id, parent_id, body, created, cid, depth, reply_count, path "
+               "FROM posts WHERE thread_id = ? AND path >= ? AND path < ? AND depth <= ? "
+               "ORDER BY path LIMIT ?")
+SELECT_TREE_AFTER = ("SELECT id, thread_id, parent_id, body, created, cid, depth, reply_count, "
+                     "path FROM posts WHERE thread_id = ? AND path > ? AND path >= ? "
+                     "AND path < ? AND depth <= ? ORDER BY path LIMIT ?")
+SELECT_NEW_POSTS = ("SELECT id, thread_id, parent_id, body, created, cid FROM posts "
+                    "WHERE thread_id = ? AND id > ? ORDER BY id LIMIT ?")
+SELECT_LAST_POST = "SELECT max(id) FROM posts WHERE thread_id = ?"
+SELECT_TREE_ROOT = "SELECT path, depth FROM posts WHERE id = ? AND thread_id = ?"
+INSERT_THREAD = ("INSERT INTO threads (title, created, last_activity, post_count) "
+                 "VALUES (?, ?, ?, 0)")
+INSERT_POST = ("INSERT INTO posts (thread_id, parent_id, body, created) "
+               "VALUES (?, ?, ?, ?)")
+SELECT_POST_THREAD = "SELECT thread_id, path, depth FROM posts WHERE id = ?"
+SET_POST_PATH = "UPDATE posts SET path = ?, depth = ? WHERE id = ?"
+COUNT_REPLY = "UPDATE posts SET reply_count = reply_count + 1 WHERE id = ?"
+SELECT_HALF_LIFE = "(SELECT value FROM ranking_state WHERE name = 'half_life')"
+SELECT_HOT_HALF_LIFE = "SELECT %s" % SELECT_HALF_LIFE
+TOUCH_THREAD = ("UPDATE threads SET last_activity = ?, post_count = post_count + 1, "
+                "hot = hot_add(hot, ?, %s) WHERE id = ?" % SELECT_HALF_LIFE)
+
+THREAD_FIELDS = ("id", "title", "created", "last_activity", "post_count", "hot")
+POST_FIELDS = ("id", "thread_id", "parent_id", "body", "created", "cid")
+TREE_FIELDS = POST_FIELDS + ("depth", "replies")
+
+# Open connections, keyed by database path. uWSGI forks its workers after
+# loading the app, so every entry remembers the pid that opened it.
+_CONNECTIONS = {}
+_CONNECTIONS_LOCK = threading.Lock()
+
+
+class ThreadNotFound(Exception):
+    """Raised when a response targets a thread that does not exist"""
+
+
+class InvalidParent(Exception):
+    """Raised when a response replies to a post of another thread"""
+
+
+def hot_add(score, created: float, half_life) -> float:
+    """
+    Hot score of a thread once a post is added to it
+    :param score: Score of the thread, None if it has no post yet
+    :param created: Creation time of the post
+    :param half_life: Seconds it takes a post to count for half as much, the
+                      default one if None
+    """
+    term = (created - HOT_EPOCH) / (half_life or DEFAULT_HALF_LIFE)
+    if score is None:
+        return term
+    high, low = max(score, term), min(score, term)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def hot_at(score, now: float, half_life: float):
+    """
+    Hot score as of now: log2 of the sum, over the posts of the thread, of
+    2 ^ (-age / half_life), lower every second without posts
+    :param score: Stored score of the thread, see HOT_EPOCH
+    :return: The score, None for a thread without posts
+    """
+    if score is None:
+        return None
+    return score - (now - HOT_EPOCH) / half_life
+
+
+class HotScore:
+    """Aggregate computing the hot score of a thread from the creation times of its posts"""
+    def __init__(self):
+        self.score = None
+
+    def step(self, created: float, half_life) -> None:
+        self.score = hot_add(self.score, created, half_life)
+
+    def finalize(self):
+        return self.score
+
+
+def _open_connection(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=256,
+                           isolation_level=None)
+    conn.create_function("hot_add", 3, hot_add)
+    conn.create_aggregate("hot_score", 2, HotScore)
+    conn.execute("PRAGMA journal_mode = WAL")
+    # Every commit is synced to the log before a write is acknowledged, the
+    # group commits of the writer make that one fsync per group
+    conn.execute("PRAGMA synchronous = FULL")
+    conn.execute("PRAGMA busy_timeout = 5000")
+    conn.executescript(SCHEMA)
+    _migrate(conn)
+    conn.executescript(TREE_SCHEMA)
+    conn.executescript(RANKING_SCHEMA)
+    try:
+        conn.executescript(SEARCH_SCHEMA)
+    except sqlite3.OperationalError:
+        logging.getLogger("kamina").warning("sqlite was built without fts5, search is disabled")
+    return conn
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    """Bring a database written by an older version up to SCHEMA_VERSION"""
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Another process may have migrated it while we waited for the lock
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(posts)")}
+            if "path" not in columns:
+                for statement in TREE_COLUMNS:
+                    conn.execute(statement)
+            conn.execute("DROP TABLE IF EXISTS temp.tree_backfill")
+            for statement in BACKFILL_TREE.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+        if version < 2:
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(threads)")}
+            if "hot" not in columns:
+                conn.execute(HOT_COLUMN)
+            conn.execute(BACKFILL_HOT)
+        conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def path_segment(post_id: int) -> str:
+    """Part of the materialized path a post adds to the path of its parent"""
+    return "%0*x" % (PATH_WIDTH, post_id)
+
+
+def shard_dir(settings: dict, community: str = None) -> str:
+    """
+    Directory of the data of a community, see shards.py
+    :param community: Id of the community, None for the own community of the node
+    """
+    if community is None:
+        return settings["general"]["node_dir"]
+    return str(PurePath(settings["general"]["node_dir"], "communities", community))
+
+
+def database_path(settings: dict, community: str = None) -> str:
+    """Location of the database of a community node, or of one of its other communities"""
+    return str(PurePath(shard_dir(settings, community), "kamina.db"))
+
+
+def get_connection(path: str) -> tuple:
+    """
+    Return the connection of the current process for the given database
+    :param path: Location of the sqlite database
+    :return: Tuple of (connection, lock serializing its use)
+    """
+    pid = os.getpid()
+    with _CONNECTIONS_LOCK:
+        entry = _CONNECTIONS.get(path)
+        if entry is None or entry[0] != pid:
+            entry = (pid, _open_connection(path), threading.RLock())
+            _CONNECTIONS[path] = entry
+        return entry[1], entry[2]
+
+
+class Database:
+    """
+    Indexed thread/post store shared by every Storage of a worker process
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.logger = logging.getLogger("kamina")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def hot_half_life(self) -> float:
+        """Half life the stored hot scores are computed with, see ranking.py"""
+        conn, lock = get_connection(self.path)
+        with lock:
+            half_life = conn.execute(SELECT_HOT_HALF_LIFE).fetchone()[0]
+        return half_life or DEFAULT_HALF_LIFE
+
+    def list_threads(self, limit: int, after: tuple = None, sort: str = "active") -> list:
+        """
+        List threads, one page at a time, each one a walk down an index
+        :param limit: Maximum number of threads to return
+        :param after: (sort key, id) of the last thread of the previous page
+        :param sort: "active" (last activity first), "hot" (hot score first)
+                     or "new" (creation time first)
+        :return: List of thread dicts
+        """
+        conn, lock = get_connection(self.path)
+        with lock:
+            if after is None:
+                rows = conn.execute(SELECT_THREADS[sort], (limit,)).fetchall()
+            else:
+                rows = conn.execute(SELECT_THREADS_AFTER[sort],
+                                    (after[0], after[1], limit)).fetchall()
+        return [dict(zip(THREAD_FIELDS, row)) for row in rows]
+
+    def get_thread(self, thread_id: int, limit: int, depth: int, root: int = None,
+                   after: str = None):
+        """
+        Load a thread with a window of its reply tree, depth first
+        Posts come with their depth and number of direct replies, the replies
+        of a post at the deepest level loaded are left out and it is flagged
+        with "more".
+        :param thread_id: Id of the thread
+        :param limit: Maximum number of posts to return
+        :param depth: Number of levels to load below the root
+        :param root: Id of the post whose subtree is loaded, the whole thread if None
+        :param after: Path of the last post of the previous page
+        :return: Thread dict with a "posts" list and the "next" path to continue
+                 from (None once the window is exhausted), None if the thread
+                 or the root post don't exist
+        """
+        conn, lock = get_connection(self.path)
+        with lock:
+            row = conn.execute(SELECT_THREAD, (thread_id,)).fetchone()
+            if row is None:
+                return None
+            if root is None:
+                low, high, max_depth = "", PATH_END, depth
+            else:
+                root_row = conn.execute(SELECT_TREE_ROOT, (root, thread_id)).fetchone()
+                if root_row is None:
+                    return None
+                low, high, max_depth = root_row[0], root_row[0] + PATH_END, root_row[1] + depth
+            # One more post than asked for tells whether there is a next page
+            if after is None:
+                posts = conn.execute(SELECT_TREE, (thread_id, low, high, max_depth,
+                                                   limit + 1)).fetchall()
+            else:
+                # Bounded on both sides, the cursor comes from the client
+                posts = conn.execute(SELECT_TREE_AFTER, (thread_id, after, low, high, max_depth,
+                                                         limit + 1)).fetchall()
+        thread = dict(zip(THREAD_FIELDS, row))
+        thread["next"] = posts[limit - 1][-1] if len(posts) > limit else None
+        thread["posts"] = []
+        for post in posts[:limit]:
+            post = dict(zip(TREE_FIELDS, post[:-1]))
+            # Replies left out, the client loads them with this post as root
+            post["more"] = post["depth"] == max_depth and post["replies"] > 0
+            thread["posts"].append(post)
+        return thread
+
+    def get_new_posts(self, thread_id: int, after: int, limit: int) -> list:
+        """
+        List the posts of a thread newer than a given one, oldest first
+        :param after: Id of the last post already seen
+        :param limit: Maximum number of posts to return
+        :return: List of post dicts
+        """
+        conn, lock = get_connection(self.path)
+        with lock:
+            rows = conn.execute(SELECT_NEW_POSTS, (thread_id, after, limit)).fetchall()
+        return [dict(zip(POST_FIELDS, row)) for row in rows]
+
+    def get_last_post_id(self, thread_id: int):
+        """
+        :return: Id of the newest post of a thread, None if there is no such thread
+        """
+        conn, lock = get_connection(self.path)
+        with lock:
+            return conn.execute(SELECT_LAST_POST, (thread_id,)).fetchone()[0]
+
+    def create_thread(self, title: str, body: str) -> tuple:
+        """
+        Create a thread along with its opening post
+        :return: Tuple of (thread id, post id)
+        """
+        return self._run_single(insert_thread, (title, body))
+
+    def add_response(self, thread_id: int, parent_id, body: str) -> int:
+        """
+        Append a response to an existing thread
+        :return: Id of the new post
+        """
+        return self._run_single(insert_response, (thread_id, parent_id, body))
+
+    def _run_single(self, func, args: tuple):
+        result, error = self.run_batch([(func, args)])[0]
+        if error is not None:
+            raise error
+        return result
+
+    def run_batch(self, operations: list) -> list:
+        """
+        Run several writes inside a single transaction
+        Every operation gets its own savepoint, so a rejected write doesn't
+        take the rest of the batch down with it.
+        :param operations: List of (function, args), called as function(conn, now, *args)
+        :return: List of (result, exception) in the same order as operations
+        """
+        results = []
+        conn, lock = get_connection(self.path)
+        with lock:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for func, args in operations:
+                    conn.execute("SAVEPOINT write")
+                    try:
+                        results.append((func(conn, now, *args), None))
+                    except (ThreadNotFound, InvalidParent) as error:
+                        conn.execute("ROLLBACK TO write")
+                        results.append((None, error))
+                    conn.execute("RELEASE write")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        return results
+
+
+def insert_thread(conn: sqlite3.Connection, now: float, title: str, body: str) -> tuple:
+    """Write a new thread and its opening post, returns (thread id, post id)"""
+    thread_id = conn.execute(INSERT_THREAD, (title, now, now)).lastrowid
+    post_id = conn.execute(INSERT_POST, (thread_id, None, body, now)).lastrowid
+    conn.execute(SET_POST_PATH, (path_segment(post_id), 0, post_id))
+    conn.execute(TOUCH_THREAD, (now, now, thread_id))
+    return thread_id, post_id
+
+
+def insert_response(conn: sqlite3.Connection, now: float, thread_id: int,
+                    parent_id, body: str) -> int:
+    """Write a response to a thread, returns the new post id"""
+    # Responses without a parent are top level replies, roots of their own tree
+    parent_path, depth = "", 0
+    if parent_id is not None:
+        parent = conn.execute(SELECT_POST_THREAD, (parent_id,)).fetchone()
+        if parent is None or parent[0] != thread_id:
+            raise InvalidParent(parent_id)
+        parent_path, depth = parent[1], parent[2] + 1
+    if conn.execute(TOUCH_THREAD, (now, now, thread_id)).rowcount == 0:
+        raise ThreadNotFound(thread_id)
+    post_id = conn.execute(INSERT_POST, (thread_id, parent_id, body, now)).lastrowid
+    conn.execute(SET_POST_PATH, (parent_path + path_segment(post_id), depth, post_id))
+    if parent_id is not None:
+        conn.execute(COUNT_REPLY, (parent_id,))
+    return post_id
@@ -0,0 +1,184 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+events.py - Notify every process of the node about new posts
+Processes with subscribers bind a unix datagram socket under the events
+directory, publishing sends a tiny datagram to each of them. Notifications
+only say "look again", the posts themselves are read back from the
+database, so a lost datagram merely delays an update until the next one.
+Subscribers wait in a thread of their own, or on an event loop.
+"""
+
+import os
+import socket
+import asyncio
+import struct
+import threading
+import logging
+
+NOTIFICATION = struct.Struct("=qq")
+
+
+class Subscription:
+    """Waits for new posts in a thread"""
+    __slots__ = ("thread_id", "wakeup")
+
+    def __init__(self, thread_id: int):
+        self.thread_id = thread_id
+        self.wakeup = threading.Event()
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Block until a post arrives in the thread or timeout seconds passed
+        :return: True if a post arrived
+        """
+        notified = self.wakeup.wait(timeout)
+        self.wakeup.clear()
+        return notified
+
+    def notify(self) -> None:
+        """Called from the receiving thread of the bus"""
+        self.wakeup.set()
+
+
+class AsyncSubscription(Subscription):
+    """Waits for new posts in a thread on an event loop, without holding a thread"""
+    __slots__ = ("loop",)
+
+    def __init__(self, thread_id: int, loop):
+        super().__init__(thread_id)
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        Return once a post arrives in the thread or timeout seconds passed
+        :return: True if a post arrived
+        """
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.wakeup.clear()
+
+    def notify(self) -> None:
+        # asyncio.Event isn't thread safe, it is set from the loop
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+
+class EventBus:
+    """
+    Publish and subscribe to new posts across processes
+    Sockets and the receiving thread are created lazily in every process,
+    neither survives the fork of uWSGI workers.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.logger = logging.getLogger("kamina")
+        self._pid = None
+        self._sender = None
+        self._receiver = None
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _ensure_sender(self) -> socket.socket:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self._sender.setblocking(False)
+                self._receiver = None
+                self._subscriptions = {}
+            return self._sender
+
+    def _ensure_receiver(self) -> None:
+        """Bind the socket of this process, called with the lock held"""
+        if self._receiver is not None:
+            return
+        path = os.path.join(self.directory, "%d.sock" % os.getpid())
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(path)
+        self._receiver = receiver
+        threading.Thread(target=self._receive, args=(receiver,), name="kamina-events",
+                         daemon=True).start()
+
+    def _receive(self, receiver: socket.socket) -> None:
+        while True:
+            data = receiver.recv(NOTIFICATION.size)
+            thread_id = NOTIFICATION.unpack(data)[0]
+            with self._lock:
+                subscriptions = list(self._subscriptions.get(thread_id, ()))
+            for subscription in subscriptions:
+                subscription.notify()
+
+    def subscribe(self, thread_id: int, loop=None) -> Subscription:
+        """
+        Start listening to a thread, release the subscription with unsubscribe
+        :param thread_id: Id of the thread
+        :param loop: Event loop to wait on, the subscription is waited on in
+                     a thread if None
+        """
+        self._ensure_sender()
+        if loop is None:
+            subscription = Subscription(thread_id)
+        else:
+            subscription = AsyncSubscription(thread_id, loop)
+        with self._lock:
+            self._ensure_receiver()
+            self._subscriptions.setdefault(thread_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.thread_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.thread_id]
+
+    def publish(self, thread_id: int, post_id: int) -> None:
+        """
+        Tell every subscribed process that a post was committed to a thread
+        :param thread_id: Id of the thread
+        :param post_id: Id of the new post
+        """
+        sender = self._ensure_sender()
+        data = NOTIFICATION.pack(thread_id, post_id)
+        for name in os.listdir(self.directory):
+            if not name.endswith(".sock"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Nobody is bound anymore, its process is gone
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except BlockingIOError:
+                # Its buffer is full, it will catch up with the next post
+                self.logger.debug("Dropped a notification to %s", name)
@@ -0,0 +1,76 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+generations.py - Change counters shared by every process of the node
+Every thread maps to a slot holding a random value that is replaced after
+each committed write to the thread. Readers remember the value they saw
+before reading, if it is still the same the data they read is still fresh.
+"""
+
+import os
+import mmap
+import struct
+
+SLOT = struct.Struct("=Q")
+LISTING_SLOT = 0
+
+
+class GenerationTable:
+    """Fixed size table of generations in a memory mapped file"""
+    def __init__(self, path: str, slots: int):
+        self.slots = slots
+        size = slots * SLOT.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size < size
+            if fresh:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        if fresh:
+            # Generations are etags too, a table made again must not start
+            # from the values an older one started from
+            self._map[:] = os.urandom(size)
+
+    def thread_slot(self, thread_id: int) -> int:
+        return 1 + thread_id % (self.slots - 1)
+
+    def get(self, slot: int) -> int:
+        return SLOT.unpack_from(self._map, slot * SLOT.size)[0]
+
+    def bump(self, slot: int) -> None:
+        # A random value instead of an increment, so concurrent bumps from
+        # several processes can't cancel each other out
+        SLOT.pack_into(self._map, slot * SLOT.size, struct.unpack("=Q", os.urandom(8))[0])
+
+    def listing(self) -> int:
+        """Generation of the thread listing, changes with any write"""
+        return self.get(LISTING_SLOT)
+
+    def thread(self, thread_id: int) -> int:
+        return self.get(self.thread_slot(thread_id))
+
+    def touch_listing(self) -> None:
+        """Mark the listing as changed, when threads moved without any post"""
+        self.bump(LISTING_SLOT)
+
+    def touch_thread(self, thread_id: int) -> None:
+        """Mark a thread, and thus the listing, as changed"""
+        self.bump(self.thread_slot(thread_id))
+        self.bump(LISTING_SLOT)
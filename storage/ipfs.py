@@ -0,0 +1,191 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+ipfs.py - Pooled keep-alive client for the ipfs daemon http api
+"""
+
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from kamina.metrics import Gauge, Histogram
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+IPFS_SECONDS = Histogram("kamina_ipfs_seconds", "Latency of ipfs http api calls", ("command",))
+IPFS_IN_FLIGHT = Gauge("kamina_ipfs_in_flight", "Ipfs http api calls waiting for an answer")
+
+
+class IPFSUnavailable(Exception):
+    """Raised when the ipfs daemon can't be reached"""
+
+
+class IPFSError(Exception):
+    """Raised when the ipfs daemon answers with an error"""
+
+
+class StreamBody:
+    """
+    Multipart body holding a single file read from a stream, chunk by chunk
+    Its length is known up front, so requests sends it with a Content-Length
+    instead of chunked encoding.
+    """
+    def __init__(self, stream, length: int, name: str = "upload"):
+        self.boundary = uuid.uuid4().hex
+        self.stream = stream
+        self.length = length
+        # Bytes the stream was short of, if it ended early
+        self.missing = 0
+        self.head = ("--%s\r\nContent-Disposition: form-data; name=\"file\"; filename=\"%s\"\r\n"
+                     "Content-Type: application/octet-stream\r\n\r\n"
+                     % (self.boundary, name)).encode("utf8")
+        self.tail = ("\r\n--%s--\r\n" % self.boundary).encode("utf8")
+
+    def __len__(self) -> int:
+        return len(self.head) + self.length + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        left = self.length
+        while left:
+            chunk = self.stream.read(min(STREAM_CHUNK_SIZE, left))
+            if not chunk:
+                self.missing = left
+                raise IOError("Stream ended %d bytes early" % left)
+            left -= len(chunk)
+            yield chunk
+        yield self.tail
+
+
+class IPFSClient:
+    """
+    Talks to the ipfs http api over a pool of persistent connections
+    The pool is created lazily in every process, sockets must not be shared
+    with the workers uWSGI forks. requests is imported along with the first
+    pool, so importing this module stays cheap for code that never calls it.
+    """
+    def __init__(self, host: str, port: int, pool_size: int, timeout: float):
+        self.base_url = "http://%s:%d/api/v0/" % (host, port)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pid = None
+        self._session = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> tuple:
+        """Session and executor of the current process"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount("http://", adapter)
+                    self._session = session
+                    self._executor = ThreadPoolExecutor(max_workers=self.pool_size)
+                    self._pid = os.getpid()
+        return self._session, self._executor
+
+    def _request(self, command: str, params=None, files=None, data=None, headers=None):
+        import requests
+        started = time.perf_counter()
+        IPFS_IN_FLIGHT.inc()
+        try:
+            response = self._pool()[0].post(self.base_url + command, params=params,
+                                            files=files, data=data, headers=headers,
+                                            timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            raise IPFSUnavailable(str(error))
+        finally:
+            IPFS_IN_FLIGHT.dec()
+            IPFS_SECONDS.observe(time.perf_counter() - started, command)
+        if response.status_code != 200:
+            try:
+                message = response.json().get("Message", response.text)
+            except ValueError:
+                message = response.text
+            raise IPFSError("%s: %s" % (command, message))
+        return response
+
+    def version(self) -> dict:
+        return self._request("version").json()
+
+    def cat(self, cid: str) -> bytes:
+        """
+        Fetch the content of an object
+        :param cid: CID of the object
+        :return: Content of the object
+        """
+        return self._request("cat", params={"arg": cid}).content
+
+    def cat_many(self, cids: list) -> list:
+        """
+        Fetch several objects at once, at most pool_size requests are in flight
+        :param cids: CIDs of the objects
+        :return: Contents, in the same order as cids
+        """
+        return list(self._pool()[1].map(self.cat, cids))
+
+    def add_many(self, blobs: list) -> list:
+        """
+        Add several objects in a single multipart request
+        :param blobs: Contents of the objects
+        :return: CIDs, in the same order as blobs
+        """
+        if not blobs:
+            return []
+        files = [("file", (str(index), blob, "application/octet-stream"))
+                 for index, blob in enumerate(blobs)]
+        response = self._request("add", params={"pin": "true"}, files=files)
+        cids = [None] * len(blobs)
+        for line in response.text.splitlines():
+            if line:
+                added = json.loads(line)
+                cids[int(added["Name"])] = added["Hash"]
+        if None in cids:
+            raise IPFSError("add: the daemon didn't return every CID")
+        return cids
+
+    def add(self, blob: bytes) -> str:
+        return self.add_many([blob])[0]
+
+    def add_stream(self, stream, length: int) -> str:
+        """
+        Add an object read from a stream, never holding more than a chunk of it
+        :param stream: File like object to read from
+        :param length: Number of bytes to read from it
+        :return: CID of the object, otherwise, IOError if the stream ends early
+        """
+        body = StreamBody(stream, length)
+        try:
+            response = self._request("add", params={"pin": "true"}, data=body, headers={
+                "Content-Type": "multipart/form-data; boundary=%s" % body.boundary})
+        except IPFSUnavailable:
+            if body.missing:
+                # The stream is at fault, not the daemon
+                raise IOError("Stream ended %d bytes early" % body.missing)
+            raise
+        for line in response.text.splitlines():
+            if line:
+                return json.loads(line)["Hash"]
+        raise IPFSError("add: the daemon didn't return a CID")
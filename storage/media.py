@@ -0,0 +1,239 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+media.py - Uploaded images and the smaller versions derived from them
+Uploads are streamed into ipfs as they arrive. The variants of an image
+listed in the configuration are made by the daemon, in a bounded pool of
+processes, so resizing never takes a request thread. Variants are keyed by
+the CID of their source: an image uploaded twice is only resized once.
+"""
+
+import io
+import logging
+import warnings
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from storage.database import get_connection
+from storage.ipfs import IPFSClient, IPFSUnavailable, IPFSError
+
+INSERT_MEDIA = "INSERT OR IGNORE INTO media (cid, type, size, created) VALUES (?, ?, ?, ?)"
+REQUEST_VARIANT = ("INSERT OR IGNORE INTO media_variants (source_cid, variant, requested) "
+                   "VALUES (?, ?, ?)")
+SET_VARIANT = ("UPDATE media_variants SET cid = ?, type = ?, error = ? "
+               "WHERE source_cid = ? AND variant = ?")
+SELECT_MEDIA = "SELECT type, size FROM media WHERE cid = ?"
+SELECT_VARIANT = "SELECT cid, type, error FROM media_variants WHERE source_cid = ? AND variant = ?"
+SELECT_PENDING = ("SELECT source_cid, variant FROM media_variants "
+                  "WHERE cid IS NULL AND error IS NULL ORDER BY requested LIMIT ?")
+
+# Client of the current pool process, see derive_variant
+_CLIENT = None
+
+
+def insert_media(conn, now: float, cid: str, media_type: str, size: int,
+                 variants: tuple) -> None:
+    """Record an upload and ask for its variants, unless it was already uploaded"""
+    conn.execute(INSERT_MEDIA, (cid, media_type, size, now))
+    for variant in variants:
+        conn.execute(REQUEST_VARIANT, (cid, variant, now))
+
+
+def set_variant(conn, now: float, source_cid: str, variant: str, cid, media_type,
+                error) -> None:
+    conn.execute(SET_VARIANT, (cid, media_type, error, source_cid, variant))
+
+
+def derive_variant(ipfs: tuple, source_cid: str, width: int, height: int, crop: bool,
+                   max_pixels: int) -> tuple:
+    """
+    Make a smaller version of an image, runs in a pool process
+    The image goes from ipfs to ipfs without passing through the daemon.
+    :param ipfs: Tuple of (host, port, timeout) of the ipfs daemon
+    :param crop: Fill width x height and crop what is left over, instead of fitting inside it
+    :param max_pixels: Bigger images are refused before being decoded, otherwise, ValueError
+    :return: Tuple of (CID, media type) of the variant
+    """
+    global _CLIENT  # pylint: disable=global-statement
+    from PIL import Image, ImageOps
+
+    if _CLIENT is None:
+        host, port, timeout = ipfs
+        _CLIENT = IPFSClient(host, port, 1, timeout)
+    # Past twice this, opening an image raises DecompressionBombError, below that
+    # it only warns and the image is refused right after
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+        image = Image.open(io.BytesIO(_CLIENT.cat(source_cid)))
+    if image.width * image.height > max_pixels:
+        raise ValueError("The image is over %d pixels" % max_pixels)
+    # Jpegs are decoded at the smallest scale still bigger than the variant
+    image.draft("RGB", (width, height))
+    if crop:
+        image = ImageOps.fit(image.convert("RGBA" if _has_alpha(image) else "RGB"),
+                             (width, height), Image.LANCZOS)
+    else:
+        image = image.convert("RGBA" if _has_alpha(image) else "RGB")
+        image.thumbnail((width, height), Image.LANCZOS)
+    output = io.BytesIO()
+    if image.mode == "RGBA":
+        image.save(output, "PNG", optimize=True)
+        media_type = "image/png"
+    else:
+        image.save(output, "JPEG", quality=85, optimize=True, progressive=True)
+        media_type = "image/jpeg"
+    return _CLIENT.add(output.getvalue()), media_type
+
+
+def _has_alpha(image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+
+
+class MediaStore:
+    """Queries of uploads and their variants"""
+    def __init__(self, path: str):
+        self.path = path
+
+    def get(self, cid: str):
+        """
+        :return: Tuple of (media type, size) of an upload, None if there is no such upload
+        """
+        conn, lock = get_connection(self.path)
+        with lock:
+            return conn.execute(SELECT_MEDIA, (cid,)).fetchone()
+
+    def variant(self, source_cid: str, variant: str):
+        """
+        :return: Tuple of (CID, media type, error) of a variant, CID and error are
+                 None while it is being made, None if it was never asked for
+        """
+        conn, lock = get_connection(self.path)
+        with lock:
+            return conn.execute(SELECT_VARIANT, (source_cid, variant)).fetchone()
+
+    def pending(self, limit: int) -> list:
+        """Tuples of (source CID, variant) waiting to be made, oldest first"""
+        conn, lock = get_connection(self.path)
+        with lock:
+            return conn.execute(SELECT_PENDING, (limit,)).fetchall()
+
+
+class MediaWorker:
+    """
+    Make the variants waiting in the database, workers of them at a time
+    A variant failing because of ipfs is tried again after a while, one
+    failing because of its source (not an image, too big...) is given up on.
+    The pool processes come from a forkserver: the daemon forking itself
+    could hand them a lock some other of its threads held at that moment.
+    """
+    def __init__(self, storage, settings: dict):
+        media = settings["media"]
+        ipfs = settings["ipfs"]
+        self.storage = storage
+        self.media = storage.media
+        self.workers = media["workers"]
+        self.poll_interval = media["poll_interval"]
+        self.retry_interval = media["retry_interval"]
+        self.variants = media["variants"]
+        self.max_pixels = media["max_pixels"] * 1000 * 1000
+        self.ipfs = (ipfs["host"], ipfs["port"], ipfs["timeout"])
+        self.logger = logging.getLogger("kamina")
+        self._executor = self._new_pool()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="kamina-media", daemon=True)
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(self.workers,
+                                   mp_context=multiprocessing.get_context("forkserver"))
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _submit(self, running: dict) -> None:
+        """Fill the pool up, queueing a few jobs beyond its workers to keep them busy"""
+        free = self.workers * 2 - len(running)
+        if free <= 0:
+            return
+        busy = set(running.values())
+        for source_cid, variant in self.media.pending(free + len(busy)):
+            if (source_cid, variant) in busy:
+                continue
+            spec = self.variants.get(variant)
+            if spec is None:
+                self.storage.database.run_batch([(set_variant, (
+                    source_cid, variant, None, None, "Unknown variant"))])
+                continue
+            future = self._executor.submit(derive_variant, self.ipfs, source_cid, spec["width"],
+                                           spec["height"], spec["crop"], self.max_pixels)
+            running[future] = (source_cid, variant)
+            free -= 1
+            if not free:
+                return
+
+    def _run(self) -> None:
+        running = {}
+        while not self._stop.is_set():
+            try:
+                self._submit(running)
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception("Unable to read the pending variants")
+            if not running:
+                self._stop.wait(self.poll_interval)
+                continue
+            done, _ = wait(list(running), timeout=self.poll_interval,
+                           return_when=FIRST_COMPLETED)
+            writes, retry, broken = [], False, False
+            for future in done:
+                source_cid, variant = running.pop(future)
+                try:
+                    cid, media_type = future.result()
+                    writes.append((set_variant, (source_cid, variant, cid, media_type, None)))
+                except (IPFSUnavailable, IPFSError) as error:
+                    self.logger.warning("Unable to make the %s of %s, retrying: %s",
+                                        variant, source_cid, error)
+                    retry = True
+                except BrokenProcessPool:
+                    # A pool process died, likely on one of these images. Every job of
+                    # the pool fails along, they are given up on and the pool restarted
+                    broken = True
+                    writes.append((set_variant, (source_cid, variant, None, None,
+                                                 "The resizing process died")))
+                except Exception as error:  # pylint: disable=broad-except
+                    self.logger.warning("Unable to make the %s of %s: %s",
+                                        variant, source_cid, error)
+                    writes.append((set_variant, (source_cid, variant, None, None,
+                                                 str(error) or type(error).__name__)))
+            if broken:
+                for source_cid, variant in running.values():
+                    writes.append((set_variant, (source_cid, variant, None, None,
+                                                 "The resizing process died")))
+                running.clear()
+                self._executor.shutdown(wait=False)
+                self._executor = self._new_pool()
+            if writes:
+                self.storage.database.run_batch(writes)
+            if retry:
+                self._stop.wait(self.retry_interval)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,168 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+outbox.py - Publishing of local posts to ipfs in the background
+A post is acknowledged once its group commit is synced to the sqlite
+write-ahead log, which makes that log the journal of the outbox: a local
+post without a CID is a post waiting to be published. The drainer publishes
+them in batches, and backs off while the ipfs daemon is down or too slow,
+without ever holding up a write.
+"""
+
+import time
+import logging
+import threading
+
+from storage.database import get_connection
+from storage.ipfs import IPFSUnavailable, IPFSError
+from storage.sync import set_post_cid
+from storage import records
+from storage.records import PostRecord, ThreadRecord
+from kamina.metrics import Counter, Gauge
+
+OUTBOX_DEPTH = Gauge("kamina_outbox_depth", "Local posts waiting to be published to ipfs")
+OUTBOX_AGE = Gauge("kamina_outbox_oldest_seconds", "Age of the oldest post waiting to be published")
+OUTBOX_PUBLISHED = Counter("kamina_outbox_published_total", "Posts published to ipfs")
+OUTBOX_FAILURES = Counter("kamina_outbox_failures_total", "Failed attempts to publish a batch",
+                          ("reason",))
+
+SELECT_PENDING = (
+    "SELECT p.id, p.thread_id, p.parent_id, p.body, p.created, t.title, "
+    "(SELECT MIN(id) FROM posts WHERE thread_id = p.thread_id) "
+    "FROM posts p JOIN threads t ON t.id = p.thread_id "
+    "WHERE p.cid IS NULL ORDER BY p.id LIMIT ?"
+)
+SELECT_DEPTH = "SELECT count(*), MIN(created) FROM posts WHERE cid IS NULL"
+
+
+class Outbox:
+    """Queries of the posts waiting to be published"""
+    def __init__(self, path: str):
+        self.path = path
+
+    def pending(self, limit: int) -> list:
+        """
+        Local posts without a CID yet, oldest first
+        :return: List of (post id, thread id, parent id, body, created, thread
+                 title, id of the opening post of the thread)
+        """
+        conn, lock = get_connection(self.path)
+        with lock:
+            return conn.execute(SELECT_PENDING, (limit,)).fetchall()
+
+    def depth(self) -> tuple:
+        """
+        :return: Tuple of (number of posts waiting, creation time of the oldest, None if empty)
+        """
+        conn, lock = get_connection(self.path)
+        with lock:
+            return tuple(conn.execute(SELECT_DEPTH).fetchone())
+
+
+class OutboxDrainer:
+    """
+    Publish the outbox to ipfs, from a background thread or on demand
+    A record always encodes to the same bytes, so a batch published twice,
+    after a crash or by a concurrent drain, gets the same CIDs again and
+    set_post_cid leaves posts that already have one alone.
+    """
+    def __init__(self, storage, settings: dict):
+        self.storage = storage
+        self.outbox = storage.outbox
+        self.sync_log = storage.sync_log
+        self.batch_size = settings["outbox"]["batch_size"]
+        self.poll_interval = settings["outbox"]["poll_interval"]
+        self.min_backoff = settings["outbox"]["min_backoff"]
+        self.max_backoff = settings["outbox"]["max_backoff"]
+        self.record_version = settings["sync"]["record_version"]
+        self.logger = logging.getLogger("kamina")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="kamina-outbox", daemon=True)
+
+    def drain(self) -> int:
+        """
+        Publish every post of the outbox
+        :return: Number of posts published, otherwise, IPFSUnavailable or IPFSError
+        """
+        published = 0
+        origin = self.sync_log.node_id()
+        while True:
+            rows = self.outbox.pending(self.batch_size)
+            if not rows:
+                return published
+            # A record names its thread and parent by CID, so a post waits
+            # for the batch holding its parent to be published first
+            batch, batched, cids = [], set(), {}
+            for post_id, thread_id, parent_id, body, created, title, first_id in rows:
+                if first_id in batched or parent_id in batched:
+                    break
+                batched.add(post_id)
+                if post_id == first_id:
+                    record = ThreadRecord(origin, created, body, title)
+                else:
+                    record = PostRecord(origin, created, body,
+                                        cids.get(first_id) or self.sync_log.post_cid(first_id))
+                    if parent_id is not None:
+                        record.parent = (cids.get(parent_id)
+                                         or self.sync_log.post_cid(parent_id))
+                batch.append((post_id, thread_id, records.encode(record, self.record_version)))
+            for (post_id, _, _), cid in zip(batch, self.storage.add_objects(
+                    [blob for _, _, blob in batch])):
+                cids[post_id] = cid
+            self.storage.database.run_batch([(set_post_cid, (post_id, cids[post_id]))
+                                             for post_id, _, _ in batch])
+            for thread_id in {thread_id for _, thread_id, _ in batch}:
+                self.storage.generations.touch_thread(thread_id)
+            published += len(batch)
+            OUTBOX_PUBLISHED.inc(amount=len(batch))
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _run(self) -> None:
+        backoff = 0
+        while not self._stop.is_set():
+            try:
+                published = self.drain()
+            except (IPFSUnavailable, IPFSError) as error:
+                OUTBOX_FAILURES.inc("unavailable" if isinstance(error, IPFSUnavailable)
+                                    else "error")
+                if not backoff:
+                    self.logger.warning("Unable to publish posts, retrying: %s", error)
+                backoff = min(max(backoff * 2, self.min_backoff), self.max_backoff)
+            except Exception:  # pylint: disable=broad-except
+                OUTBOX_FAILURES.inc("internal")
+                self.logger.exception("Publishing posts failed")
+                backoff = min(max(backoff * 2, self.min_backoff), self.max_backoff)
+            else:
+                if backoff:
+                    self.logger.info("Publishing posts again")
+                backoff = 0
+                if published:
+                    self.logger.debug("Published %d posts", published)
+            self._update_depth()
+            self._stop.wait(backoff or self.poll_interval)
+
+    def _update_depth(self) -> None:
+        count, oldest = self.outbox.depth()
+        OUTBOX_DEPTH.set(value=count)
+        OUTBOX_AGE.set(value=time.time() - oldest if oldest is not None else 0)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
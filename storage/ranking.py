@@ -0,0 +1,125 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+ranking.py - Hot scores of the threads, kept right in the background
+A score is added to as the posts of its thread are written, see HOT_EPOCH
+in database.py, and decayed to the present when it is read, see hot_at, so
+the stored one never needs to decay. Scores only need computing again
+when the half life changes: every thread is then rescored from the creation
+times of its posts, batch_size threads per transaction, by the daemon. A
+post written meanwhile is already scored with the new half life.
+"""
+
+import logging
+import threading
+
+from storage.database import get_connection, DEFAULT_HALF_LIFE
+
+SELECT_STATE = "SELECT value FROM ranking_state WHERE name = ?"
+UPSERT_STATE = "INSERT OR REPLACE INTO ranking_state (name, value) VALUES (?, ?)"
+DELETE_STATE = "DELETE FROM ranking_state WHERE name = ?"
+SELECT_BATCH_END = ("SELECT max(id) FROM (SELECT id FROM threads WHERE id > ? "
+                    "ORDER BY id LIMIT ?)")
+RESCORE = ("UPDATE threads SET hot = (SELECT hot_score(created, ?) FROM posts "
+           "WHERE thread_id = threads.id) WHERE id > ? AND id <= ?")
+
+
+def set_half_life(conn, now: float, half_life: float, rescore: bool) -> None:
+    """Score the new posts with half_life, and rescore every thread if asked to"""
+    conn.execute(UPSERT_STATE, ("half_life", half_life))
+    if rescore:
+        conn.execute(UPSERT_STATE, ("rescored", 0))
+
+
+def rescore_batch(conn, now: float, limit: int) -> int:
+    """
+    Rescore the next limit threads, in id order
+    :return: Number of threads rescored, 0 once they all are
+    """
+    rescored = conn.execute(SELECT_STATE, ("rescored",)).fetchone()
+    if rescored is None:
+        return 0
+    half_life = conn.execute(SELECT_STATE, ("half_life",)).fetchone()[0]
+    end = conn.execute(SELECT_BATCH_END, (int(rescored[0]), limit)).fetchone()[0]
+    if end is None:
+        conn.execute(DELETE_STATE, ("rescored",))
+        return 0
+    count = conn.execute(RESCORE, (half_life, int(rescored[0]), end)).rowcount
+    conn.execute(UPSERT_STATE, ("rescored", end))
+    return count
+
+
+class Ranker:
+    """Bring the hot scores in line with the configured half life, from a background thread"""
+    def __init__(self, storage, settings: dict):
+        self.storage = storage
+        self.half_life = settings["ranking"]["hot_half_life"] * 3600.0
+        self.batch_size = settings["ranking"]["batch_size"]
+        self.batch_interval = settings["ranking"]["batch_interval"]
+        self.logger = logging.getLogger("kamina")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="kamina-ranking", daemon=True)
+
+    def _state(self, name: str):
+        conn, lock = get_connection(self.storage.database.path)
+        with lock:
+            row = conn.execute(SELECT_STATE, (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _run_single(self, func, *args):
+        result, error = self.storage.database.run_batch([(func, args)])[0]
+        if error is not None:
+            raise error
+        return result
+
+    def rescore(self) -> int:
+        """
+        Rescore the threads, if the half life they were scored with isn't the configured one
+        A rescoring cut short carries on from where it was on the next call.
+        :return: Number of threads rescored
+        """
+        current = self._state("half_life")
+        if current != self.half_life:
+            # Scores written before the half life was ever set used the default one
+            self._run_single(set_half_life, self.half_life,
+                             (current or DEFAULT_HALF_LIFE) != self.half_life)
+        total = 0
+        while not self._stop.is_set():
+            count = self._run_single(rescore_batch, self.batch_size)
+            if not count:
+                break
+            total += count
+            self.storage.generations.touch_listing()
+            self._stop.wait(self.batch_interval)
+        return total
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _run(self) -> None:
+        try:
+            rescored = self.rescore()
+        except Exception:  # pylint: disable=broad-except
+            self.logger.exception("Rescoring threads failed")
+            return
+        if rescored:
+            self.logger.info("Rescored %d threads", rescored)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
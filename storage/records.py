@@ -0,0 +1,191 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+records.py - Post and thread records as they are published to ipfs
+Version 2 records are a small header, the fields of the record packed
+positionally with msgpack, then the raw utf8 body:
+
+    b"KR" | version (1 byte) | length of the fields (4 bytes) | fields | body
+
+Decoding leaves the body as a view of the fetched bytes, a large body is
+only copied once something asks for its text. Version 1 records, canonical
+json objects, are still read.
+"""
+
+import json
+import struct
+
+import msgpack
+
+MAGIC = b"KR"
+RECORD_VERSION = 2
+JSON_VERSION = 1
+HEADER = struct.Struct(">2sBI")
+KIND_THREAD = 0
+KIND_POST = 1
+
+
+class PostRecord:
+    """A response, naming its thread and parent post by CID"""
+    __slots__ = ("origin", "created", "thread", "parent", "_body")
+    kind = KIND_POST
+
+    def __init__(self, origin: str, created: float, body, thread: str, parent: str = None):
+        """
+        :param origin: Id of the node which wrote the post
+        :param created: Creation time, seconds since the epoch
+        :param body: Text of the post, or its utf8 bytes
+        :param thread: CID of the opening post of the thread
+        :param parent: CID of the post replied to, None for a reply to the thread
+        """
+        self.origin = origin
+        # Always a float, so equal records always pack to the same bytes
+        self.created = float(created)
+        self.thread = thread
+        self.parent = parent
+        self._body = body
+
+    @property
+    def body(self) -> str:
+        """Text of the post, decoded on first access"""
+        if isinstance(self._body, str):
+            return self._body
+        return self.decode_body()
+
+    @property
+    def body_bytes(self):
+        """Utf8 bytes of the body, a view of the record when it was decoded"""
+        if isinstance(self._body, str):
+            return self._body.encode("utf8")
+        return self._body
+
+    def decode_body(self) -> str:
+        """
+        Decode the body now rather than on first access
+        :return: The text, otherwise, ValueError if the body isn't utf8
+        """
+        if not isinstance(self._body, str):
+            self._body = str(self._body, "utf8")
+        return self._body
+
+    def fields(self) -> list:
+        """Everything but the body, in the order it is packed"""
+        return [self.kind, self.origin, self.created, self.thread, self.parent]
+
+    def to_json(self) -> dict:
+        """The version 1 object of the record"""
+        return {"v": JSON_VERSION, "origin": self.origin, "body": self.body,
+                "created": self.created, "thread": self.thread, "parent": self.parent}
+
+    def __eq__(self, other) -> bool:
+        return (type(self) is type(other) and self.fields() == other.fields()
+                and bytes(self.body_bytes) == bytes(other.body_bytes))
+
+    def __repr__(self) -> str:
+        return "<%s %r>" % (type(self).__name__, self.fields())
+
+
+class ThreadRecord(PostRecord):
+    """The opening post of a thread, which carries its title"""
+    __slots__ = ("title",)
+    kind = KIND_THREAD
+
+    def __init__(self, origin: str, created: float, body, title: str):
+        super().__init__(origin, created, body, None)
+        self.title = title
+
+    def fields(self) -> list:
+        return [self.kind, self.origin, self.created, self.title]
+
+    def to_json(self) -> dict:
+        record = super().to_json()
+        record["title"] = self.title
+        return record
+
+
+def encode(record: PostRecord, version: int = RECORD_VERSION) -> bytes:
+    """
+    Canonical bytes of a record, the same post always gets the same CID
+    :param version: Format to write, JSON_VERSION for nodes that can't read binary records
+    """
+    if version == JSON_VERSION:
+        return json.dumps(record.to_json(), sort_keys=True, separators=(",", ":")).encode("utf8")
+    if version != RECORD_VERSION:
+        raise ValueError("Unknown post record version %r" % version)
+    fields = msgpack.packb(record.fields(), use_bin_type=True)
+    return b"".join((HEADER.pack(MAGIC, RECORD_VERSION, len(fields)), fields,
+                     record.body_bytes))
+
+
+def decode(data) -> PostRecord:
+    """
+    Parse and check a record, of any version this node can read
+    :param data: Bytes of the record, any object supporting the buffer protocol
+    :return: A PostRecord or ThreadRecord, otherwise, ValueError
+    """
+    view = memoryview(data)
+    if view[:1] == b"{":
+        return _decode_json(view)
+    if len(view) < HEADER.size:
+        raise ValueError("Malformed post record")
+    magic, version, length = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError("Malformed post record")
+    if version != RECORD_VERSION:
+        raise ValueError("Unsupported post record version %d" % version)
+    end = HEADER.size + length
+    if end > len(view):
+        raise ValueError("Malformed post record")
+    try:
+        fields = msgpack.unpackb(view[HEADER.size:end], raw=False)
+    except (ValueError, TypeError, msgpack.exceptions.UnpackException):
+        raise ValueError("Malformed post record")
+    return _from_fields(fields, view[end:])
+
+
+def _from_fields(fields, body) -> PostRecord:
+    # Fields appended by later versions of the same format are ignored
+    if not isinstance(fields, list) or len(fields) < 4 or not isinstance(fields[1], str) \
+            or not isinstance(fields[2], (int, float)):
+        raise ValueError("Malformed post record")
+    if fields[0] == KIND_THREAD and isinstance(fields[3], str):
+        return ThreadRecord(fields[1], fields[2], body, fields[3])
+    if fields[0] == KIND_POST and len(fields) >= 5 and isinstance(fields[3], str) \
+            and isinstance(fields[4], (str, type(None))):
+        return PostRecord(fields[1], fields[2], body, fields[3], fields[4])
+    raise ValueError("Malformed post record")
+
+
+def _decode_json(view: memoryview) -> PostRecord:
+    try:
+        record = json.loads(str(view, "utf8"))
+    except ValueError:
+        raise ValueError("Malformed post record")
+    if (not isinstance(record, dict) or record.get("v") != JSON_VERSION
+            or not isinstance(record.get("body"), str)
+            or not isinstance(record.get("created"), (int, float))
+            or not isinstance(record.get("thread"), (str, type(None)))
+            or not isinstance(record.get("parent"), (str, type(None)))):
+        raise ValueError("Malformed post record")
+    origin = record.get("origin") or ""
+    if record["thread"] is None:
+        if not isinstance(record.get("title"), str):
+            raise ValueError("Malformed post record")
+        return ThreadRecord(origin, record["created"], record["body"], record["title"])
+    return PostRecord(origin, record["created"], record["body"], record["thread"],
+                      record["parent"])
@@ -0,0 +1,188 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+search.py - Ranked full text search over the posts
+"""
+
+import re
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from storage.database import get_connection, POST_FIELDS, SEARCH_TABLE, SEARCH_TRIGGER
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+SEARCH = ("SELECT p.id, p.thread_id, p.parent_id, p.body, p.created, p.cid, f.rank "
+          "FROM posts_fts f JOIN posts p ON p.id = f.rowid "
+          "WHERE posts_fts MATCH ? ORDER BY f.rank, f.rowid LIMIT ?")
+SEARCH_AFTER = ("SELECT p.id, p.thread_id, p.parent_id, p.body, p.created, p.cid, f.rank "
+                "FROM posts_fts f JOIN posts p ON p.id = f.rowid "
+                "WHERE posts_fts MATCH ? AND (f.rank, f.rowid) > (?, ?) "
+                "ORDER BY f.rank, f.rowid LIMIT ?")
+SELECT_POSTS_TO_INDEX = (
+    "SELECT p.id, CASE WHEN p.id = (SELECT MIN(id) FROM posts WHERE thread_id = p.thread_id) "
+    "THEN t.title ELSE '' END, p.body "
+    "FROM posts p JOIN threads t ON t.id = p.thread_id "
+    "WHERE p.id > ? ORDER BY p.id LIMIT ?"
+)
+# Rebuilds fill this index, swapped in for posts_fts once complete
+REBUILD_TABLE = "posts_fts_rebuild"
+INSERT_INDEX = "INSERT INTO posts_fts_rebuild (rowid, title, body) VALUES (?, ?, ?)"
+SELECT_STATE = "SELECT value FROM search_state WHERE name = ?"
+UPSERT_STATE = "INSERT OR REPLACE INTO search_state (name, value) VALUES (?, ?)"
+
+
+class SearchUnavailable(Exception):
+    """Raised when the sqlite library has no fts5 support"""
+
+
+def make_query(text: str) -> str:
+    """
+    Turn user input into an fts5 query matching posts with all of its words
+    Every word is quoted, so no fts5 syntax can be injected.
+    :return: The query, empty if there is nothing to search for
+    """
+    return " ".join('"%s"' % token for token in TOKEN_RE.findall(text))
+
+
+def rebuild_index(path: str) -> int:
+    """Rebuild the index of one database, runs in a process of its own, see SearchIndex.rebuild"""
+    return SearchIndex(path).rebuild()
+
+
+class SearchIndex:
+    """Queries and maintenance of the posts_fts index"""
+    def __init__(self, path: str):
+        self.path = path
+        self.logger = logging.getLogger("kamina")
+
+    @staticmethod
+    def _check(conn) -> None:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'posts_fts'").fetchone() is None:
+            raise SearchUnavailable()
+
+    def search(self, text: str, limit: int, after: tuple = None) -> list:
+        """
+        Find the posts matching some text, best match first
+        :param text: Words to look for
+        :param limit: Maximum number of posts to return
+        :param after: (rank, id) of the last post of the previous page
+        :return: List of post dicts, each with its "rank"
+        """
+        query = make_query(text)
+        if not query:
+            return []
+        conn, lock = get_connection(self.path)
+        with lock:
+            self._check(conn)
+            if after is None:
+                rows = conn.execute(SEARCH, (query, limit)).fetchall()
+            else:
+                rows = conn.execute(SEARCH_AFTER, (query, after[0], after[1], limit)).fetchall()
+        return [dict(zip(POST_FIELDS + ("rank",), row)) for row in rows]
+
+    def rebuild(self, batch_size: int = 10000) -> int:
+        """
+        Build the index again from the posts table, and swap it in for the current one
+        The new index is filled aside, one transaction per batch, so the api
+        keeps writing in between and searching the current index meanwhile.
+        Posts written during the rebuild go into both, by a trigger of the new
+        one, and the batches stop at the last post that existed when it
+        started. The last post indexed is saved with every batch, a rebuild
+        interrupted goes on from there the next time.
+        Merging of index segments is turned off while loading and the index
+        is optimized once at the end, which beats merging on the fly. The next
+        batch is read by a thread of its own, over a second connection, while
+        sqlite tokenizes the current one.
+        :return: Number of posts indexed by this run
+        """
+        names = {"table": REBUILD_TABLE}
+        conn, lock = get_connection(self.path)
+        with lock:
+            self._check(conn)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                last_post = conn.execute(SELECT_STATE, ("rebuild_last_post",)).fetchone()
+                if last_post is None:
+                    conn.execute("DROP TRIGGER IF EXISTS %(table)s_insert" % names)
+                    conn.execute("DROP TABLE IF EXISTS %(table)s" % names)
+                    conn.execute(SEARCH_TABLE % names)
+                    conn.execute(SEARCH_TRIGGER % names)
+                    conn.execute("INSERT INTO %(table)s (%(table)s, rank) "
+                                 "VALUES ('automerge', 0)" % names)
+                    last_post = conn.execute("SELECT IFNULL(MAX(id), 0) FROM posts").fetchone()
+                    conn.execute(UPSERT_STATE, ("rebuild_last_post", last_post[0]))
+                    conn.execute(UPSERT_STATE, ("rebuild_indexed", 0))
+                else:
+                    self.logger.info("Resuming the interrupted rebuild of the search index")
+                last_post = last_post[0]
+                last_id = conn.execute(SELECT_STATE, ("rebuild_indexed",)).fetchone()[0]
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+        indexed = 0
+        reader_conn = sqlite3.connect(self.path, check_same_thread=False)
+
+        def read(after: int) -> list:
+            if after >= last_post:
+                return []
+            rows = reader_conn.execute(SELECT_POSTS_TO_INDEX, (after, batch_size)).fetchall()
+            return [row for row in rows if row[0] <= last_post]
+
+        try:
+            with ThreadPoolExecutor(max_workers=1) as reader:
+                pending = reader.submit(read, last_id)
+                while True:
+                    rows = pending.result()
+                    if not rows:
+                        break
+                    pending = reader.submit(read, rows[-1][0])
+                    with lock:
+                        conn.execute("BEGIN IMMEDIATE")
+                        try:
+                            conn.executemany(INSERT_INDEX, rows)
+                            conn.execute(UPSERT_STATE, ("rebuild_indexed", rows[-1][0]))
+                        except Exception:
+                            conn.execute("ROLLBACK")
+                            raise
+                        conn.execute("COMMIT")
+                    indexed += len(rows)
+                    self.logger.debug("Indexed %d posts", indexed)
+        finally:
+            reader_conn.close()
+
+        with lock:
+            conn.execute("INSERT INTO %(table)s (%(table)s) VALUES ('optimize')" % names)
+            conn.execute("INSERT INTO %(table)s (%(table)s, rank) VALUES ('automerge', 4)" % names)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Renaming checks every trigger, none may name a table that is gone
+                conn.execute("DROP TRIGGER %(table)s_insert" % names)
+                conn.execute("DROP TRIGGER posts_fts_insert")
+                conn.execute("DROP TABLE posts_fts")
+                conn.execute("ALTER TABLE %(table)s RENAME TO posts_fts" % names)
+                conn.execute(SEARCH_TRIGGER % {"table": "posts_fts"})
+                conn.execute("DELETE FROM search_state WHERE name LIKE 'rebuild_%'")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        return indexed
@@ -0,0 +1,80 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+shards.py - One storage shard per community hosted by the node
+The own community of the node lives right in node_dir, as it always has.
+Every other community of general.communities gets a directory of its own,
+node_dir/communities/<id>, with its database, object cache, generations
+and events. Each database is a separate sqlite file written by its own
+writer thread, so writes to two communities never wait on each other.
+"""
+
+import re
+import threading
+
+from storage.storage import Storage
+
+COMMUNITY_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class UnknownCommunity(Exception):
+    """Raised when asked for a community the node doesn't host"""
+
+
+def check_communities(communities: list) -> list:
+    """
+    :return: The ids of communities, otherwise, ValueError if one can't be a directory name
+    """
+    for community in communities:
+        if not isinstance(community, str) or not COMMUNITY_RE.match(community):
+            raise ValueError("Invalid community id: %r" % (community,))
+    return list(communities)
+
+
+class Shards:
+    """
+    The Storage of every community, opened on first use
+    They share a single ipfs client, its pool of connections is the node's.
+    """
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self.communities = check_communities(settings["general"]["communities"])
+        self._shards = {}
+        self._lock = threading.Lock()
+        self._ipfs_conn = None
+
+    def get(self, community: str = None) -> Storage:
+        """
+        :param community: Id of the community, None for the own community of the node
+        :return: Its Storage, otherwise, UnknownCommunity
+        """
+        storage = self._shards.get(community)
+        if storage is None:
+            if community is not None and community not in self.communities:
+                raise UnknownCommunity(community)
+            with self._lock:
+                storage = self._shards.get(community)
+                if storage is None:
+                    storage = Storage(self.settings, community, self._ipfs_conn)
+                    self._ipfs_conn = storage.ipfs_conn
+                    self._shards[community] = storage
+        return storage
+
+    def all(self) -> list:
+        """The Storage of every community, the own one of the node first"""
+        return [self.get(community) for community in [None] + self.communities]
@@ -20,22 +20,239 @@ storage.py - Manage data storage, be it sqlite or ipfs
 """
 
 import logging
+from pathlib import PurePath
 
-import ipfsapi
+from storage.database import (Database, shard_dir, database_path, insert_thread,
+                              insert_response)
+from storage.writer import WriteCoalescer
+from storage.cache import ObjectCache
+from storage.ipfs import IPFSClient, IPFSUnavailable, IPFSError
+from storage.generations import GenerationTable
+from storage.search import SearchIndex
+from storage.events import EventBus
+from storage.sync import SyncLog
+from storage.outbox import Outbox
+from storage.media import MediaStore, insert_media
+from kamina.metrics import Histogram
+
+STORAGE_SECONDS = Histogram("kamina_storage_seconds", "Latency of storage calls", ("operation",))
+
+GENERATION_SLOTS = 65536
 
 
 class Storage:
     """
     Helper class to simplify storage
+    :param community: Id of the community whose shard this is, None for the
+                      own community of the node, see shards.py
+    :param ipfs_conn: IPFSClient to share with other shards, a new one if None
     """
-    def __init__(self, settings: dict):
+    def __init__(self, settings: dict, community: str = None, ipfs_conn: IPFSClient = None):
         self.settings = settings
+        self.community = community
         self.logger = logging.getLogger("kamina")
-        self.ipfs_conn = None
-        self._connect_to_ipfs()
+        self.ipfs_conn = ipfs_conn
+        directory = shard_dir(settings, community)
+        path = database_path(settings, community)
+        self.database = Database(path)
+        self.search_index = SearchIndex(path)
+        self.sync_log = SyncLog(path)
+        self.outbox = Outbox(path)
+        self.media = MediaStore(path)
+        self.writer = WriteCoalescer(self.database,
+                                     settings["storage"]["flush_interval"] / 1000,
+                                     settings["storage"]["batch_size"])
+        self.cache = ObjectCache(str(PurePath(directory, "cache")),
+                                 settings["cache"]["memory_size"] * 1024 * 1024,
+                                 settings["cache"]["disk_size"] * 1024 * 1024)
+        self.generations = GenerationTable(str(PurePath(directory, "generations")),
+                                           GENERATION_SLOTS)
+        self.events = EventBus(str(PurePath(directory, "events")))
+        if self.ipfs_conn is None:
+            self._connect_to_ipfs()
 
     def _connect_to_ipfs(self):
+        ipfs = self.settings["ipfs"]
+        # The client keeps working once the daemon comes up, no need to retry here
+        self.ipfs_conn = IPFSClient(ipfs["host"], ipfs["port"], ipfs["pool_size"], ipfs["timeout"])
         try:
-            self.ipfs_conn = ipfsapi.connect('127.0.0.1', 5001)
-        except ipfsapi.exceptions.ConnectionError:
-            print("Unable to connect to the ipfs daemon")
+            self.ipfs_conn.version()
+        except (IPFSUnavailable, IPFSError):
+            self.logger.warning("Unable to connect to the ipfs daemon, "
+                                "new posts are published once it is up")
+
+    @STORAGE_SECONDS.time("get_object")
+    def get_object(self, cid: str) -> bytes:
+        """
+        Read an object from ipfs, going through the object cache first
+        :param cid: CID of the object
+        :return: Content of the object
+        """
+        if not cid.isalnum():
+            raise ValueError("Invalid CID: %r" % cid)
+        data = self.cache.get(cid)
+        if data is None:
+            data = self.ipfs_conn.cat(cid)
+            self.cache.put(cid, data)
+        return data
+
+    @STORAGE_SECONDS.time("get_objects")
+    def get_objects(self, cids: list) -> list:
+        """
+        Read several objects, the ones missing from the cache are fetched concurrently
+        :param cids: CIDs of the objects
+        :return: Contents, in the same order as cids
+        """
+        for cid in cids:
+            if not cid.isalnum():
+                raise ValueError("Invalid CID: %r" % cid)
+        objects = [self.cache.get(cid) for cid in cids]
+        missing = [cid for cid, data in zip(cids, objects) if data is None]
+        if missing:
+            fetched = dict(zip(missing, self.ipfs_conn.cat_many(missing)))
+            for cid, data in fetched.items():
+                self.cache.put(cid, data)
+            objects = [fetched[cid] if data is None else data for cid, data in zip(cids, objects)]
+        return objects
+
+    @STORAGE_SECONDS.time("add_objects")
+    def add_objects(self, blobs: list) -> list:
+        """
+        Publish several objects to ipfs in a single request
+        :param blobs: Contents of the objects
+        :return: CIDs, in the same order as blobs
+        """
+        cids = self.ipfs_conn.add_many(blobs)
+        for cid, blob in zip(cids, blobs):
+            self.cache.put(cid, blob)
+        return cids
+
+    @STORAGE_SECONDS.time("add_upload")
+    def add_upload(self, stream, length: int, media_type: str) -> str:
+        """
+        Stream an upload into ipfs and ask for the variants of images
+        :param stream: File like object the upload is read from
+        :param length: Size of the upload
+        :param media_type: Its media type, as told by the client
+        :return: CID of the upload
+        """
+        cid = self.ipfs_conn.add_stream(stream, length)
+        self.record_upload(cid, media_type, length)
+        return cid
+
+    def record_upload(self, cid: str, media_type: str, length: int) -> None:
+        """Save an upload already added to ipfs, and ask for the variants of images"""
+        variants = ()
+        if media_type.startswith("image/"):
+            variants = tuple(self.settings["media"]["variants"])
+        self.writer.submit(insert_media, cid, media_type, length, variants)
+
+    def get_media(self, cid: str):
+        """
+        :return: Tuple of (media type, size) of an upload, None if there is no such upload
+        """
+        return self.media.get(cid)
+
+    def get_media_variant(self, cid: str, variant: str):
+        """
+        :return: Tuple of (CID, media type, error) of a variant of an upload,
+                 see MediaStore.variant
+        """
+        return self.media.variant(cid, variant)
+
+    @STORAGE_SECONDS.time("get_all_threads")
+    def get_all_threads(self, limit: int, after: tuple = None, sort: str = "active") -> list:
+        """
+        List threads, the most recently active ones first unless told otherwise
+        :param limit: Maximum number of threads to return
+        :param after: (sort key, id) of the last thread already seen
+        :param sort: "active", "hot" or "new", see Database.list_threads
+        :return: List of thread dicts
+        """
+        return self.database.list_threads(limit, after, sort)
+
+    def get_hot_half_life(self) -> float:
+        """Half life of the stored hot scores, which may not be the configured one yet"""
+        return self.database.hot_half_life()
+
+    @STORAGE_SECONDS.time("get_single_thread")
+    def get_single_thread(self, thread_id: int, limit: int, depth: int, root: int = None,
+                          after: str = None):
+        """
+        Load a thread with a window of its reply tree
+        :param thread_id: Id of the thread
+        :param limit: Maximum number of posts to return
+        :param depth: Number of reply levels to load below the root
+        :param root: Id of the post whose replies are loaded, the whole thread if None
+        :param after: Position of the last post already seen
+        :return: Thread dict, None if there is no such thread or post
+        """
+        return self.database.get_thread(thread_id, limit, depth, root, after)
+
+    @STORAGE_SECONDS.time("search")
+    def search(self, text: str, limit: int, after: tuple = None) -> list:
+        """
+        Full text search over every post
+        :param text: Words to look for
+        :param limit: Maximum number of posts to return
+        :param after: (rank, id) of the last post already seen
+        :return: List of post dicts, best match first
+        """
+        return self.search_index.search(text, limit, after)
+
+    @STORAGE_SECONDS.time("get_new_posts")
+    def get_new_posts(self, thread_id: int, after: int, limit: int) -> list:
+        """
+        List the posts of a thread newer than a given one, oldest first
+        :param after: Id of the last post already seen
+        :param limit: Maximum number of posts to return
+        :return: List of post dicts
+        """
+        return self.database.get_new_posts(thread_id, after, limit)
+
+    def get_last_post_id(self, thread_id: int):
+        """
+        :return: Id of the newest post of a thread, None if there is no such thread
+        """
+        return self.database.get_last_post_id(thread_id)
+
+    def get_sync_log(self, after: int, limit: int) -> tuple:
+        """
+        Read the sync log of the node, for peers replicating from it
+        :param after: Sequence number of the last entry already seen
+        :return: Tuple of (list of (seq, cid), sequence number of the last entry)
+        """
+        return self.sync_log.entries(after, limit)
+
+    def get_sync_ranges(self, low: int, high: int, parts: int) -> tuple:
+        """
+        Digests of parts of the CID key range [low, high), for peers comparing it with theirs
+        :return: Tuple of (list of (low, high, count, sum of keys), sequence number
+                 of the last log entry)
+        """
+        return self.sync_log.ranges(low, high, parts)
+
+    def get_sync_entries(self, low: int, high: int, limit: int) -> list:
+        """List the (seq, cid) of the log entries in the CID key range [low, high)"""
+        return self.sync_log.range_entries(low, high, limit)
+
+    @STORAGE_SECONDS.time("make_post")
+    def make_post(self, title: str, body: str) -> tuple:
+        """
+        Start a new thread
+        :return: Tuple of (thread id, post id)
+        """
+        thread_id, post_id = self.writer.submit(insert_thread, title, body)
+        self.generations.touch_thread(thread_id)
+        return thread_id, post_id
+
+    @STORAGE_SECONDS.time("make_response")
+    def make_response(self, thread_id: int, parent_id, body: str) -> int:
+        """
+        Reply to a thread, optionally to a given post of it
+        :return: Id of the new post
+        """
+        post_id = self.writer.submit(insert_response, thread_id, parent_id, body)
+        self.generations.touch_thread(thread_id)
+        self.events.publish(thread_id, post_id)
+        return post_id
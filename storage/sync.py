@@ -0,0 +1,406 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+sync.py - Replication of posts between community nodes
+Every post is published to ipfs as a small record naming its thread and
+parent by CID, and appended to the sync log of the node. Nodes pull the log
+of a peer from where they left off, and compare digests of CID ranges the
+first time they meet, so only the missing records are ever fetched.
+"""
+
+import json
+import uuid
+import hashlib
+import logging
+import threading
+
+from storage.database import (get_connection, path_segment, ThreadNotFound, InvalidParent,
+                              INSERT_THREAD, INSERT_POST, SET_POST_PATH, COUNT_REPLY,
+                              SELECT_HALF_LIFE)
+from storage import records
+from storage.records import PostRecord, ThreadRecord
+
+# Ranges are compared on a hash of the CIDs, spread evenly over KEY_SPACE.
+# 32 bits keep sum() far from overflowing sqlite integers.
+KEY_SPACE = 1 << 32
+RANGE_PARTS = 16
+# Ranges holding fewer CIDs than this are listed instead of split again
+LEAF_SIZE = 256
+# Syncs a post whose thread or parent is unknown is tried again in
+MAX_RETRIES = 10
+
+SELECT_LOG = "SELECT seq, cid FROM sync_log WHERE seq > ? ORDER BY seq LIMIT ?"
+SELECT_LOG_HEAD = "SELECT IFNULL(MAX(seq), 0) FROM sync_log"
+SELECT_RANGE_DIGEST = ("SELECT count(*), IFNULL(sum(key), 0) FROM sync_log "
+                       "WHERE key >= ? AND key < ?")
+SELECT_RANGE = ("SELECT seq, cid FROM sync_log WHERE key >= ? AND key < ? "
+                "ORDER BY key, seq LIMIT ?")
+SELECT_KNOWN = "SELECT 1 FROM sync_log WHERE cid = ?"
+INSERT_LOG = "INSERT OR IGNORE INTO sync_log (cid, key) VALUES (?, ?)"
+SELECT_STATE = "SELECT value FROM sync_state WHERE name = ?"
+UPSERT_STATE = "INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)"
+SELECT_POST_CID = "SELECT cid FROM posts WHERE id = ?"
+SELECT_POST_BY_CID = "SELECT id, thread_id, path, depth FROM posts WHERE cid = ?"
+SET_POST_CID = "UPDATE posts SET cid = ? WHERE id = ? AND cid IS NULL"
+TOUCH_THREAD_AT = ("UPDATE threads SET last_activity = max(last_activity, ?), "
+                   "post_count = post_count + 1, hot = hot_add(hot, ?, %s) WHERE id = ?"
+                   % SELECT_HALF_LIFE)
+
+
+def cid_key(cid: str) -> int:
+    """Position of a CID in the key space ranges are cut from"""
+    return int.from_bytes(hashlib.sha256(cid.encode("utf8")).digest()[:4], "big")
+
+
+def peer_url(url: str, community: str = None) -> str:
+    """Base url of a community on a peer node, peers host it under the same id"""
+    if community is None:
+        return url
+    return "%s/c/%s" % (url.rstrip("/"), community)
+
+
+def decode_record(data) -> PostRecord:
+    """
+    Parse and check a post record fetched from a peer
+    Its body is decoded up front, so a bad one is refused before any write.
+    :return: The record, otherwise, ValueError
+    """
+    record = records.decode(data)
+    record.decode_body()
+    return record
+
+
+def set_post_cid(conn, now: float, post_id: int, cid: str) -> None:
+    """Record the CID a local post was published under, unless it already has one"""
+    if conn.execute(SET_POST_CID, (cid, post_id)).rowcount:
+        conn.execute(INSERT_LOG, (cid, cid_key(cid)))
+
+
+def import_post(conn, now: float, cid: str, record: PostRecord):
+    """
+    Write a post received from a peer, its thread and parent must be known
+    :return: Tuple of (thread id, post id), None if the post was already known
+    """
+    if conn.execute(SELECT_KNOWN, (cid,)).fetchone() is not None:
+        return None
+    parent_id, parent_path, depth = None, "", 0
+    if isinstance(record, ThreadRecord):
+        thread_id = conn.execute(INSERT_THREAD, (record.title, record.created,
+                                                 record.created)).lastrowid
+    else:
+        root = conn.execute(SELECT_POST_BY_CID, (record.thread,)).fetchone()
+        if root is None:
+            raise ThreadNotFound(record.thread)
+        thread_id = root[1]
+        if record.parent is not None:
+            parent = conn.execute(SELECT_POST_BY_CID, (record.parent,)).fetchone()
+            if parent is None or parent[1] != thread_id:
+                raise InvalidParent(record.parent)
+            parent_id, parent_path, depth = parent[0], parent[2], parent[3] + 1
+    post_id = conn.execute(INSERT_POST, (thread_id, parent_id, record.body,
+                                         record.created)).lastrowid
+    conn.execute(SET_POST_PATH, (parent_path + path_segment(post_id), depth, post_id))
+    if parent_id is not None:
+        conn.execute(COUNT_REPLY, (parent_id,))
+    conn.execute(TOUCH_THREAD_AT, (record.created, record.created, thread_id))
+    set_post_cid(conn, now, post_id, cid)
+    return thread_id, post_id
+
+
+class SyncLog:
+    """Queries of the sync log, the side of replication peers ask"""
+    def __init__(self, path: str):
+        self.path = path
+
+    def entries(self, after: int, limit: int) -> tuple:
+        """
+        Read the log from a given position
+        :param after: Sequence number of the last entry already seen
+        :return: Tuple of (list of (seq, cid), sequence number of the last entry)
+        """
+        conn, lock = get_connection(self.path)
+        with lock:
+            rows = conn.execute(SELECT_LOG, (after, limit)).fetchall()
+            head = conn.execute(SELECT_LOG_HEAD).fetchone()[0]
+        return rows, head
+
+    def head(self) -> int:
+        """Sequence number of the last log entry, 0 if the log is empty"""
+        conn, lock = get_connection(self.path)
+        with lock:
+            return conn.execute(SELECT_LOG_HEAD).fetchone()[0]
+
+    def ranges(self, low: int, high: int, parts: int) -> tuple:
+        """
+        Digest of every part of the key range [low, high)
+        :return: Tuple of (list of (low, high, count, sum of keys), log head)
+        """
+        bounds = [low + (high - low) * part // parts for part in range(parts + 1)]
+        conn, lock = get_connection(self.path)
+        with lock:
+            head = conn.execute(SELECT_LOG_HEAD).fetchone()[0]
+            digests = [(start, end) + conn.execute(SELECT_RANGE_DIGEST, (start, end)).fetchone()
+                       for start, end in zip(bounds, bounds[1:]) if start < end]
+        return digests, head
+
+    def range_entries(self, low: int, high: int, limit: int) -> list:
+        """List the (seq, cid) of the log entries in the key range [low, high)"""
+        conn, lock = get_connection(self.path)
+        with lock:
+            return conn.execute(SELECT_RANGE, (low, high, limit)).fetchall()
+
+    def unknown(self, cids: list) -> list:
+        """The CIDs missing from the log, in the same order"""
+        conn, lock = get_connection(self.path)
+        with lock:
+            return [cid for cid in cids if conn.execute(SELECT_KNOWN, (cid,)).fetchone() is None]
+
+    def get_state(self, name: str, default=None):
+        conn, lock = get_connection(self.path)
+        with lock:
+            row = conn.execute(SELECT_STATE, (name,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set_state(self, name: str, value) -> None:
+        conn, lock = get_connection(self.path)
+        with lock:
+            conn.execute(UPSERT_STATE, (name, json.dumps(value)))
+
+    def node_id(self) -> str:
+        """Random id of this node, generated once, keeps its records apart from others"""
+        node_id = self.get_state("node_id")
+        if node_id is None:
+            node_id = uuid.uuid4().hex
+            self.set_state("node_id", node_id)
+        return node_id
+
+    def post_cid(self, post_id: int):
+        conn, lock = get_connection(self.path)
+        with lock:
+            row = conn.execute(SELECT_POST_CID, (post_id,)).fetchone()
+        return None if row is None else row[0]
+
+
+class PeerClient:
+    """Asks the api of a peer node about its sync log"""
+    def __init__(self, url: str, timeout: float):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._session = None
+
+    def _get(self, endpoint: str, **params) -> dict:
+        import requests
+        if self._session is None:
+            self._session = requests.Session()
+        response = self._session.get(self.url + "/api/sync/" + endpoint, params=params,
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def entries(self, after: int, limit: int) -> tuple:
+        reply = self._get("log", after=after, limit=limit)
+        return [tuple(entry) for entry in reply["entries"]], reply["head"]
+
+    def ranges(self, low: int, high: int, parts: int) -> tuple:
+        reply = self._get("ranges", low=low, high=high, parts=parts)
+        return [tuple(entry) for entry in reply["ranges"]], reply["head"]
+
+    def range_entries(self, low: int, high: int, limit: int) -> list:
+        return [tuple(entry) for entry in self._get("entries", low=low, high=high,
+                                                     limit=limit)["entries"]]
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+
+
+class Replicator:
+    """
+    Publish the local posts and pull the missing ones from peers
+    Missing records are fetched batch_size at a time, concurrently through
+    the ipfs client pool, and the next batch is only fetched once the
+    previous one is written, so a big backlog never piles up in memory.
+    """
+    def __init__(self, storage, settings: dict):
+        self.storage = storage
+        self.sync_log = storage.sync_log
+        self.batch_size = settings["sync"]["batch_size"]
+        self.timeout = settings["sync"]["timeout"]
+        self.logger = logging.getLogger("kamina")
+
+    def sync_peer(self, url: str, full: bool = False) -> int:
+        """
+        Pull the posts of a peer we don't have yet
+        The cursor moves past posts which couldn't be written for lack of
+        their thread or parent, they are kept aside and tried again at the end
+        of the next syncs, once their thread or parent may have come along.
+        :param url: Base url of the peer api
+        :param full: Compare the whole CID sets instead of reading the new log entries
+        :return: Number of posts imported
+        """
+        peer = PeerClient(url, self.timeout)
+        cursor_name = "cursor:%s" % peer.url
+        retry_name = "retry:%s" % peer.url
+        cursor = self.sync_log.get_state(cursor_name)
+        # CIDs to try again, in peer log order, with the number of syncs they failed in
+        retry = dict(self.sync_log.get_state(retry_name, []))
+        imported = 0
+        try:
+            # An empty node has nothing to compare, reading the whole log is cheaper
+            if cursor is None and self.sync_log.head() == 0:
+                cursor = 0
+            if full or cursor is None:
+                missing, head = self._diff_ranges(peer)
+                imported += self._import(missing, retry)
+                cursor = max(cursor or 0, head)
+                self._save(cursor_name, cursor, retry_name, retry)
+            while True:
+                entries, _ = peer.entries(cursor, self.batch_size * 4)
+                if not entries:
+                    break
+                missing = self.sync_log.unknown([cid for _, cid in entries])
+                imported += self._import(missing, retry)
+                cursor = entries[-1][0]
+                self._save(cursor_name, cursor, retry_name, retry)
+            if retry:
+                imported += self._retry(retry)
+                self._save(cursor_name, cursor, retry_name, retry)
+        finally:
+            peer.close()
+        return imported
+
+    def _save(self, cursor_name: str, cursor: int, retry_name: str, retry: dict) -> None:
+        self.sync_log.set_state(retry_name, list(retry.items()))
+        self.sync_log.set_state(cursor_name, cursor)
+
+    def _retry(self, retry: dict) -> int:
+        """Import the posts kept aside again, giving up on the ones failing too often"""
+        cids = self.sync_log.unknown(list(retry))
+        attempts = {cid: retry[cid] + 1 for cid in cids}
+        retry.clear()
+        failed = {}
+        imported = self._import(cids, failed)
+        for cid in failed:
+            if attempts[cid] < MAX_RETRIES:
+                retry[cid] = attempts[cid]
+            else:
+                self.logger.warning("Giving up on post %s, its thread or parent is still "
+                                    "unknown, kcn sync --full looks for it again", cid)
+        return imported
+
+    def _diff_ranges(self, peer: PeerClient) -> tuple:
+        """
+        Find the CIDs of a peer missing here by comparing range digests,
+        splitting the ranges which differ until they are small enough to list
+        :return: Tuple of (missing CIDs in the peer log order, peer log head)
+        """
+        missing = []
+        head = None
+        pending = [(0, KEY_SPACE)]
+        while pending:
+            low, high = pending.pop()
+            remote, remote_head = peer.ranges(low, high, RANGE_PARTS)
+            if head is None:
+                head = remote_head
+            local = {digest[:2]: digest[2:] for digest in self.sync_log.ranges(
+                low, high, RANGE_PARTS)[0]}
+            for start, end, count, total in remote:
+                if count == 0 or local.get((start, end)) == (count, total):
+                    continue
+                if count <= LEAF_SIZE or end - start <= RANGE_PARTS:
+                    entries = peer.range_entries(start, end, count)
+                    unknown = set(self.sync_log.unknown([cid for _, cid in entries]))
+                    missing.extend(entry for entry in entries if entry[1] in unknown)
+                else:
+                    pending.append((start, end))
+        # The peer logged every post after its parent, its order is safe to import in
+        missing.sort()
+        return [cid for _, cid in missing], head or 0
+
+    def _import(self, cids: list, failed: dict) -> int:
+        """
+        Fetch and write the given records, batch_size of them at a time
+        :param failed: The CIDs of posts whose thread or parent is unknown are added to it
+        """
+        imported = 0
+        for start in range(0, len(cids), self.batch_size):
+            batch = cids[start:start + self.batch_size]
+            operations = []
+            for cid, data in zip(batch, self.storage.get_objects(batch)):
+                try:
+                    operations.append((import_post, (cid, decode_record(data))))
+                except ValueError:
+                    self.logger.warning("Ignoring malformed post record %s", cid)
+            results = self.storage.database.run_batch(operations)
+            for (_, (cid, _)), (result, error) in zip(operations, results):
+                if error is not None:
+                    self.logger.debug("Keeping post %s aside, its thread or parent is unknown",
+                                      cid)
+                    failed.setdefault(cid, 0)
+                elif result is not None:
+                    thread_id, post_id = result
+                    self.storage.generations.touch_thread(thread_id)
+                    self.storage.events.publish(thread_id, post_id)
+                    imported += 1
+        return imported
+
+    def sync_all(self, peers: list = None, full: bool = False) -> int:
+        """
+        Pull from every peer, the community of the storage of the replicator
+        :param peers: Base urls of the peer nodes, the configured ones if None
+        :return: Number of posts imported
+        """
+        imported = 0
+        if peers is None:
+            peers = self.storage.settings["sync"]["peers"]
+        for url in [peer_url(peer, self.storage.community) for peer in peers]:
+            try:
+                count = self.sync_peer(url, full)
+            except Exception as error:  # pylint: disable=broad-except
+                self.logger.warning("Unable to sync with %s: %s", url, error)
+                continue
+            if count:
+                self.logger.info("Imported %d posts from %s", count, url)
+            imported += count
+        return imported
+
+
+class SyncTask:
+    """Run the replicator every interval seconds in a background thread"""
+    def __init__(self, replicator: Replicator, interval: float):
+        self.replicator = replicator
+        self.interval = interval
+        self.logger = logging.getLogger("kamina")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="kamina-sync", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.replicator.sync_all()
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception("Sync failed")
+            self._stop.wait(self.interval)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
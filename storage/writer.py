@@ -0,0 +1,119 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+writer.py - Group commit of concurrent writes to the local database
+"""
+
+import os
+import time
+import queue
+import threading
+import logging
+
+from storage.database import Database
+from kamina.metrics import Gauge, Histogram
+
+PENDING_WRITES = Gauge("kamina_pending_writes", "Writes waiting for their batch to be committed")
+BATCH_SIZE = Histogram("kamina_write_batch_size", "Writes committed together",
+                       buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+class PendingWrite:
+    """A write waiting for its batch to be committed"""
+    __slots__ = ("func", "args", "done", "result", "error")
+
+    def __init__(self, func, args: tuple):
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WriteCoalescer:
+    """
+    Queue writes coming from every request thread and commit them together,
+    once flush_interval has passed since the first one or batch_size of them
+    are waiting, whichever comes first.
+    """
+    def __init__(self, database: Database, flush_interval: float, batch_size: int):
+        self.database = database
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.logger = logging.getLogger("kamina")
+        self._queue = queue.Queue()
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """
+        Queue a write and wait until its batch is committed
+        :param func: Write function, called as func(conn, now, *args)
+        :return: Whatever func returned, its exception is raised here
+        """
+        self._ensure_thread()
+        pending = PendingWrite(func, args)
+        PENDING_WRITES.inc()
+        self._queue.put(pending)
+        pending.done.wait()
+        PENDING_WRITES.dec()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def pending(self) -> int:
+        """Writes queued in this process, not yet picked up by a batch"""
+        return self._queue.qsize()
+
+    def _ensure_thread(self):
+        # Threads don't survive the fork of uWSGI workers, start one per process
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                thread = threading.Thread(target=self._run, name="kamina-writer", daemon=True)
+                thread.start()
+                self._pid = os.getpid()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            BATCH_SIZE.observe(len(batch))
+            try:
+                results = self.database.run_batch([(item.func, item.args) for item in batch])
+            except Exception as error:  # pylint: disable=broad-except
+                self.logger.exception("Unable to commit a batch of %d writes", len(batch))
+                results = [(None, error)] * len(batch)
+            for item, (result, error) in zip(batch, results):
+                item.result = result
+                item.error = error
+                item.done.set()
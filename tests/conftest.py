@@ -0,0 +1,55 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+
+"""
+conftest.py - Fixtures shared by the tests
+Every test gets a node of its own: a throwaway configuration and node_dir,
+served by a fake ipfs daemon, see bench/common.py.
+"""
+
+import pytest
+
+from bench.common import bench_environment
+from kamina.config import KaminaConfiguration
+from storage.shards import Shards
+from storage.ipfs import IPFSClient
+
+
+@pytest.fixture
+def node():
+    """Tuple of (base dir of the node, its FakeIPFS)"""
+    with bench_environment() as environment:
+        yield environment
+
+
+@pytest.fixture
+def settings(node):
+    return KaminaConfiguration(node[0]).conf
+
+
+@pytest.fixture
+def storage(settings):
+    """Storage of the own community of the node"""
+    return Shards(settings).get()
+
+
+@pytest.fixture
+def ipfs(node):
+    """Tuple of (IPFSClient talking to the fake daemon, the FakeIPFS)"""
+    return IPFSClient("127.0.0.1", node[1].port, 4, 5), node[1]
@@ -0,0 +1,132 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+
+"""
+test_api.py - Requests to the api, through the flask test client
+"""
+
+import time
+
+import pytest
+
+import backend.api
+from backend.api import API
+from storage.ranking import Ranker
+from storage.database import hot_add, hot_at, DEFAULT_HALF_LIFE
+
+
+@pytest.fixture
+def api(node):
+    api = API(node[0])
+    # Keeps the hot scores, part of the cache keys, from moving mid test
+    api.conf["ranking"]["hot_refresh"] = 24 * 3600
+    return api
+
+
+@pytest.fixture
+def client(api):
+    return api.app.test_client()
+
+
+@pytest.mark.parametrize("body", [[1, 2], "text", 3])
+def test_json_bodies_must_be_objects(client, body):
+    assert client.post("/api/make_post", json=body).status_code == 400
+
+
+def test_json_and_form_posts(client):
+    made = client.post("/api/make_post", json={"title": "Thread", "body": "Body"}).get_json()
+    reply = client.post("/api/make_response", data={"thread_id": made["thread_id"],
+                                                    "parent_id": made["post_id"],
+                                                    "body": "Reply"})
+    assert reply.status_code == 200
+    assert client.post("/api/make_response", json={"thread_id": made["thread_id"],
+                                                   "body": ["not", "text"]}).status_code == 400
+    assert client.post("/api/make_response", json={"thread_id": made["thread_id"] + 1,
+                                                   "body": "Reply"}).status_code == 404
+
+
+def test_etags(client):
+    made = client.post("/api/make_post", json={"title": "Thread", "body": "Body"}).get_json()
+    url = "/api/get_single_thread?id=%d" % made["thread_id"]
+    first = client.get(url)
+    # Set on the response that filled the cache too
+    etag = first.headers["ETag"]
+    assert etag
+    cached = client.get(url)
+    assert cached.headers["ETag"] == etag and cached.data == first.data
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    client.post("/api/make_response", json={"thread_id": made["thread_id"], "body": "Reply"})
+    changed = client.get(url, headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    listing = client.get("/api/get_all_threads")
+    assert client.get("/api/get_all_threads",
+                      headers={"If-None-Match": listing.headers["ETag"]}).status_code == 304
+
+
+def test_hot_at():
+    now = time.time()
+    score = hot_add(hot_add(None, now - 3600, 3600), now - 3600, 3600)
+    # Two posts an hour old with an hour of half life count as one new post
+    assert hot_at(score, now, 3600) == pytest.approx(0)
+    assert hot_at(score, now + 3600, 3600) == pytest.approx(-1)
+    assert hot_at(None, now, 3600) is None
+
+
+def test_served_hot_scores_decay(api, client, monkeypatch):
+    api.conf["ranking"]["hot_refresh"] = 1
+    half_life = api.conf["ranking"]["hot_half_life"] * 3600
+    quiet = client.post("/api/make_post", json={"title": "Quiet", "body": "Body"}).get_json()
+    busy = client.post("/api/make_post", json={"title": "Busy", "body": "Body"}).get_json()
+    for _ in range(3):
+        client.post("/api/make_response", json={"thread_id": busy["thread_id"], "body": "Reply"})
+    now = time.time()
+    listing = client.get("/api/get_all_threads?sort=hot").get_json()["threads"]
+    assert [thread["id"] for thread in listing] == [busy["thread_id"], quiet["thread_id"]]
+    assert listing[0]["hot"] == pytest.approx(2, abs=0.01)
+    assert listing[1]["hot"] == pytest.approx(0, abs=0.01)
+
+    monkeypatch.setattr(backend.api.time, "time", lambda: now + 2 * half_life)
+    later = client.get("/api/get_all_threads?sort=hot").get_json()["threads"]
+    assert [thread["id"] for thread in later] == [busy["thread_id"], quiet["thread_id"]]
+    assert later[0]["hot"] == pytest.approx(0, abs=0.01)
+    assert later[1]["hot"] == pytest.approx(-2, abs=0.01)
+    thread = client.get("/api/get_single_thread?id=%d" % quiet["thread_id"]).get_json()
+    assert thread["hot"] == pytest.approx(-2, abs=0.01)
+
+
+def test_hot_scores_use_the_stored_half_life(api, client, monkeypatch):
+    api.conf["ranking"]["hot_refresh"] = 1
+    made = client.post("/api/make_post", json={"title": "Thread", "body": "Body"}).get_json()
+    # A reload changed hot_half_life, the daemon hasn't rescored the threads yet
+    api.conf["ranking"]["hot_half_life"] = 1
+    half_life = api.storage.get_hot_half_life()
+    assert half_life == DEFAULT_HALF_LIFE
+    now = time.time()
+    monkeypatch.setattr(backend.api.time, "time", lambda: now + half_life)
+    thread = client.get("/api/get_single_thread?id=%d" % made["thread_id"]).get_json()
+    assert thread["hot"] == pytest.approx(-1, abs=0.01)
+    listing = client.get("/api/get_all_threads?sort=hot").get_json()["threads"]
+    assert listing[0]["hot"] == pytest.approx(-1, abs=0.01)
+
+    # Until the daemon rescores them with the new one
+    assert Ranker(api.storage, api.conf).rescore() == 1
+    assert api.storage.get_hot_half_life() == 3600
+    monkeypatch.setattr(backend.api.time, "time", lambda: now + 3600)
+    thread = client.get("/api/get_single_thread?id=%d" % made["thread_id"]).get_json()
+    assert thread["hot"] == pytest.approx(-1, abs=0.01)
@@ -0,0 +1,122 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+
+"""
+test_archive.py - Exporting a community to an archive and importing it on another node
+"""
+
+import os
+
+import pytest
+
+from bench.common import bench_environment
+from bench.sync import seed, posts_of
+from kamina.config import KaminaConfiguration
+from storage.archive import Exporter, Importer, ArchiveError, set_variant
+from storage.outbox import OutboxDrainer
+from storage.shards import Shards
+
+
+@pytest.fixture
+def exported(storage, settings, tmp_path):
+    """Tuple of (storage, settings, path of its archive, CIDs of its uploads)"""
+    settings["archive"]["batch_size"] = 7
+    seed(storage, 20, 4)
+    OutboxDrainer(storage, settings).drain()
+    uploads = []
+    for index in range(5):
+        blob = os.urandom(20000 + index)
+        cid = storage.ipfs_conn.add(blob)
+        storage.record_upload(cid, "image/png", len(blob))
+        uploads.append(cid)
+    thumbnail = storage.ipfs_conn.add(b"thumbnail")
+    storage.database.run_batch([(set_variant, (uploads[0], "thumbnail", thumbnail,
+                                               "image/png", None))])
+    path = str(tmp_path / "community.karc")
+    assert Exporter(storage, settings).export(path) == (20 * 5, 5)
+    return storage, settings, path, uploads
+
+
+@pytest.fixture
+def other_node():
+    """Settings of an empty node, with an ipfs daemon of its own"""
+    with bench_environment() as (base_dir, _):
+        settings = KaminaConfiguration(base_dir).conf
+        settings["archive"]["transaction_size"] = 16
+        yield settings
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as archive:
+        return archive.read()
+
+
+def test_interrupted_export_resumes(exported):
+    storage, settings, path, _ = exported
+    whole = read(path)
+    assert Exporter(storage, settings).export(path) == (0, 0)
+    # Cut in the posts, in the uploads and in the index
+    for cut in (len(whole) // 10, len(whole) - 50000, len(whole) - 100):
+        with open(path, "wb") as archive:
+            archive.write(whole[:cut])
+        Exporter(storage, settings).export(path)
+        assert read(path) == whole
+
+
+def test_import(exported, other_node):
+    storage, settings, path, uploads = exported
+    imported = Shards(other_node).get()
+    assert Importer(imported, other_node).import_archive(path) == (20 * 5, 5)
+    assert posts_of(other_node) == posts_of(settings)
+    for cid in uploads:
+        assert imported.get_media(cid) == storage.get_media(cid)
+        assert imported.get_object(cid) == storage.get_object(cid)
+    assert imported.get_media_variant(uploads[0], "thumbnail")[0] is not None
+    # Importing it again writes nothing
+    assert Importer(imported, other_node).import_archive(path) == (0, 0)
+
+
+def test_interrupted_import_resumes(exported, other_node):
+    storage, settings, path, _ = exported
+    imported = Shards(other_node).get()
+    run_batch = imported.database.run_batch
+    batches = []
+
+    def failing(operations):
+        batches.append(len(operations))
+        if len(batches) == 3:
+            raise RuntimeError("interrupted")
+        return run_batch(operations)
+
+    imported.database.run_batch = failing
+    with pytest.raises(RuntimeError):
+        Importer(imported, other_node).import_archive(path)
+    imported.database.run_batch = run_batch
+    posts, uploads = Importer(imported, other_node).import_archive(path)
+    # The two transactions committed before the failure aren't written again
+    assert (posts, uploads) == (20 * 5 - 2 * 16, 5)
+    assert posts_of(other_node) == posts_of(settings)
+
+
+def test_incomplete_archive_is_refused(exported, other_node):
+    _, _, path, _ = exported
+    with open(path, "r+b") as archive:
+        archive.truncate(os.path.getsize(path) - 10)
+    with pytest.raises(ArchiveError):
+        Importer(Shards(other_node).get(), other_node).import_archive(path)
@@ -0,0 +1,97 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+test_cache.py - Size bound and eviction of the disk cache
+"""
+
+import os
+import multiprocessing
+
+from storage.cache import DiskCache
+
+MAX_SIZE = 64 * 1024
+
+
+def _directory_size(directory: str) -> int:
+    return DiskCache(directory, MAX_SIZE)._scan_size()
+
+
+def _write(directory: str, writer: int, barrier) -> None:
+    """Fill the cache with objects of 1 to 4 KiB, as a process of its own"""
+    cache = DiskCache(directory, MAX_SIZE)
+    barrier.wait()
+    for index in range(200):
+        cache.put("cid-%d-%03d" % (writer, index), os.urandom(1024 * (1 + index % 4)))
+
+
+def test_bound_holds_with_several_writers(tmp_path):
+    directory = str(tmp_path / "cache")
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(4)
+    writers = [context.Process(target=_write, args=(directory, writer, barrier))
+               for writer in range(4)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join(60)
+        assert writer.exitcode == 0
+
+    # 4 processes wrote 2 MiB between them, 32 times the bound
+    actual = _directory_size(directory)
+    assert 0 < actual <= MAX_SIZE
+    # Every process counted into the same total, which never runs behind
+    assert DiskCache(directory, MAX_SIZE).size >= actual
+
+
+def test_bound_holds_after_every_write(tmp_path):
+    directory = str(tmp_path / "cache")
+    # Two writers of the same directory, like two uWSGI workers
+    caches = DiskCache(directory, 10 * 1024), DiskCache(directory, 10 * 1024)
+    for index in range(30):
+        caches[index % 2].put("cid-%d" % index, b"x" * 1024)
+        assert _directory_size(directory) <= 10 * 1024
+        assert caches[0].size == caches[1].size == _directory_size(directory)
+
+
+def test_size_counts_objects_cached_before(tmp_path):
+    directory = str(tmp_path / "cache")
+    os.makedirs(os.path.join(directory, "ab"))
+    with open(os.path.join(directory, "ab", "Qmab"), "wb") as cached:
+        cached.write(b"x" * 1000)
+
+    cache = DiskCache(directory, MAX_SIZE)
+    assert cache.size == 1000
+    cache.put("Qmcd", b"y" * 500)
+    assert DiskCache(directory, MAX_SIZE).size == 1500
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(str(tmp_path), 10 * 1024)
+    for index in range(9):
+        cache.put("cid-%d" % index, b"x" * 1024)
+        # mtimes are the access times, keep them apart
+        os.utime(cache._path("cid-%d" % index), (index, index))
+    cache.get("cid-0")
+
+    cache.put("cid-9", b"x" * 2048)
+    assert cache.size <= 9 * 1024
+    assert cache.size == _directory_size(str(tmp_path))
+    assert cache.get("cid-0") is not None
+    assert cache.get("cid-1") is None
+    assert cache.get("cid-9") is not None
@@ -0,0 +1,167 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+test_config.py - Configuration snapshots, reloads and the hangup signal asking for them
+"""
+
+import os
+import signal
+import logging
+from pathlib import PurePath
+
+import yaml
+import pytest
+
+from kamina.config import KaminaConfiguration, CACHE_FILE
+from kamina.process import KaminaProcess
+
+
+def _edit(base_dir: str, edit) -> None:
+    """
+    Change kamina.yaml of a node, edit gets its parsed content
+    Its mtime is moved a second ahead, two writes in a row may otherwise
+    share one on filesystems with a coarse clock.
+    """
+    conf_path = os.path.join(base_dir, "conf", "kamina.yaml")
+    with open(conf_path, "rt") as conf_file:
+        conf = yaml.safe_load(conf_file)
+    edit(conf)
+    _write(conf_path, yaml.safe_dump(conf, default_flow_style=False))
+
+
+def _write(path: str, text: str) -> None:
+    mtime = os.stat(path).st_mtime_ns
+    with open(path, "wt") as conf_file:
+        conf_file.write(text)
+    os.utime(path, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+
+
+@pytest.fixture
+def kamina_conf(node, caplog):
+    kamina_conf = KaminaConfiguration(node[0])
+    # Propagates to pytest, which the configured kamina logger doesn't
+    kamina_conf.logger = logging.getLogger("kamina-test.config")
+    caplog.set_level(logging.INFO, "kamina-test.config")
+    return kamina_conf
+
+
+def test_snapshot_saved_then_reused(node, monkeypatch):
+    conf = KaminaConfiguration(node[0]).conf
+    assert os.path.isfile(os.path.join(node[0], "conf", CACHE_FILE))
+
+    def parse(*_):
+        raise AssertionError("Parsed although the snapshot is up to date")
+
+    monkeypatch.setattr(KaminaConfiguration, "_parse", parse)
+    assert KaminaConfiguration(node[0]).conf == conf
+
+
+def test_snapshot_outdated_by_edits(node):
+    KaminaConfiguration(node[0])
+    _edit(node[0], lambda conf: conf["api"].update(page_size=7))
+    assert KaminaConfiguration(node[0]).conf["api"]["page_size"] == 7
+
+
+def test_snapshot_outdated_by_another_home(node, monkeypatch, tmp_path):
+    conf = KaminaConfiguration(node[0]).conf
+    assert conf["ipfs"]["install_dir"].startswith(os.path.expanduser("~"))
+    monkeypatch.setenv("HOME", str(tmp_path))
+    conf = KaminaConfiguration(node[0]).conf
+    assert conf["ipfs"]["install_dir"] == str(PurePath(tmp_path, ".kamina", "go-ipfs"))
+
+
+def test_broken_snapshot_parsed_again(node):
+    conf = KaminaConfiguration(node[0]).conf
+    _write(os.path.join(node[0], "conf", CACHE_FILE), '{"key": ')
+    assert KaminaConfiguration(node[0]).conf == conf
+
+
+def test_invalid_configuration_at_start(node):
+    _write(os.path.join(node[0], "conf", "kamina.yaml"), "api: [page_size: 1\n")
+    with pytest.raises(SystemExit):
+        KaminaConfiguration(node[0])
+
+
+def test_reload_updates_conf_in_place(kamina_conf, node):
+    conf = kamina_conf.conf
+    api = conf["api"]
+    # Nothing changed
+    assert not kamina_conf.reload()
+
+    def edit(parsed: dict):
+        parsed["api"]["page_size"] = 7
+        del parsed["archive"]
+
+    _edit(node[0], edit)
+    assert kamina_conf.reload()
+    assert kamina_conf.conf is conf
+    assert conf["api"]["page_size"] == 7
+    assert "archive" not in conf
+    # Sections are replaced, not changed, the old one is left as it was for whoever held it
+    assert api["page_size"] == 50
+    # Logging was set up again, from logging.yaml
+    assert kamina_conf.logger is logging.getLogger("kamina")
+    assert not kamina_conf.reload()
+
+
+def test_reload_keeps_overrides(kamina_conf, node):
+    kamina_conf.set_override("api", "page_size", 3)
+    _edit(node[0], lambda conf: conf["api"].update(max_page_size=30))
+    assert kamina_conf.reload()
+    assert kamina_conf.conf["api"]["page_size"] == 3
+    assert kamina_conf.conf["api"]["max_page_size"] == 30
+
+
+def test_invalid_reload_keeps_the_old_conf(kamina_conf, node, caplog):
+    conf_path = os.path.join(node[0], "conf", "kamina.yaml")
+    with open(conf_path, "rt") as conf_file:
+        valid = conf_file.read()
+    before = {section: dict(values) for section, values in kamina_conf.conf.items()}
+    _write(conf_path, "api: [page_size: 1\n")
+    assert not kamina_conf.reload()
+    assert kamina_conf.conf == before
+    assert "Not reloading configuration: Error parsing kamina.yaml" in caplog.messages
+
+    # Same when the file is gone, the fixed one is picked up
+    os.rename(conf_path, conf_path + ".old")
+    assert not kamina_conf.reload()
+    assert kamina_conf.conf == before
+    os.rename(conf_path + ".old", conf_path)
+    _write(conf_path, valid.replace("page_size: 50", "page_size: 8"))
+    assert kamina_conf.reload()
+    assert kamina_conf.conf["api"]["page_size"] == 8
+
+
+def test_hangup_reloads(kamina_conf, node):
+    process = KaminaProcess(kamina_conf.conf, kamina_conf)
+    previous = {signum: signal.getsignal(signum)
+                for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)}
+    try:
+        process.setup_sighandlers()
+        _edit(node[0], lambda conf: conf["api"].update(page_size=9))
+        os.kill(os.getpid(), signal.SIGHUP)
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+    # Only asked for, the main loop does the reload
+    assert process.reload_requested
+    assert kamina_conf.conf["api"]["page_size"] == 50
+    process.reload()
+    assert not process.reload_requested
+    assert process.conf["api"]["page_size"] == 9
@@ -0,0 +1,186 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+
+"""
+test_download.py - Resumable downloads, against a local http server
+"""
+
+import os
+import re
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from kamina import download
+from kamina.download import Download, DownloadError
+
+RANGE_RE = re.compile(r"bytes=(\d+)-(\d+)")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Serves server.content, with range requests, ETag and If-Range like a static server"""
+    def log_message(self, *_):
+        pass
+
+    def _headers(self, code: int, length: int, extra: dict = None):
+        server = self.server
+        self.send_response(code)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", server.etag)
+        if server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        for name, value in (extra or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        server = self.server
+        self._headers(200, len(server.content))
+        if server.replacement is not None:
+            # The file changes right after the download started
+            server.content, server.replacement = server.replacement, None
+            server.etag = '"%s"' % hashlib.sha1(server.content).hexdigest()
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        server = self.server
+        with server.lock:
+            server.gets += 1
+            cut = server.fail_after is not None and server.gets > server.fail_after
+        content = server.content
+        match = RANGE_RE.match(self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        if server.ranges and match and (if_range is None or if_range == server.etag):
+            start, end = int(match.group(1)), int(match.group(2))
+            body = content[start:end + 1]
+            self._headers(206, len(body), {
+                "Content-Range": "bytes %d-%d/%d" % (start, end, len(content))})
+        else:
+            body = content
+            self._headers(200, len(body))
+        if cut:
+            # The connection drops halfway through the body
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class FileServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, content: bytes):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.content = content
+        self.etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        self.ranges = True
+        self.replacement = None
+        self.fail_after = None
+        self.gets = 0
+        self.lock = threading.Lock()
+        self.url = "http://127.0.0.1:%d/go-ipfs.tar.gz" % self.server_address[1]
+
+
+@pytest.fixture
+def server():
+    content = os.urandom(10 * 64 * 1024 + 123)
+    file_server = FileServer(content)
+    thread = threading.Thread(target=file_server.serve_forever, daemon=True)
+    thread.start()
+    yield file_server
+    file_server.shutdown()
+    file_server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def small_parts(monkeypatch):
+    monkeypatch.setattr(download, "PART_SIZE", 64 * 1024)
+    monkeypatch.setattr(download, "CHUNK_SIZE", 16 * 1024)
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def test_download_in_parts(server, tmp_path):
+    destination = str(tmp_path / "archive")
+    digest = Download(server.url, destination, 4, 5).run(sha256(server.content))
+    assert digest == sha256(server.content)
+    assert read(destination) == server.content
+    assert server.gets == 11
+    assert os.listdir(str(tmp_path)) == ["archive"]
+
+
+def test_interrupted_download_resumes(server, tmp_path):
+    destination = str(tmp_path / "archive")
+    server.fail_after = 4
+    with pytest.raises(DownloadError):
+        Download(server.url, destination, 1, 5).run(sha256(server.content))
+    assert not os.path.exists(destination)
+    assert os.path.exists(destination + ".part.json")
+    server.fail_after = None
+    server.gets = 0
+    Download(server.url, destination, 4, 5).run(sha256(server.content))
+    assert read(destination) == server.content
+    # Only the parts missing from the first attempt
+    assert server.gets == 11 - 4
+
+
+def test_changed_file_starts_over(server, tmp_path):
+    destination = str(tmp_path / "archive")
+    server.fail_after = 4
+    with pytest.raises(DownloadError):
+        Download(server.url, destination, 1, 5).run(sha256(server.content))
+    server.fail_after = None
+    server.content = os.urandom(len(server.content))
+    server.etag = '"%s"' % sha256(server.content)
+    Download(server.url, destination, 4, 5).run(sha256(server.content))
+    assert read(destination) == server.content
+
+
+def test_file_changing_during_the_download_starts_over(server, tmp_path):
+    destination = str(tmp_path / "archive")
+    replacement = os.urandom(len(server.content) + 1000)
+    server.replacement = replacement
+    # The first probe sees the old file, every range request the new one
+    Download(server.url, destination, 4, 5).run(sha256(replacement))
+    assert read(destination) == replacement
+    # Range requests answered with the whole new file, then the new parts
+    assert server.gets > 11
+
+
+def test_checksum_mismatch(server, tmp_path):
+    destination = str(tmp_path / "archive")
+    with pytest.raises(DownloadError):
+        Download(server.url, destination, 4, 5).run(sha256(b"something else"))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_server_without_ranges(server, tmp_path):
+    destination = str(tmp_path / "archive")
+    server.ranges = False
+    Download(server.url, destination, 4, 5).run(sha256(server.content).upper())
+    assert read(destination) == server.content
+    assert server.gets == 1
@@ -0,0 +1,209 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+test_events.py - The event bus, and thread event streams served by flask and asgi
+"""
+
+import json
+import socket
+import asyncio
+import threading
+
+import pytest
+
+from backend.api import API
+from backend.asgi import ASGIApp
+from storage.events import EventBus
+
+
+@pytest.fixture
+def api(node):
+    return API(node[0])
+
+
+@pytest.fixture
+def client(api):
+    return api.app.test_client()
+
+
+def _thread(client, replies: int) -> tuple:
+    """
+    Make a thread with some replies
+    :return: Tuple of (thread id, ids of its posts, oldest first)
+    """
+    made = client.post("/api/make_post", json={"title": "Thread", "body": "Body"}).get_json()
+    ids = [made["post_id"]]
+    for index in range(replies):
+        ids.append(_reply(client, made["thread_id"], index))
+    return made["thread_id"], ids
+
+
+def _reply(client, thread_id: int, index: int = 0) -> int:
+    reply = client.post("/api/make_response",
+                        json={"thread_id": thread_id, "body": "Reply %d" % index})
+    return reply.get_json()["post_id"]
+
+
+def _event_ids(body: str) -> list:
+    return [json.loads(line[len("data: "):])["id"]
+            for line in body.splitlines() if line.startswith("data: ")]
+
+
+def test_bus_wakes_subscribers_of_the_thread(tmp_path):
+    bus = EventBus(str(tmp_path))
+    subscription = bus.subscribe(1)
+    other = bus.subscribe(2)
+    try:
+        bus.publish(1, 10)
+        assert subscription.wait(5)
+        assert not other.wait(0.1)
+        # Cleared once waited on
+        assert not subscription.wait(0.1)
+    finally:
+        bus.unsubscribe(subscription)
+        bus.unsubscribe(other)
+    assert not bus._subscriptions
+
+
+def test_bus_forgets_processes_gone(tmp_path):
+    # Bound by a process which then died without unlinking its socket
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale.bind(str(tmp_path / "99999999.sock"))
+    stale.close()
+    bus = EventBus(str(tmp_path))
+    bus.publish(1, 10)
+    assert not (tmp_path / "99999999.sock").exists()
+
+
+def test_bus_wakes_subscribers_on_a_loop(tmp_path):
+    bus = EventBus(str(tmp_path))
+
+    async def wait():
+        subscription = bus.subscribe(1, asyncio.get_event_loop())
+        try:
+            assert not await subscription.wait(0.05)
+            # Published from another thread, as the receiving thread of the bus sets it
+            threading.Timer(0.05, bus.publish, (1, 10)).start()
+            assert await subscription.wait(5)
+        finally:
+            bus.unsubscribe(subscription)
+
+    asyncio.run(wait())
+
+
+def test_flask_stream_resumes_after_last_event_id(api, client):
+    thread_id, ids = _thread(client, 3)
+    response = client.get("/api/threads/%d/events" % thread_id,
+                          headers={"Last-Event-ID": str(ids[1])})
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    chunks = iter(response.response)
+    assert next(chunks).startswith(b"retry: ")
+    body = b"".join(next(chunks) for _ in ids[2:]).decode("utf8")
+    assert _event_ids(body) == ids[2:]
+    assert api.streams == 1
+    response.close()
+    assert api.streams == 0
+
+
+def test_flask_streams_are_capped(api, client):
+    thread_id, _ = _thread(client, 0)
+    api.conf["events"]["max_streams"] = 0
+    response = client.get("/api/threads/%d/events" % thread_id)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(api.conf["events"]["retry"])
+
+
+def test_flask_stream_of_unknown_thread(client):
+    assert client.get("/api/threads/12345/events").status_code == 404
+
+
+async def _stream(app: ASGIApp, path: str, headers: dict, done) -> tuple:
+    """
+    Request path from app as a client which leaves once done(body) is true
+    :return: Tuple of (status, body received)
+    """
+    gone = asyncio.Event()
+    sent = []
+    scope = {"type": "http", "method": "GET", "path": path, "query_string": b"",
+             "http_version": "1.1", "scheme": "http", "client": ("127.0.0.1", 50000),
+             "server": ("127.0.0.1", 1337),
+             "headers": [(name.lower().encode("latin1"), value.encode("latin1"))
+                         for name, value in headers.items()]}
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await gone.wait()
+        return {"type": "http.disconnect"}
+
+    def body() -> str:
+        return b"".join(message.get("body", b"") for message in sent[1:]).decode("utf8")
+
+    async def send(message):
+        sent.append(message)
+        if message["type"] == "http.response.body" and done(body()):
+            gone.set()
+
+    await asyncio.wait_for(app(scope, receive, send), 10)
+    return sent[0]["status"], body()
+
+
+def test_asgi_stream_resumes_then_follows_the_thread(api, client):
+    app = ASGIApp(api)
+    thread_id, ids = _thread(client, 2)
+    bus = api.storage.events
+    followed = []
+
+    def done(body: str) -> bool:
+        received = _event_ids(body)
+        if received == ids[2:] and not followed:
+            # Caught up, the next post arrives while the stream waits on the loop
+            followed.append(None)
+            threading.Thread(target=lambda: followed.append(_reply(client, thread_id))).start()
+        return len(received) > len(ids[2:])
+
+    async def request():
+        try:
+            return await _stream(app, "/api/threads/%d/events" % thread_id,
+                                 {"Last-Event-ID": str(ids[1])}, done)
+        finally:
+            app.executor.shutdown()
+
+    status, body = asyncio.run(request())
+    assert status == 200
+    assert body.startswith("retry: ")
+    assert _event_ids(body) == ids[2:] + followed[1:]
+    # Unsubscribed once the client left
+    assert not bus._subscriptions
+
+
+def test_asgi_stream_of_unknown_thread(api):
+    app = ASGIApp(api)
+
+    async def request():
+        try:
+            return await _stream(app, "/api/threads/12345/events", {}, lambda _: True)
+        finally:
+            app.executor.shutdown()
+
+    assert asyncio.run(request())[0] == 404
@@ -0,0 +1,118 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+
+"""
+test_install.py - kcn init --install-ipfs, against a local dist server
+"""
+
+import io
+import os
+import json
+import hashlib
+import tarfile
+import threading
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+
+from kamina.process import KaminaProcess
+from kamina.cli_commands.basic import BasicCommands, ipfs_archive_name
+
+
+class _Handler(SimpleHTTPRequestHandler):
+    def log_message(self, *_):
+        pass
+
+
+def make_archive() -> bytes:
+    """A go-ipfs release archive holding a fake binary"""
+    binary = b"#!/bin/sh\necho fake ipfs\n"
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as archive:
+        info = tarfile.TarInfo("go-ipfs/ipfs")
+        info.size = len(binary)
+        info.mode = 0o755
+        archive.addfile(info, io.BytesIO(binary))
+    return data.getvalue()
+
+
+@pytest.fixture
+def dist(tmp_path):
+    """Tuple of (url of the dist server, directory of the release, archive name, archive)"""
+    version = "v0.4.14"
+    name = ipfs_archive_name(version)
+    release = tmp_path / "dist" / "go-ipfs" / version
+    release.mkdir(parents=True)
+    archive = make_archive()
+    (release / name).write_bytes(archive)
+    handler = functools.partial(_Handler, directory=str(tmp_path / "dist"))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:%d" % server.server_address[1], release, name, archive
+    server.shutdown()
+    server.server_close()
+
+
+def install(settings: dict, dist_url: str, tmp_path) -> str:
+    settings["ipfs"]["dist_url"] = dist_url
+    settings["ipfs"]["download_cache"] = str(tmp_path / "cache")
+    install_dir = str(tmp_path / "go-ipfs")
+    BasicCommands(KaminaProcess(settings))._install_ipfs(install_dir)
+    return install_dir
+
+
+def test_default_configuration_uses_the_published_checksum(settings, dist, tmp_path):
+    url, release, name, archive = dist
+    # The default configuration names no digest
+    assert settings["ipfs"]["version"] == "v0.4.14" and not settings["ipfs"]["sha256"]
+    (release / (name + ".sha512")).write_text(
+        "%s  %s\n" % (hashlib.sha512(archive).hexdigest(), name))
+    install_dir = install(settings, url, tmp_path)
+    assert os.path.isfile(os.path.join(install_dir, "ipfs"))
+
+
+def test_digest_listed_in_dist_json(settings, dist, tmp_path):
+    url, release, name, archive = dist
+    (release / "dist.json").write_text(json.dumps({"id": "go-ipfs", "platforms": {
+        "linux": {"archs": {"amd64": {"link": "/" + name,
+                                      "sha512": hashlib.sha512(archive).hexdigest()}}}}}))
+    assert os.path.isfile(os.path.join(install(settings, url, tmp_path), "ipfs"))
+
+
+def test_configured_digest(settings, dist, tmp_path):
+    url, _, name, archive = dist
+    settings["ipfs"]["sha256"] = {name: hashlib.sha256(archive).hexdigest()}
+    assert os.path.isfile(os.path.join(install(settings, url, tmp_path), "ipfs"))
+
+
+def test_nothing_published(settings, dist, tmp_path):
+    with pytest.raises(SystemExit):
+        install(settings, dist[0], tmp_path)
+    assert not os.path.exists(str(tmp_path / "go-ipfs"))
+
+
+def test_published_digest_mismatch(settings, dist, tmp_path):
+    url, release, name, _ = dist
+    (release / (name + ".sha512")).write_text(hashlib.sha512(b"other").hexdigest())
+    with pytest.raises(SystemExit):
+        install(settings, url, tmp_path)
+    assert not os.path.exists(str(tmp_path / "go-ipfs"))
+    assert os.listdir(str(tmp_path / "cache" / "go-ipfs" / "v0.4.14")) == []
@@ -0,0 +1,59 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+
+"""
+test_ipfs.py - The pooled ipfs client
+"""
+
+import pytest
+
+from storage.ipfs import IPFSClient, IPFSUnavailable, IPFSError
+from utils.fake_ipfs import fake_cid
+
+
+def test_add_many_keeps_the_order_of_the_blobs(ipfs):
+    client, daemon = ipfs
+    blobs = [b"blob %d" % index for index in range(20)]
+    assert client.add_many(blobs) == [fake_cid(blob) for blob in blobs]
+    # A single request for the whole batch
+    assert daemon.calls["/api/v0/add"] == 1
+    assert client.add_many([]) == []
+
+
+def test_cat_many_keeps_the_order_of_the_cids(ipfs):
+    client, _ = ipfs
+    blobs = [b"blob %d" % index for index in range(20)]
+    cids = client.add_many(blobs)
+    assert client.cat_many(list(reversed(cids))) == list(reversed(blobs))
+    assert client.cat(cids[0]) == blobs[0]
+
+
+def test_errors_of_the_daemon(ipfs):
+    client, daemon = ipfs
+    with pytest.raises(IPFSError):
+        client.cat(fake_cid(b"never added"))
+    daemon.online = False
+    with pytest.raises(IPFSError):
+        client.version()
+
+
+def test_unreachable_daemon():
+    # Nothing listens on port 9 of the loopback
+    with pytest.raises(IPFSUnavailable):
+        IPFSClient("127.0.0.1", 9, 1, 1).version()
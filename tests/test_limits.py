@@ -0,0 +1,192 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+test_limits.py - Token buckets, in-flight counts, and the api with rate limiting on
+The test nodes have rate limiting turned off, the api tests here turn it
+back on in the configuration of their node.
+"""
+
+import os
+import multiprocessing
+
+import yaml
+import pytest
+
+from backend import limits
+from backend.api import API
+from backend.limits import TokenBuckets, InFlightTable
+
+
+class Clock:
+    """Stands in for the time module of backend.limits"""
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(limits, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def api(node, clock):
+    conf_path = os.path.join(node[0], "conf", "kamina.yaml")
+    with open(conf_path, "rt") as conf_file:
+        conf = yaml.safe_load(conf_file)
+    conf["limits"]["rate_limiting"] = True
+    conf["limits"]["rules"]["read"] = {"rate": 0.5, "burst": 2}
+    conf["limits"]["rules"]["write"] = {"rate": 1, "burst": 1}
+    with open(conf_path, "wt") as conf_file:
+        yaml.safe_dump(conf, conf_file, default_flow_style=False)
+    return API(node[0])
+
+
+@pytest.fixture
+def client(api):
+    return api.app.test_client()
+
+
+def _read(client, address: str = "10.0.0.1", **headers):
+    return client.get("/api/get_all_threads", environ_base={"REMOTE_ADDR": address},
+                      headers=headers)
+
+
+def test_bucket_burst_then_refill(tmp_path, clock):
+    buckets = TokenBuckets(str(tmp_path / "buckets"), 64)
+    assert [buckets.take("client", 2, 3) for _ in range(3)] == [0, 0, 0]
+    # Empty, the next token comes in 1/rate seconds
+    assert buckets.take("client", 2, 3) == pytest.approx(0.5)
+    clock.now += 0.25
+    assert buckets.take("client", 2, 3) == pytest.approx(0.25)
+    clock.now += 0.25
+    assert buckets.take("client", 2, 3) == 0
+    # Refilled up to burst, not beyond
+    clock.now += 3600
+    assert [buckets.take("client", 2, 3) for _ in range(4)][-1] > 0
+
+
+def test_buckets_of_other_keys_untouched(tmp_path, clock):
+    buckets = TokenBuckets(str(tmp_path / "buckets"), 1 << 16)
+    assert buckets.take("read 10.0.0.1", 1, 1) == 0
+    assert buckets.take("read 10.0.0.1", 1, 1) > 0
+    assert buckets.take("read 10.0.0.2", 1, 1) == 0
+    assert buckets.take("write 10.0.0.1", 1, 1) == 0
+
+
+def _take_all(path: str, results) -> None:
+    buckets = TokenBuckets(path, 64)
+    results.put(sum(1 for _ in range(50) if buckets.take("client", 0.001, 40) == 0))
+
+
+def test_buckets_shared_by_processes(tmp_path):
+    path = str(tmp_path / "buckets")
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    processes = [context.Process(target=_take_all, args=(path, results)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    taken = sum(results.get(timeout=30) for _ in processes)
+    for process in processes:
+        process.join(30)
+    # A single bucket of 40 tokens between them, barely refilled meanwhile
+    assert 40 <= taken <= 41
+
+
+def _in_child(func) -> bool:
+    """Run func in a forked process, like another uWSGI worker, :return: What it returned"""
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if func() else 1)
+    _, status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(status) == 0
+
+
+def test_in_flight_counts_every_worker(tmp_path):
+    path = str(tmp_path / "in_flight")
+    table = InFlightTable(path)
+    assert table.add(1) == 1
+    assert table.add(1) == 2
+    # Another worker adds to the same total, then dies in the middle of its request
+    assert _in_child(lambda: InFlightTable(path).add(1) == 3)
+    # What it counted is dropped once a worker claims a slot again
+    assert _in_child(lambda: InFlightTable(path).add(0) == 2)
+    assert table.add(-2) == 0
+
+
+def test_reads_over_the_limit_get_a_429(client):
+    assert _read(client).status_code == 200
+    assert _read(client).status_code == 200
+    refused = _read(client)
+    assert refused.status_code == 429
+    assert refused.headers["Retry-After"] == "2"
+    # Other clients have buckets of their own
+    assert _read(client, "10.0.0.2").status_code == 200
+
+
+def test_limits_refilled_over_time(client, clock):
+    for _ in range(2):
+        _read(client)
+    assert _read(client).status_code == 429
+    clock.now += 2
+    assert _read(client).status_code == 200
+    assert _read(client).status_code == 429
+
+
+def test_rules_limited_apart(client):
+    for _ in range(3):
+        _read(client)
+    made = client.post("/api/make_post", json={"title": "Thread", "body": "Body"},
+                       environ_base={"REMOTE_ADDR": "10.0.0.1"})
+    assert made.status_code == 200
+    assert client.post("/api/make_post", json={"title": "Thread", "body": "Body"},
+                       environ_base={"REMOTE_ADDR": "10.0.0.1"}).status_code == 429
+    # Scrapes are never limited
+    assert all(client.get("/metrics", environ_base={"REMOTE_ADDR": "10.0.0.1"}).status_code
+               == 200 for _ in range(5))
+
+
+def test_clients_behind_a_proxy(api, client):
+    api.limiter.client_header = "X-Forwarded-For"
+    for spoofed in ("1.1.1.1", "2.2.2.2"):
+        # The proxy appends the address it got the request from
+        assert _read(client, "10.0.0.100",
+                     **{"X-Forwarded-For": "%s, 10.0.0.1" % spoofed}).status_code == 200
+    # Made up addresses on the left don't make a new client
+    assert _read(client, "10.0.0.100",
+                 **{"X-Forwarded-For": "3.3.3.3, 10.0.0.1"}).status_code == 429
+    assert _read(client, "10.0.0.100",
+                 **{"X-Forwarded-For": "3.3.3.3, 10.0.0.2"}).status_code == 200
+
+
+def test_requests_over_max_in_flight_get_a_503(api, client):
+    api.limiter.max_in_flight = 1
+    # Another request of this worker is being served
+    assert api.limiter.enter()
+    try:
+        refused = _read(client)
+        assert refused.status_code == 503
+        assert refused.headers["Retry-After"] == str(api.limiter.retry_after)
+    finally:
+        api.limiter.leave()
+    assert _read(client).status_code == 200
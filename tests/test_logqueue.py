@@ -0,0 +1,194 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+test_logqueue.py - Log handlers run by a listener thread, behind a bounded queue
+"""
+
+import os
+import logging
+import threading
+
+import pytest
+
+from kamina import logqueue, metrics
+from kamina.logqueue import DroppingQueueHandler, SamplingFilter, LOG_RECORDS_DROPPED
+
+
+class Recording(logging.Handler):
+    """Keeps the messages it handles, and the threads it handled them in"""
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self.messages = []
+        self.threads = set()
+        self.handled = threading.Event()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.messages.append(record.getMessage())
+        self.threads.add(threading.current_thread().name)
+        self.handled.set()
+
+
+class Blocking(Recording):
+    """Stuck on its first record until released, like a log server gone slow"""
+    def __init__(self):
+        super().__init__()
+        self.entered = threading.Event()
+        self.unblock = threading.Event()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.entered.set()
+        self.unblock.wait(10)
+        super().emit(record)
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """A registry of its own, for the dropped records of a test"""
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, "REGISTRY", registry)
+    return registry
+
+
+@pytest.fixture
+def logger(request):
+    logger = logging.getLogger("kamina-test." + request.node.name)
+    logger.setLevel(logging.DEBUG)
+    yield logger
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        if isinstance(handler, DroppingQueueHandler):
+            handler.stop()
+
+
+def test_records_handled_by_the_listener(logger):
+    everything = Recording()
+    warnings = Recording(logging.WARNING)
+    queue_handler = DroppingQueueHandler([everything, warnings], 100)
+    logger.addHandler(queue_handler)
+    logger.info("Started on port %d", 1337)
+    assert everything.handled.wait(5)
+    logger.warning("Slow ipfs")
+    queue_handler.stop()
+    assert everything.messages == ["Started on port 1337", "Slow ipfs"]
+    # Handler levels still apply behind the queue
+    assert warnings.messages == ["Slow ipfs"]
+    assert everything.threads == {"kamina-log"}
+
+
+def test_stop_flushes_queued_records(logger):
+    recording = Recording()
+    queue_handler = DroppingQueueHandler([recording], 100)
+    logger.addHandler(queue_handler)
+    for index in range(10):
+        logger.info("Record %d", index)
+    # Within FLUSH_DELAY of the first one, none was handled yet
+    queue_handler.stop()
+    assert recording.messages == ["Record %d" % index for index in range(10)]
+
+
+def test_full_queue_drops_and_reports(logger, registry):
+    blocking = Blocking()
+    queue_handler = DroppingQueueHandler([blocking], 2)
+    logger.addHandler(queue_handler)
+    try:
+        logger.info("First")
+        assert blocking.entered.wait(5)
+        # The listener is stuck on the first record, two fit in the queue
+        for index in range(5):
+            logger.info("Record %d", index)
+        assert queue_handler.dropped == 3
+    finally:
+        blocking.unblock.set()
+    queue_handler.stop()
+    assert blocking.messages == ["First", "Record 0", "Record 1",
+                                 "Dropped 3 log records, the logging queue was full"]
+    totals = registry._collect_values()[0]
+    assert LOG_RECORDS_DROPPED.series(totals) == {("queue_full",): 3}
+
+
+def test_drops_reported_at_most_every_interval(logger, monkeypatch):
+    monkeypatch.setattr(logqueue, "REPORT_INTERVAL", 3600)
+    recording = Recording()
+    queue_handler = DroppingQueueHandler([recording], 100)
+    logger.addHandler(queue_handler)
+    logger.info("First")
+    assert recording.handled.wait(5)
+    listener = queue_handler._listener
+    queue_handler.dropped = 2
+    listener._report()
+    queue_handler.dropped = 5
+    # Within the interval, left for the next report
+    listener._report()
+    queue_handler.stop()
+    assert recording.messages == ["First",
+                                  "Dropped 2 log records, the logging queue was full",
+                                  "Dropped 3 log records, the logging queue was full"]
+
+
+def test_listener_restarted_in_forked_workers(logger, tmp_path):
+    path = str(tmp_path / "child.log")
+    queue_handler = DroppingQueueHandler([logging.FileHandler(path)], 100)
+    logger.addHandler(queue_handler)
+    logger.info("Parent")
+    parent_listener = queue_handler._listener
+    pid = os.fork()
+    if pid == 0:
+        try:
+            logger.info("Child")
+            queue_handler.stop()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    queue_handler.stop()
+    assert parent_listener is queue_handler._listener
+    with open(path, "rt") as log_file:
+        lines = log_file.read().splitlines()
+    # The parent's record was handled once, by the parent
+    assert sorted(lines) == ["Child", "Parent"]
+
+
+def test_install_moves_the_handlers(logger, monkeypatch):
+    monkeypatch.setattr(logqueue, "_QUEUE_HANDLERS", [])
+    recording = Recording()
+    logger.addHandler(recording)
+    logqueue.install([logger, logging.getLogger("kamina-test.empty")], 100)
+    logqueue.install([logger], 100)
+    queue_handler, = logger.handlers
+    assert isinstance(queue_handler, DroppingQueueHandler)
+    assert queue_handler.targets == [recording]
+    assert logqueue._QUEUE_HANDLERS == [queue_handler]
+    logger.info("Queued")
+    logqueue.stop_all()
+    assert recording.messages == ["Queued"]
+    assert not logqueue._QUEUE_HANDLERS
+
+
+def test_sampling_filter(registry):
+    sampling = SamplingFilter(rate=0.001, burst=3, level="INFO")
+
+    def record(level: int, lineno: int) -> logging.LogRecord:
+        return logging.LogRecord("kamina", level, __file__, lineno, "Message", (), None)
+
+    assert [sampling.filter(record(logging.INFO, 1)) for _ in range(5)] == [True] * 3 + [False] * 2
+    # Call sites have buckets of their own, and records above level always pass
+    assert sampling.filter(record(logging.INFO, 2))
+    assert sampling.filter(record(logging.WARNING, 1))
+    assert sampling.sampled == 2
+    totals = registry._collect_values()[0]
+    assert LOG_RECORDS_DROPPED.series(totals) == {("sampled",): 2}
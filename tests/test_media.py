@@ -0,0 +1,242 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+test_media.py - Uploads, their checks, and the variants made by the media worker
+"""
+
+import io
+import time
+import asyncio
+
+import pytest
+from PIL import Image
+
+from backend.api import API
+from backend.asgi import ASGIApp
+from storage.ipfs import STREAM_CHUNK_SIZE
+from storage.media import MediaWorker
+from utils.fake_ipfs import fake_cid
+
+
+@pytest.fixture
+def api(node):
+    api = API(node[0])
+    api.conf["media"]["poll_interval"] = 0.05
+    api.conf["media"]["retry_interval"] = 0.1
+    return api
+
+
+@pytest.fixture
+def client(api):
+    return api.app.test_client()
+
+
+@pytest.fixture
+def worker(api):
+    """Media worker of the own community, with its process pool"""
+    worker = MediaWorker(api.storage, api.conf)
+    worker.start()
+    yield worker
+    worker.stop()
+
+
+def _image(width: int, height: int, mode: str = "RGB", kind: str = "JPEG") -> bytes:
+    output = io.BytesIO()
+    Image.new(mode, (width, height), "red").save(output, kind)
+    return output.getvalue()
+
+
+class RecordingStream(io.BytesIO):
+    """Upload body which records the size of every read"""
+    def __init__(self, data: bytes):
+        super().__init__(data)
+        self.reads = []
+
+    def read(self, size=-1):
+        self.reads.append(size)
+        return super().read(size)
+
+
+def _wait_variant(storage, cid: str, variant: str) -> tuple:
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        derived = storage.get_media_variant(cid, variant)
+        if derived is not None and (derived[0] is not None or derived[2] is not None):
+            return derived
+        time.sleep(0.05)
+    raise AssertionError("The %s of %s wasn't made" % (variant, cid))
+
+
+def test_upload_and_read_back(client, node):
+    data = _image(64, 48)
+    made = client.post("/api/upload", data=data, content_type="image/jpeg")
+    assert made.status_code == 200
+    cid = made.get_json()["cid"]
+    assert cid == fake_cid(data) and node[1].objects[cid] == data
+    assert made.get_json()["size"] == len(data)
+
+    read = client.get("/api/media/%s" % cid)
+    assert read.status_code == 200
+    assert read.data == data and read.mimetype == "image/jpeg"
+    assert read.headers["ETag"] == '"%s"' % cid
+    assert "immutable" in read.headers["Cache-Control"]
+
+
+def test_upload_streamed_in_chunks(api, node):
+    data = bytes(range(256)) * (STREAM_CHUNK_SIZE // 64)
+    stream = RecordingStream(data)
+    cid = api.storage.add_upload(stream, len(data), "application/octet-stream")
+    assert node[1].objects[cid] == data
+    # Never read whole, a chunk at a time
+    assert len(stream.reads) > 1 and max(stream.reads) <= STREAM_CHUNK_SIZE
+
+
+def test_upload_shorter_than_announced(api):
+    with pytest.raises(IOError):
+        api.storage.add_upload(io.BytesIO(b"short"), 1000, "image/png")
+    # Never recorded, so no variant was asked for
+    assert not api.storage.media.pending(10)
+
+
+@pytest.mark.parametrize("content_type, status", [("text/plain", 415),
+                                                  ("application/octet-stream", 415),
+                                                  ("image/svg+xml", 415)])
+def test_upload_media_types(client, node, content_type, status):
+    assert client.post("/api/upload", data=b"<svg/>", content_type=content_type).status_code \
+        == status
+    assert not node[1].calls.get("/api/v0/add")
+
+
+def test_upload_size_limit(api, client, node):
+    api.conf["media"]["max_upload_size"] = 1
+    too_big = b"\0" * (1024 * 1024 + 1)
+    assert client.post("/api/upload", data=too_big, content_type="image/png").status_code == 413
+    assert not node[1].calls.get("/api/v0/add")
+    assert client.post("/api/upload", data=too_big[1:], content_type="image/png").status_code \
+        == 200
+
+
+def test_upload_without_length(client):
+    # A chunked body, its length is only known once it was read
+    response = client.post("/api/upload", input_stream=io.BytesIO(b"4\r\ndata\r\n0\r\n\r\n"),
+                           content_type="image/png", headers={"Transfer-Encoding": "chunked"})
+    assert response.status_code == 411
+
+
+def test_asgi_upload_streamed_from_the_loop(api, node):
+    app = ASGIApp(api)
+    data = _image(64, 48, kind="PNG")
+    chunks = [data[index:index + 100] for index in range(0, len(data), 100)]
+    sent = []
+
+    async def receive():
+        if chunks:
+            return {"type": "http.request", "body": chunks.pop(0), "more_body": bool(chunks)}
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    async def request():
+        scope = {"type": "http", "method": "POST", "path": "/api/upload", "query_string": b"",
+                 "http_version": "1.1", "scheme": "http", "client": ("127.0.0.1", 50000),
+                 "server": ("127.0.0.1", 1337),
+                 "headers": [(b"content-type", b"image/png"),
+                             (b"content-length", str(len(data)).encode("ascii"))]}
+        try:
+            await app(scope, receive, send)
+        finally:
+            await app.ipfs_conn.close()
+            app.executor.shutdown()
+
+    asyncio.run(request())
+    assert sent[0]["status"] == 200
+    assert node[1].objects[fake_cid(data)] == data
+    assert api.storage.get_media(fake_cid(data))[0] == "image/png"
+
+
+def test_variants_made_by_the_pool(api, client, worker):
+    cid = client.post("/api/upload", data=_image(1000, 800),
+                      content_type="image/jpeg").get_json()["cid"]
+
+    thumbnail = _wait_variant(api.storage, cid, "thumbnail")
+    banner = _wait_variant(api.storage, cid, "banner")
+    assert thumbnail[1] == banner[1] == "image/jpeg"
+    # Fits inside 320x320, keeping its proportions
+    assert Image.open(io.BytesIO(client.get("/api/media/%s?variant=thumbnail" % cid).data)).size \
+        == (320, 256)
+    # Fills 1500x300 exactly, cropping what is left over
+    assert Image.open(io.BytesIO(client.get("/api/media/%s?variant=banner" % cid).data)).size \
+        == (1500, 300)
+
+
+def test_variant_pending_redirects(api, client):
+    cid = client.post("/api/upload", data=_image(64, 48),
+                      content_type="image/jpeg").get_json()["cid"]
+    # No worker runs, the variant is still waiting
+    pending = client.get("/api/media/%s?variant=thumbnail" % cid)
+    assert pending.status_code == 307
+    assert pending.headers["Location"].endswith("/api/media/%s" % cid)
+    assert client.get("/api/media/%s?variant=huge" % cid).status_code == 400
+
+
+def test_variants_of_transparent_images_stay_png(api, client, worker):
+    cid = client.post("/api/upload", data=_image(400, 400, "RGBA", "PNG"),
+                      content_type="image/png").get_json()["cid"]
+    assert _wait_variant(api.storage, cid, "thumbnail")[1] == "image/png"
+
+
+def test_variants_of_broken_images_given_up(api, client, worker):
+    cid = client.post("/api/upload", data=b"not an image",
+                      content_type="image/png").get_json()["cid"]
+    failed = _wait_variant(api.storage, cid, "thumbnail")
+    assert failed[0] is None and failed[2]
+    # Served the upload itself instead
+    assert client.get("/api/media/%s?variant=thumbnail" % cid).status_code == 307
+
+
+def test_variants_of_huge_images_refused(api, client):
+    api.conf["media"]["max_pixels"] = 0.1
+    worker = MediaWorker(api.storage, api.conf)
+    worker.start()
+    try:
+        cid = client.post("/api/upload", data=_image(400, 400),
+                          content_type="image/jpeg").get_json()["cid"]
+        failed = _wait_variant(api.storage, cid, "thumbnail")
+    finally:
+        worker.stop()
+    assert failed[0] is None and "pixels" in failed[2]
+
+
+def test_variants_retried_while_ipfs_is_down(api, client, node):
+    cid = client.post("/api/upload", data=_image(100, 100),
+                      content_type="image/jpeg").get_json()["cid"]
+    node[1].online = False
+    worker = MediaWorker(api.storage, api.conf)
+    worker.start()
+    try:
+        deadline = time.monotonic() + 30
+        while not node[1].calls.get("/api/v0/cat") and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert api.storage.get_media_variant(cid, "thumbnail") == (None, None, None)
+        node[1].online = True
+        thumbnail = _wait_variant(api.storage, cid, "thumbnail")
+    finally:
+        worker.stop()
+    assert thumbnail[0] is not None
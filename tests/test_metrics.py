@@ -0,0 +1,202 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+test_metrics.py - Metric values shared by processes, summed up and exposed to prometheus
+"""
+
+import os
+
+import pytest
+
+from backend.api import API
+from kamina import metrics
+from kamina.metrics import MappedValues, Registry, Counter, Gauge, Histogram, INITIAL_SIZE
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """A registry of their own for the metrics declared by a test"""
+    registry = Registry()
+    monkeypatch.setattr(metrics, "REGISTRY", registry)
+    return registry
+
+
+@pytest.fixture
+def shared(registry, tmp_path):
+    """The registry, with values shared through a directory like uWSGI workers do"""
+    registry.configure(str(tmp_path))
+    return registry
+
+
+def _in_child(func) -> None:
+    """Run func in a forked process which then exits, like a uWSGI worker going away"""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            func()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def _samples(text: str) -> dict:
+    """Sample lines of an exposition, by name and labels"""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = value
+    return samples
+
+
+def test_mapped_values_reopened(tmp_path):
+    path = str(tmp_path / "1.metrics")
+    values = MappedValues(path)
+    values.add("requests", 2)
+    values.add("requests", 1.5)
+    values.set("open", 7)
+    # More entries than the initial mapping holds
+    for index in range(INITIAL_SIZE // 16):
+        values.add("key %d" % index, index)
+    assert len(values._map) > INITIAL_SIZE
+    with open(path, "rb") as metrics_file:
+        buffer = metrics_file.read()
+    used = metrics.HEADER.unpack_from(buffer, 0)[0]
+    read = {key: value for key, value, _ in metrics.read_entries(buffer, used)}
+    assert read["requests"] == 3.5
+    assert read["open"] == 7
+    assert read["key %d" % (INITIAL_SIZE // 16 - 1)] == INITIAL_SIZE // 16 - 1
+    # Picked up where it was left, a process restarted with the same pid
+    reopened = MappedValues(path)
+    reopened.add("requests", 1)
+    assert set(reopened._positions) == set(read)
+    assert reopened._positions["requests"] == values._positions["requests"]
+
+
+def test_values_kept_in_memory_until_configured(registry, tmp_path):
+    requests = Counter("test_requests_total", "Requests")
+    requests.inc()
+    requests.inc()
+    assert _samples(registry.render()) == {"test_requests_total": "2"}
+    assert not os.listdir(str(tmp_path))
+
+
+def test_counters_summed_across_processes(shared, tmp_path):
+    requests = Counter("test_requests_total", "Requests", ("endpoint",))
+    requests.inc("index")
+    for _ in range(3):
+        _in_child(lambda: requests.inc("index", amount=2))
+    _in_child(lambda: requests.inc("search"))
+    assert len(os.listdir(str(tmp_path))) == 5
+    assert _samples(shared.render()) == {'test_requests_total{endpoint="index"}': "7",
+                                         'test_requests_total{endpoint="search"}': "1"}
+
+
+def test_histograms_summed_across_processes(shared):
+    # Exact in binary, the sum doesn't depend on the order the files are read in
+    latency = Histogram("test_seconds", "Latency", buckets=(0.25, 1.0))
+    latency.observe(0.0625)
+    _in_child(lambda: latency.observe(0.5))
+    _in_child(lambda: (latency.observe(0.25), latency.observe(2.5)))
+    assert _samples(shared.render()) == {'test_seconds_bucket{le="0.25"}': "2",
+                                         'test_seconds_bucket{le="1.0"}': "3",
+                                         'test_seconds_bucket{le="+Inf"}': "4",
+                                         "test_seconds_sum": "3.3125",
+                                         "test_seconds_count": "4"}
+
+
+def test_gauges_of_live_processes_only(shared):
+    streams = Gauge("test_streams", "Open streams")
+    streams.inc(amount=2)
+    ready_read, ready_write = os.pipe()
+    done_read, done_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            streams.inc(amount=3)
+            os.write(ready_write, b"x")
+            # Holds its streams until the test is done looking
+            os.read(done_read, 1)
+        finally:
+            os._exit(0)
+    try:
+        os.read(ready_read, 1)
+        assert _samples(shared.render()) == {"test_streams": "5"}
+    finally:
+        os.write(done_write, b"x")
+        os.waitpid(pid, 0)
+        for fd in (ready_read, ready_write, done_read, done_write):
+            os.close(fd)
+    assert _samples(shared.render()) == {"test_streams": "2"}
+
+
+def test_files_of_dead_processes_removed_on_configure(registry, tmp_path):
+    registry.configure(str(tmp_path))
+    requests = Counter("test_requests_total", "Requests")
+    requests.inc()
+    _in_child(requests.inc)
+    assert len(os.listdir(str(tmp_path))) == 2
+    # The daemon starts over, counters too
+    Registry().configure(str(tmp_path))
+    assert os.listdir(str(tmp_path)) == ["%d.metrics" % os.getpid()]
+    assert _samples(registry.render()) == {"test_requests_total": "1"}
+
+
+def test_exposition_format(registry):
+    requests = Counter("test_requests_total", "Answered requests", ("endpoint", "status"))
+    streams = Gauge("test_streams", "Open streams")
+    latency = Histogram("test_seconds", "Latency", ("endpoint",), buckets=(0.5,))
+    registry.add_collector(lambda totals: ["# TYPE test_extra gauge",
+                                           "test_extra %d" % len(totals)])
+    requests.inc("index", 200)
+    requests.inc('say "hi"\\', 404, amount=0.5)
+    streams.set(value=3)
+    latency.observe(0.25, "index")
+    assert registry.render() == "\n".join([
+        "# HELP test_requests_total Answered requests",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{endpoint="index",status="200"} 1',
+        'test_requests_total{endpoint="say \\"hi\\"\\\\",status="404"} 0.5',
+        "# HELP test_streams Open streams",
+        "# TYPE test_streams gauge",
+        "test_streams 3",
+        "# HELP test_seconds Latency",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{endpoint="index",le="0.5"} 1',
+        'test_seconds_bucket{endpoint="index",le="+Inf"} 1',
+        'test_seconds_sum{endpoint="index"} 0.25',
+        'test_seconds_count{endpoint="index"} 1',
+        "# TYPE test_extra gauge",
+        "test_extra 6",
+    ]) + "\n"
+
+
+def test_metrics_endpoint(node):
+    client = API(node[0]).app.test_client()
+    client.post("/api/make_post", json={"title": "Thread", "body": "Body"})
+    client.get("/api/get_all_threads?sort=nope")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type == "text/plain; version=0.0.4"
+    samples = _samples(response.get_data(as_text=True))
+    assert samples['kamina_requests_total{endpoint="make_post",status="200"}'] == "1"
+    assert samples['kamina_requests_total{endpoint="get_all_threads",status="400"}'] == "1"
+    assert samples['kamina_request_seconds_count{endpoint="make_post"}'] == "1"
+    # Counted once answered, the scrape itself is in flight
+    assert samples["kamina_requests_in_flight"] == "1"
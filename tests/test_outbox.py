@@ -0,0 +1,103 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+test_outbox.py - Posts published to ipfs in the background, across an ipfs outage
+"""
+
+import time
+
+import pytest
+
+from storage import records
+from storage.ipfs import IPFSUnavailable
+from storage.outbox import OutboxDrainer
+from utils.fake_ipfs import FakeIPFS
+
+
+@pytest.fixture
+def drainer(settings, storage):
+    settings["outbox"].update(poll_interval=0.05, min_backoff=0.05, max_backoff=0.2)
+    drainer = OutboxDrainer(storage, settings)
+    yield drainer
+    if drainer._thread.is_alive():
+        drainer.stop()
+
+
+def _wait_drained(storage, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while storage.outbox.depth()[0] and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert storage.outbox.depth()[0] == 0
+
+
+def test_drain_on_demand(storage, drainer, node):
+    thread_id, op = storage.make_post("Thread", "Opening post")
+    reply = storage.make_response(thread_id, op, "Reply")
+    assert storage.sync_log.post_cid(op) is None
+    assert drainer.drain() == 2
+    assert drainer.drain() == 0
+
+    op_cid, reply_cid = storage.sync_log.post_cid(op), storage.sync_log.post_cid(reply)
+    opening = records.decode(node[1].objects[op_cid])
+    assert opening.title == "Thread" and opening.body == "Opening post"
+    # Replies name their thread and parent by CID
+    answer = records.decode(node[1].objects[reply_cid])
+    assert answer.thread == op_cid and answer.parent == op_cid and answer.body == "Reply"
+
+
+def test_posts_made_while_ipfs_is_down_published_later(storage, drainer, node):
+    fake_ipfs = node[1]
+    port = fake_ipfs.port
+    drainer.start()
+    thread_id, op = storage.make_post("Thread", "Published right away")
+    _wait_drained(storage)
+    op_cid = storage.sync_log.post_cid(op)
+    assert op_cid in fake_ipfs.objects
+
+    fake_ipfs.stop()
+    restarted = None
+    try:
+        # Writes don't wait on ipfs
+        started = time.monotonic()
+        replies = [storage.make_response(thread_id, op, "Reply %d" % index) for index in range(3)]
+        other_id, other_op = storage.make_post("Other thread", "Also waiting")
+        assert time.monotonic() - started < 5
+        generations = storage.generations.thread(thread_id), storage.generations.thread(other_id)
+
+        # A few attempts fail meanwhile, the posts stay in the outbox
+        time.sleep(0.5)
+        assert storage.outbox.depth()[0] == 4
+        assert all(storage.sync_log.post_cid(post_id) is None for post_id in replies)
+        with pytest.raises(IPFSUnavailable):
+            drainer.drain()
+
+        restarted = FakeIPFS(port).start()
+        _wait_drained(storage)
+    finally:
+        if restarted is not None:
+            restarted.stop()
+
+    for post_id in replies + [other_op]:
+        cid = storage.sync_log.post_cid(post_id)
+        assert cid in restarted.objects
+    assert records.decode(restarted.objects[storage.sync_log.post_cid(replies[0])]).thread \
+        == op_cid
+    # Readers holding a thread from before the publication see it changed
+    assert storage.generations.thread(thread_id) != generations[0]
+    assert storage.generations.thread(other_id) != generations[1]
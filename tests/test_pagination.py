@@ -0,0 +1,94 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+
+"""
+test_pagination.py - Keyset pagination of the thread listing
+"""
+
+import pytest
+
+from backend.api import API
+from backend.cursor import encode_cursor, decode_cursor, NUMBER
+from storage.database import SORT_COLUMNS
+
+
+def test_cursor_round_trip():
+    token = encode_cursor(1514764800.5, 42)
+    assert "=" not in token
+    assert decode_cursor(token, 2) == (1514764800.5, 42)
+    assert decode_cursor(encode_cursor("000000000001"), 1) == ("000000000001",)
+
+
+@pytest.mark.parametrize("token", ["", "not a cursor", encode_cursor(1, 2, 3),
+                                   encode_cursor(1)[:-2] + "!!"])
+def test_malformed_cursors(token):
+    with pytest.raises(ValueError):
+        decode_cursor(token, 2)
+
+
+@pytest.mark.parametrize("values", [({"a": 1}, 1), ([1], 1), (1.5, "1"), (True, 1),
+                                    (None, 1), (1, 1 << 64)])
+def test_cursors_of_the_wrong_types(values):
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor(*values), 2, (NUMBER, int))
+    assert decode_cursor(encode_cursor(1.5, 2), 2, (NUMBER, int)) == (1.5, 2)
+
+
+def walk(storage, sort: str, limit: int) -> list:
+    """Ids of every thread, a page at a time"""
+    ids = []
+    after = None
+    while True:
+        threads = storage.get_all_threads(limit, after, sort)
+        ids.extend(thread["id"] for thread in threads)
+        if len(threads) < limit:
+            return ids
+        after = (threads[-1][SORT_COLUMNS[sort]], threads[-1]["id"])
+
+
+@pytest.mark.parametrize("sort", sorted(SORT_COLUMNS))
+def test_pages_list_every_thread_once(storage, sort):
+    thread_ids = [storage.make_post("Thread %d" % index, "Body")[0] for index in range(23)]
+    # Replies move a few threads up the active and hot listings
+    for thread_id in thread_ids[::4]:
+        storage.make_response(thread_id, None, "Reply")
+    whole = [thread["id"] for thread in storage.get_all_threads(100, None, sort)]
+    assert sorted(whole) == sorted(thread_ids)
+    for limit in (1, 5, 23):
+        assert walk(storage, sort, limit) == whole
+
+
+def test_pages_from_the_api(node):
+    client = API(node[0]).app.test_client()
+    for index in range(7):
+        client.post("/api/make_post", json={"title": "Thread %d" % index, "body": "Body"})
+    ids = []
+    url = "/api/get_all_threads?limit=3"
+    while url is not None:
+        page = client.get(url).get_json()
+        assert len(page["threads"]) <= 3
+        ids.extend(thread["id"] for thread in page["threads"])
+        url = page["next"] and "/api/get_all_threads?limit=3&cursor=" + page["next"]
+    assert ids == list(range(7, 0, -1))
+    assert client.get("/api/get_all_threads?cursor=bad").status_code == 400
+    for cursor in (encode_cursor({"a": 1}, 1), encode_cursor(1, [2]), encode_cursor(1, 1 << 64)):
+        assert client.get("/api/get_all_threads?cursor=" + cursor).status_code == 400
+    assert client.get("/api/get_single_thread?id=1&cursor=" +
+                      encode_cursor(["path"])).status_code == 400
+    assert client.get("/api/get_all_threads?sort=top").status_code == 400
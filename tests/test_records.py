@@ -0,0 +1,93 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+
+"""
+test_records.py - Version 1 (json) and version 2 (binary) post records
+"""
+
+import json
+
+import pytest
+
+from storage.records import (PostRecord, ThreadRecord, encode, decode, HEADER, MAGIC,
+                             JSON_VERSION, RECORD_VERSION)
+
+THREAD = ThreadRecord("QmNode", 1514764800, "Opening post \u00e9", "Title")
+REPLY = PostRecord("QmNode", 1514764801.25, "Reply", "bafkthread", "bafkparent")
+TOP_REPLY = PostRecord("QmNode", 1514764802, "", "bafkthread")
+
+
+@pytest.mark.parametrize("record", [THREAD, REPLY, TOP_REPLY])
+@pytest.mark.parametrize("version", [JSON_VERSION, RECORD_VERSION])
+def test_round_trip(record, version):
+    decoded = decode(encode(record, version))
+    assert decoded == record
+    assert type(decoded) is type(record)
+    assert decoded.body == record.body
+
+
+def test_encoding_is_canonical():
+    assert encode(REPLY) == encode(PostRecord("QmNode", 1514764801.25, b"Reply",
+                                              "bafkthread", "bafkparent"))
+    # An int and a float creation time are the same post
+    assert encode(THREAD) == encode(ThreadRecord("QmNode", 1514764800.0,
+                                                 "Opening post \u00e9", "Title"))
+
+
+def test_version_1_records_written_by_older_nodes():
+    data = json.dumps({"v": 1, "origin": "QmOld", "created": 1514764800, "title": "Old",
+                       "body": "Old post", "thread": None, "parent": None}).encode("utf8")
+    record = decode(data)
+    assert isinstance(record, ThreadRecord)
+    assert (record.origin, record.title, record.body) == ("QmOld", "Old", "Old post")
+    reply = decode(json.dumps({"v": 1, "created": 1, "body": "Hi", "thread": "bafkthread",
+                               "parent": None}).encode("utf8"))
+    assert isinstance(reply, PostRecord) and reply.origin == ""
+
+
+def test_binary_body_is_decoded_lazily():
+    data = encode(REPLY)
+    record = decode(bytearray(data))
+    assert isinstance(record.body_bytes, memoryview)
+    assert record.body == "Reply"
+    assert decode(encode(PostRecord("QmNode", 1, b"\xff", "bafkthread"))).body_bytes == b"\xff"
+    with pytest.raises(ValueError):
+        decode(encode(PostRecord("QmNode", 1, b"\xff", "bafkthread"))).decode_body()
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"KR",
+    b"XX" + encode(REPLY)[2:],
+    HEADER.pack(MAGIC, RECORD_VERSION + 1, 0),
+    HEADER.pack(MAGIC, RECORD_VERSION, 1000) + b"short",
+    HEADER.pack(MAGIC, RECORD_VERSION, 1) + b"\xc1",
+    b'{"v": 2, "body": "", "created": 1, "thread": null, "parent": null}',
+    b'{"v": 1, "body": "", "created": 1, "thread": null, "parent": null}',
+    b"[1, 2]",
+    b"{not json",
+])
+def test_malformed_records(data):
+    with pytest.raises(ValueError):
+        decode(data)
+
+
+def test_unknown_version_is_not_written():
+    with pytest.raises(ValueError):
+        encode(REPLY, 3)
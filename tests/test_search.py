@@ -0,0 +1,139 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+
+"""
+test_search.py - Full text search, its index and rebuilds of the index
+"""
+
+import pytest
+
+from backend.api import API
+from backend.cursor import encode_cursor
+from kamina.process import KaminaProcess
+from kamina.cli_commands.advanced import AdvancedCommands
+from storage.database import get_connection
+from storage.search import make_query
+from storage.shards import Shards
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptingLogger:
+    """Stands in for the logger of a rebuild, failing once a batch is committed"""
+    def debug(self, *_):
+        raise Interrupted()
+
+    def info(self, *_):
+        pass
+
+
+def found(storage, text: str) -> set:
+    return {post["id"] for post in storage.search(text, 1000)}
+
+
+def seed(storage, threads: int = 30) -> dict:
+    """Ids of the posts mentioning each word"""
+    posts = {"apple": set(), "banana": set()}
+    for index in range(threads):
+        fruit = "apple" if index % 3 else "banana"
+        thread_id, post_id = storage.make_post("About %s %d" % (fruit, index), "Opening post")
+        posts[fruit].add(post_id)
+        posts["banana"].add(storage.make_response(thread_id, post_id, "I prefer bananas, banana"))
+    return posts
+
+
+def test_make_query():
+    assert make_query('apple "OR" banana*') == '"apple" "OR" "banana"'
+    assert make_query("  ;-- ") == ""
+
+
+def test_new_posts_are_indexed(storage):
+    posts = seed(storage)
+    # Titles are searched along with the opening post
+    assert found(storage, "apple") == posts["apple"]
+    assert found(storage, "banana") == posts["banana"]
+    assert found(storage, "apple about") == posts["apple"]
+    assert found(storage, "cherry") == set()
+    assert storage.search("", 10) == []
+
+
+def test_search_pages(node):
+    client = API(node[0]).app.test_client()
+    for index in range(1, 7):
+        client.post("/api/make_post", json={"title": "Thread %d" % index, "body": "kiwi " * index})
+    ids = []
+    url = "/api/search?q=kiwi&limit=2"
+    while url is not None:
+        page = client.get(url).get_json()
+        ids.extend(post["id"] for post in page["posts"])
+        url = page["next"] and "/api/search?q=kiwi&limit=2&cursor=" + page["next"]
+    assert sorted(ids) == list(range(1, 7))
+    assert client.get("/api/search").status_code == 400
+    for cursor in (encode_cursor([1], [2]), encode_cursor(-1.5, "2"), "bad"):
+        assert client.get("/api/search?q=kiwi&cursor=" + cursor).status_code == 400
+
+
+def test_rebuild_swaps_in_a_complete_index(storage):
+    posts = seed(storage)
+    conn, lock = get_connection(storage.database.path)
+    with lock:
+        conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('delete-all')")
+    assert found(storage, "banana") == set()
+    assert storage.search_index.rebuild(batch_size=7) == 60
+    assert found(storage, "banana") == posts["banana"]
+    # The trigger of the swapped in index keeps indexing new posts
+    thread_id, post_id = storage.make_post("Cherry", "A new fruit")
+    assert found(storage, "cherry") == {post_id}
+    with lock:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+        state = conn.execute("SELECT count(*) FROM search_state").fetchone()[0]
+    assert "posts_fts_rebuild" not in tables and state == 0
+
+
+def test_interrupted_rebuild_resumes(storage):
+    posts = seed(storage)
+    index = storage.search_index
+    logger = index.logger
+    index.logger = InterruptingLogger()
+    with pytest.raises(Interrupted):
+        index.rebuild(batch_size=10)
+    index.logger = logger
+    # The current index is still whole meanwhile, and so are posts written now
+    assert found(storage, "banana") == posts["banana"]
+    thread_id, post_id = storage.make_post("Cherry", "Written during the rebuild")
+    assert found(storage, "cherry") == {post_id}
+    assert index.rebuild(batch_size=10) == 50
+    assert found(storage, "banana") == posts["banana"]
+    assert found(storage, "cherry") == {post_id}
+
+
+def test_communities_are_rebuilt_in_parallel(settings):
+    settings["general"]["communities"] = ["fruit", "veg"]
+    shards = Shards(settings)
+    posts = {}
+    for storage in shards.all():
+        posts[storage.community] = seed(storage, 5)["banana"]
+        conn, lock = get_connection(storage.database.path)
+        with lock:
+            conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('delete-all')")
+    AdvancedCommands(KaminaProcess(settings)).rebuild_search_index()
+    for storage in shards.all():
+        assert found(storage, "banana") == posts[storage.community]
@@ -0,0 +1,175 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+test_shards.py - Communities hosted side by side: their shards, and the /c/<id> routes
+The test nodes host their own community only, the tests here add two more
+to the configuration of their node.
+"""
+
+import os
+import asyncio
+
+import yaml
+import pytest
+
+from backend.api import API
+from backend.asgi import ASGIApp
+from kamina.config import KaminaConfiguration
+from storage.shards import Shards, UnknownCommunity, check_communities
+from utils.fake_ipfs import fake_cid
+
+COMMUNITIES = ["books", "music"]
+
+
+@pytest.fixture
+def hosting(node):
+    """Base dir of a node hosting COMMUNITIES next to its own community"""
+    conf_path = os.path.join(node[0], "conf", "kamina.yaml")
+    with open(conf_path, "rt") as conf_file:
+        conf = yaml.safe_load(conf_file)
+    conf["general"]["communities"] = COMMUNITIES
+    with open(conf_path, "wt") as conf_file:
+        yaml.safe_dump(conf, conf_file, default_flow_style=False)
+    return node[0]
+
+
+@pytest.fixture
+def shards(hosting):
+    return Shards(KaminaConfiguration(hosting).conf)
+
+
+@pytest.fixture
+def api(hosting):
+    return API(hosting)
+
+
+@pytest.fixture
+def client(api):
+    return api.app.test_client()
+
+
+def _titles(client, prefix: str = "") -> list:
+    threads = client.get(prefix + "/api/get_all_threads").get_json()["threads"]
+    return [thread["title"] for thread in threads]
+
+
+@pytest.mark.parametrize("communities", [["a/b"], [".."], [""], ["x" * 65], [3]])
+def test_invalid_community_ids(communities):
+    with pytest.raises(ValueError):
+        check_communities(communities)
+
+
+def test_a_shard_per_community(shards):
+    own = shards.get()
+    books = shards.get("books")
+    assert shards.get("books") is books
+    assert [storage.community for storage in shards.all()] == [None] + COMMUNITIES
+    node_dir = shards.settings["general"]["node_dir"]
+    assert own.database.path == os.path.join(node_dir, "kamina.db")
+    assert books.database.path == os.path.join(node_dir, "communities", "books", "kamina.db")
+    # One pool of ipfs connections for the node
+    assert books.ipfs_conn is own.ipfs_conn
+    with pytest.raises(UnknownCommunity):
+        shards.get("movies")
+
+
+def test_posts_stay_in_their_shard(shards):
+    own, books, music = shards.all()
+    thread_id, _ = books.make_post("Dune", "Spice")
+    books.make_response(thread_id, None, "Worms")
+    assert [thread["title"] for thread in books.get_all_threads(10)] == ["Dune"]
+    assert own.get_all_threads(10) == []
+    assert music.get_all_threads(10) == []
+    assert not music.search("Spice", 10)
+    assert [post["body"] for post in books.search("Spice", 10)] == ["Spice"]
+
+
+def test_communities_routed_apart(client):
+    client.post("/c/books/api/make_post", json={"title": "Dune", "body": "Spice"})
+    client.post("/api/make_post", json={"title": "Welcome", "body": "Hi"})
+    assert _titles(client, "/c/books") == ["Dune"]
+    assert _titles(client) == ["Welcome"]
+    assert _titles(client, "/c/music") == []
+    assert client.get("/c/music/api/search?q=Spice").get_json()["posts"] == []
+
+
+def test_same_thread_id_in_two_communities(client):
+    books = client.post("/c/books/api/make_post", json={"title": "Dune", "body": "Spice"})
+    music = client.post("/c/music/api/make_post", json={"title": "Jazz", "body": "Blue"})
+    # Each shard numbers its threads, the cached responses of one don't answer for the other
+    thread_id = books.get_json()["thread_id"]
+    assert music.get_json()["thread_id"] == thread_id
+    for prefix, body in (("/c/books", "Spice"), ("/c/music", "Blue")):
+        thread = client.get(prefix + "/api/get_single_thread?id=%d" % thread_id).get_json()
+        assert [post["body"] for post in thread["posts"]] == [body]
+    assert client.get("/api/get_single_thread?id=%d" % thread_id).status_code == 404
+    reply = client.post("/c/music/api/make_response",
+                        json={"thread_id": thread_id, "body": "Kind of"})
+    assert reply.status_code == 200
+    thread = client.get("/c/books/api/get_single_thread?id=%d" % thread_id).get_json()
+    assert [post["body"] for post in thread["posts"]] == ["Spice"]
+
+
+def test_unknown_community(client):
+    assert client.get("/c/movies/api/get_all_threads").status_code == 404
+    assert client.post("/c/movies/api/make_post",
+                       json={"title": "Alien", "body": "Nostromo"}).status_code == 404
+    assert client.get("/c/../api/get_all_threads").status_code == 404
+
+
+def test_media_stay_in_their_community(api, client, node):
+    data = b"\x89PNG\r\n\x1a\n" + b"books" * 10
+    cid = client.post("/c/books/api/upload", data=data,
+                      content_type="image/png").get_json()["cid"]
+    assert cid == fake_cid(data)
+    assert client.get("/c/books/api/media/" + cid).data == data
+    assert client.get("/c/music/api/media/" + cid).status_code == 404
+    assert client.get("/api/media/" + cid).status_code == 404
+
+
+def test_asgi_routes_communities_apart(api, client):
+    app = ASGIApp(api)
+    data = b"\x89PNG\r\n\x1a\n" + b"music" * 10
+    cid = client.post("/c/music/api/upload", data=data,
+                      content_type="image/png").get_json()["cid"]
+
+    async def get(path: str) -> int:
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": path, "query_string": b"",
+                 "http_version": "1.1", "scheme": "http", "client": ("127.0.0.1", 50000),
+                 "server": ("127.0.0.1", 1337), "headers": []}
+        await app(scope, receive, send)
+        return sent[0]["status"]
+
+    async def request():
+        try:
+            return [await get(prefix + "/api/media/" + cid)
+                    for prefix in ("/c/music", "/c/books", "", "/c/movies")]
+        finally:
+            await app.ipfs_conn.close()
+            app.executor.shutdown()
+
+    assert asyncio.run(request()) == [200, 404, 404, 404]
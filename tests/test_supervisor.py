@@ -0,0 +1,183 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+test_supervisor.py - Restarting and stopping the daemon children
+Children are small python processes, ready once they created the file they
+were given. The supervisor runs in the main thread since it handles signals,
+and is stopped by a SIGTERM sent to the test itself.
+"""
+
+import os
+import sys
+import time
+import signal
+import subprocess
+import threading
+
+import pytest
+
+from kamina.process import KaminaProcess
+from kamina.supervisor import Supervisor, SupervisedChild
+
+READY = "import signal, sys, time; open(sys.argv[1], 'w').close(); "
+SLEEPER = READY + "time.sleep(60)"
+# Ignores the polite stop signal, only a kill ends it
+STUBBORN = "import signal; signal.signal(signal.SIGTERM, signal.SIG_IGN); " + SLEEPER
+# Reports a reload by exiting with code 3
+RELOADER = "import signal, sys; signal.signal(signal.SIGHUP, lambda *_: sys.exit(3)); " + SLEEPER
+
+
+@pytest.fixture(params=["pidfd", "sigchld"])
+def supervisor(request):
+    """Supervisor watching its children either through pidfds or SIGCHLD"""
+    if request.param == "pidfd" and not hasattr(os, "pidfd_open"):
+        pytest.skip("no pidfd on this platform")
+    handlers = {signum: signal.getsignal(signum)
+                for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)}
+    process = KaminaProcess({})
+    process.setup_sighandlers()
+    supervisor = Supervisor(process, ready_timeout=1, restart_limit=2, restart_window=60)
+    supervisor._use_pidfd = request.param == "pidfd"
+    yield supervisor
+    for child in supervisor.children:
+        if child.process is not None and child.process.poll() is None:
+            child.process.kill()
+            child.process.wait()
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def _child(name: str, code: str, ready_dir, **kwargs) -> SupervisedChild:
+    """Child running code, every process it was started as is kept in child.started"""
+    ready = ready_dir / name
+
+    def start():
+        if ready.exists():
+            ready.unlink()
+        process = subprocess.Popen([sys.executable, "-c", code, str(ready)])
+        child.started.append(process)
+        return process
+
+    child = SupervisedChild(name, start, ready.exists, **kwargs)
+    child.started = []
+    return child
+
+
+def _signal_later(signum: int, delay: float = 0.2) -> None:
+    threading.Timer(delay, os.kill, (os.getpid(), signum)).start()
+
+
+def _stop_when(condition, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def test_dead_child_restarted(supervisor, tmp_path):
+    child = _child("sleeper", SLEEPER, tmp_path)
+    supervisor.add(child)
+
+    def on_ready():
+        child.process.kill()
+        # Stop once the replacement is running
+        threading.Thread(target=_stop_when, args=(lambda: len(child.started) == 2,)).start()
+
+    assert supervisor.run(on_ready)
+    first, second = child.started
+    assert first.returncode == -signal.SIGKILL
+    assert second.returncode == -signal.SIGTERM
+    assert len(child.restarts) == 1
+
+
+def test_gives_up_after_restart_limit(supervisor, tmp_path):
+    child = _child("crasher", READY + "time.sleep(0.05); sys.exit(1)", tmp_path)
+    supervisor.add(child)
+
+    assert not supervisor.run()
+    assert supervisor.failed
+    # The first start and restart_limit restarts
+    assert len(child.started) == 3
+    assert all(process.returncode == 1 for process in child.started)
+
+
+def test_child_exiting_while_starting(supervisor, tmp_path):
+    child = _child("broken", "import sys; sys.exit(2)", tmp_path)
+    supervisor.add(child)
+
+    assert not supervisor.run()
+    assert child.started[0].returncode == 2
+
+
+def test_stopped_on_signal_in_reverse_order(supervisor, tmp_path):
+    first = _child("first", SLEEPER, tmp_path)
+    second = _child("second", SLEEPER, tmp_path, stop_signal=signal.SIGUSR1)
+    stopped = []
+    for child in (first, second):
+        child.start = _recording_start(child, stopped)
+        supervisor.add(child)
+
+    assert supervisor.run(lambda: _signal_later(signal.SIGTERM))
+    assert not supervisor.process.running
+    assert first.process.returncode == -signal.SIGTERM
+    assert second.process.returncode == -signal.SIGUSR1
+    assert [name for name, _ in stopped] == ["second", "first"]
+
+
+def _recording_start(child: SupervisedChild, stopped: list):
+    """Start of child recording the signals sent to it in stopped"""
+    start = child.start
+
+    def recording():
+        process = start()
+        send_signal = process.send_signal
+
+        def send(signum):
+            stopped.append((child.name, signum))
+            send_signal(signum)
+        process.send_signal = send
+        return process
+    return recording
+
+
+def test_stubborn_child_killed(supervisor, tmp_path):
+    child = _child("stubborn", STUBBORN, tmp_path)
+    supervisor.add(child)
+
+    assert supervisor.run(lambda: _signal_later(signal.SIGTERM, 0.5))
+    assert child.process.returncode == -signal.SIGKILL
+    assert len(child.started) == 1
+
+
+def test_reload_signals_children(supervisor, tmp_path):
+    reloaded = _child("reloader", RELOADER, tmp_path, reload_signal=signal.SIGHUP)
+    fixed = _child("fixed", SLEEPER, tmp_path)
+    for child in (reloaded, fixed):
+        supervisor.add(child)
+
+    def on_ready():
+        _signal_later(signal.SIGHUP)
+        # The reload makes the reloader exit, stop once it was restarted
+        threading.Thread(target=_stop_when,
+                         args=(lambda: len(reloaded.started) == 2,)).start()
+
+    assert supervisor.run(on_ready)
+    assert reloaded.started[0].returncode == 3
+    assert fixed.started == [fixed.process]
+    assert not supervisor.process.reload_requested
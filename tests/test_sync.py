@@ -0,0 +1,109 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+
+"""
+test_sync.py - Replication between two nodes sharing a fake ipfs daemon
+"""
+
+import logging
+
+import pytest
+
+from backend.api import API
+from bench.common import bench_environment
+from bench.sync import seed, serve, posts_of
+from storage.database import get_connection
+from storage.outbox import OutboxDrainer
+from storage.sync import Replicator
+
+
+class Node:
+    """A node serving its api, with its replicator and outbox drainer"""
+    def __init__(self, base_dir: str):
+        self.api = API(base_dir)
+        self.storage = self.api.storage
+        self.server, self.url = serve(self.api)
+        self.replicator = Replicator(self.storage, self.api.conf)
+        self.drainer = OutboxDrainer(self.storage, self.api.conf)
+
+    def posts(self) -> list:
+        return posts_of(self.api.conf)
+
+
+@pytest.fixture
+def nodes():
+    logging.getLogger("werkzeug").disabled = True
+    with bench_environment() as (base_a, ipfs), bench_environment(ipfs) as (base_b, _):
+        node_a, node_b = Node(base_a), Node(base_b)
+        try:
+            yield node_a, node_b
+        finally:
+            node_a.server.shutdown()
+            node_b.server.shutdown()
+
+
+def test_nodes_converge(nodes):
+    node_a, node_b = nodes
+    seed(node_a.storage, 40, 6)
+    # Posts of its own make B compare range digests when it first meets A
+    seed(node_b.storage, 5, 3)
+    assert node_a.drainer.drain() == 40 * 7
+    assert node_b.drainer.drain() == 5 * 4
+    assert node_b.replicator.sync_peer(node_a.url) == 40 * 7
+    assert node_a.replicator.sync_peer(node_b.url) == 5 * 4
+    assert node_a.posts() == node_b.posts()
+    assert len(node_a.posts()) == 45 * 7 - 5 * 3
+
+    # Then only the new log entries are read
+    seed(node_a.storage, 3, 2)
+    node_a.drainer.drain()
+    assert node_b.replicator.sync_peer(node_a.url) == 3 * 3
+    assert node_b.replicator.sync_peer(node_a.url, full=True) == 0
+    assert node_a.posts() == node_b.posts()
+
+
+def test_full_sync_finds_posts_behind_the_cursor(nodes):
+    node_a, node_b = nodes
+    seed(node_a.storage, 10, 2)
+    node_a.drainer.drain()
+    node_b.replicator.sync_peer(node_a.url)
+    conn, lock = get_connection(node_b.storage.database.path)
+    with lock:
+        conn.execute("DELETE FROM sync_log WHERE cid IN (SELECT cid FROM posts "
+                     "WHERE parent_id IS NOT NULL)")
+        conn.execute("DELETE FROM posts WHERE parent_id IS NOT NULL")
+    assert node_b.replicator.sync_peer(node_a.url) == 0
+    assert node_b.replicator.sync_peer(node_a.url, full=True) == 10 * 2
+    assert node_a.posts() == node_b.posts()
+
+
+def test_posts_logged_before_their_thread_are_retried(nodes):
+    node_a, node_b = nodes
+    thread_id, post_id = node_a.storage.make_post("Thread", "Opening post")
+    for index in range(5):
+        node_a.storage.make_response(thread_id, post_id, "Reply %d" % index)
+    node_a.drainer.drain()
+    # The opening post moves to the end of the log of A, after its replies
+    conn, lock = get_connection(node_a.storage.database.path)
+    with lock:
+        conn.execute("UPDATE sync_log SET seq = 1000 WHERE cid = "
+                     "(SELECT cid FROM posts WHERE id = ?)", (post_id,))
+    assert node_b.replicator.sync_peer(node_a.url) == 6
+    assert node_a.posts() == node_b.posts()
+    assert node_b.storage.sync_log.get_state("retry:%s" % node_a.url) == []
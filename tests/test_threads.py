@@ -0,0 +1,152 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+test_threads.py - Windows of the reply tree of a thread: depth, subtree roots and pages
+"""
+
+import pytest
+
+from backend.api import API
+from backend.cursor import encode_cursor
+
+
+@pytest.fixture
+def tree(storage):
+    """
+    Thread of posts named after their place in the tree:
+    op
+    +- a
+    |  +- a1
+    |  |  +- a1x
+    |  +- a2
+    +- b
+    +- c
+       +- c1 ... c5
+    :return: Tuple of (thread id, ids by name, names in depth first order)
+    """
+    thread_id, op = storage.make_post("Thread", "op")
+    ids = {"op": op}
+    order = ["op"]
+
+    def reply(name: str, parent: str):
+        ids[name] = storage.make_response(thread_id, ids[parent], name)
+        order.append(name)
+
+    reply("a", "op")
+    reply("a1", "a")
+    reply("a1x", "a1")
+    reply("a2", "a")
+    reply("b", "op")
+    reply("c", "op")
+    for index in range(1, 6):
+        reply("c%d" % index, "c")
+    return thread_id, ids, order
+
+
+def _names(thread: dict, ids: dict) -> list:
+    by_id = {post_id: name for name, post_id in ids.items()}
+    return [by_id[post["id"]] for post in thread["posts"]]
+
+
+def _walk(storage, thread_id: int, limit: int, depth: int, root: int = None) -> list:
+    """Every page of a window, :return: Posts of each page"""
+    pages = []
+    after = None
+    while True:
+        thread = storage.get_single_thread(thread_id, limit, depth, root, after)
+        pages.append(thread["posts"])
+        after = thread["next"]
+        if after is None:
+            return pages
+
+
+def test_whole_thread_depth_first(storage, tree):
+    thread_id, ids, order = tree
+    thread = storage.get_single_thread(thread_id, 100, 8)
+    assert _names(thread, ids) == order
+    assert thread["next"] is None
+    depths = {post["id"]: post["depth"] for post in thread["posts"]}
+    assert depths[ids["op"]] == 0 and depths[ids["a1"]] == 2 and depths[ids["a1x"]] == 3
+    assert not any(post["more"] for post in thread["posts"])
+
+
+def test_depth_limit(storage, tree):
+    thread_id, ids, _ = tree
+    thread = storage.get_single_thread(thread_id, 100, 1)
+    assert _names(thread, ids) == ["op", "a", "b", "c"]
+    # Flagged where replies were left out
+    more = {name for name, post in zip(_names(thread, ids), thread["posts"]) if post["more"]}
+    assert more == {"a", "c"}
+    replies = {name: post["replies"] for name, post in zip(_names(thread, ids), thread["posts"])}
+    assert replies == {"op": 3, "a": 2, "b": 0, "c": 5}
+
+    only_op = storage.get_single_thread(thread_id, 100, 0)
+    assert _names(only_op, ids) == ["op"] and only_op["posts"][0]["more"]
+
+
+def test_subtree_root(storage, tree):
+    thread_id, ids, _ = tree
+    thread = storage.get_single_thread(thread_id, 100, 1, ids["a"])
+    # Depths stay those of the whole thread, the window is relative to the root
+    assert _names(thread, ids) == ["a", "a1", "a2"]
+    assert [post["depth"] for post in thread["posts"]] == [1, 2, 2]
+    assert [post["more"] for post in thread["posts"]] == [False, True, False]
+    assert _names(storage.get_single_thread(thread_id, 100, 8, ids["a1x"]), ids) == ["a1x"]
+
+
+def test_root_of_another_thread(storage, tree):
+    thread_id, ids, _ = tree
+    other_id, other_op = storage.make_post("Other", "op")
+    assert storage.get_single_thread(thread_id, 100, 8, other_op) is None
+    assert storage.get_single_thread(other_id, 100, 8, ids["a"]) is None
+    assert storage.get_single_thread(thread_id, 100, 8, 999999) is None
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 5])
+def test_pages_across_siblings(storage, tree, limit):
+    thread_id, ids, order = tree
+    pages = _walk(storage, thread_id, limit, 8)
+    assert all(len(page) == limit for page in pages[:-1]) and 0 < len(pages[-1]) <= limit
+    assert [name for page in pages for name in _names({"posts": page}, ids)] == order
+
+
+@pytest.mark.parametrize("limit", [1, 2, 4])
+def test_pages_of_a_subtree(storage, tree, limit):
+    thread_id, ids, _ = tree
+    pages = _walk(storage, thread_id, limit, 1, ids["c"])
+    names = [name for page in pages for name in _names({"posts": page}, ids)]
+    # The siblings after c's replies, and c's own siblings, stay out
+    assert names == ["c"] + ["c%d" % index for index in range(1, 6)]
+
+
+def test_thread_api_pages(node, storage, tree):
+    thread_id, ids, _ = tree
+    client = API(node[0]).app.test_client()
+    url = "/api/get_single_thread?id=%d&root=%d&depth=1&limit=2" % (thread_id, ids["a"])
+    first = client.get(url).get_json()
+    second = client.get(url + "&cursor=" + first["next"]).get_json()
+    assert [post["id"] for post in first["posts"] + second["posts"]] \
+        == [ids["a"], ids["a1"], ids["a2"]]
+    assert second["next"] is None
+    # A cursor from before the subtree doesn't widen the window
+    outside = client.get(url + "&cursor=" + encode_cursor("")).get_json()
+    assert [post["id"] for post in outside["posts"]] == [ids["a"], ids["a1"]]
+    assert client.get("/api/get_single_thread?id=%d&root=%d" % (thread_id, 999999)).status_code \
+        == 404
+    assert client.get(url + "&cursor=" + encode_cursor(1)).status_code == 400
@@ -0,0 +1,102 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+
+"""
+test_writer.py - Group commit of the writes
+"""
+
+import threading
+
+import pytest
+
+from storage.database import (get_connection, insert_thread, insert_response,
+                              ThreadNotFound, InvalidParent)
+from storage.writer import WriteCoalescer
+
+
+def count_posts(database) -> int:
+    conn, lock = get_connection(database.path)
+    with lock:
+        return conn.execute("SELECT count(*) FROM posts").fetchone()[0]
+
+
+def half_written(conn, now: float, thread_id: int) -> None:
+    """A write rejected after it already wrote a post"""
+    insert_response(conn, now, thread_id, None, "Never committed")
+    raise InvalidParent(None)
+
+
+def test_a_rejected_write_leaves_the_rest_of_the_batch(storage):
+    database = storage.database
+    thread_id, post_id = database.run_batch([(insert_thread, ("Thread", "Body"))])[0][0]
+    results = database.run_batch([
+        (insert_response, (thread_id, post_id, "First")),
+        (insert_response, (thread_id + 1, None, "Unknown thread")),
+        (insert_response, (thread_id, post_id + 100, "Unknown parent")),
+        (half_written, (thread_id,)),
+        (insert_response, (thread_id, None, "Last")),
+    ])
+    assert isinstance(results[1][1], ThreadNotFound)
+    assert isinstance(results[2][1], InvalidParent)
+    assert isinstance(results[3][1], InvalidParent)
+    assert results[0][1] is None and results[4][1] is None
+    assert count_posts(database) == 3
+    assert database.get_thread(thread_id, 10, 10)["post_count"] == 3
+
+
+def test_a_failing_batch_is_rolled_back_whole(storage):
+    def broken(conn, now):
+        raise RuntimeError("broken write")
+
+    with pytest.raises(RuntimeError):
+        storage.database.run_batch([(insert_thread, ("Thread", "Body")), (broken, ())])
+    assert count_posts(storage.database) == 0
+
+
+def test_concurrent_writes_are_committed_together(storage):
+    batches = []
+    run_batch = storage.database.run_batch
+
+    def counting(operations):
+        batches.append(len(operations))
+        return run_batch(operations)
+
+    storage.database.run_batch = counting
+    writer = WriteCoalescer(storage.database, 0.2, 64)
+    thread_id, _ = writer.submit(insert_thread, "Thread", "Body")
+    start = threading.Barrier(16)
+    errors = []
+
+    def reply(index):
+        start.wait()
+        try:
+            # Every other reply goes to a thread that doesn't exist
+            writer.submit(insert_response, thread_id + index % 2, None, "Reply")
+        except ThreadNotFound as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=reply, args=(index,)) for index in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 8
+    assert count_posts(storage.database) == 9
+    # The first write, then far fewer batches than replies
+    assert batches[0] == 1 and len(batches) - 1 < 8
@@ -0,0 +1,157 @@
+# Kamina - The />p/ social network
+# Copyright (C) 2018, The Kamina Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+fake_ipfs.py - In-memory stand-in for the ipfs daemon http api
+Implements just enough of /api/v0 (add, cat, version, id) to run the
+storage layer and the benchmarks without a real daemon or any network.
+"""
+
+import re
+import json
+import socket
+import hashlib
+import threading
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+BOUNDARY_RE = re.compile(r'boundary="?([^";]+)"?')
+NAME_RE = re.compile(rb'filename="([^"]*)"')
+
+
+def fake_cid(data: bytes) -> str:
+    """Content address of the fake daemon, not a real multihash"""
+    return "bafk" + hashlib.sha256(data).hexdigest()
+
+
+def _parse_multipart(body: bytes, boundary: bytes) -> list:
+    parts = []
+    for chunk in body.split(b"--" + boundary):
+        if not chunk.strip() or chunk.strip() == b"--":
+            continue
+        headers, _, data = chunk.partition(b"\r\n\r\n")
+        name = NAME_RE.search(headers)
+        parts.append((name.group(1).decode("utf8") if name else "", data[:-2]))
+    return parts
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes, Nagle would delay the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, *_):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections.add(self.connection)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.connection)
+        super().finish()
+
+    def _reply(self, code: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        args = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        server = self.server
+
+        with server.lock:
+            server.calls[url.path] = server.calls.get(url.path, 0) + 1
+        if server.delay:
+            server.delay_event.wait(server.delay)
+        if not server.online:
+            self._reply(503, b'{"Message": "offline"}')
+            return
+
+        if url.path == "/api/v0/version":
+            self._reply(200, json.dumps({"Version": "0.4.14-fake"}).encode("utf8"))
+        elif url.path == "/api/v0/id":
+            self._reply(200, json.dumps({"ID": server.peer_id}).encode("utf8"))
+        elif url.path == "/api/v0/add":
+            boundary = BOUNDARY_RE.search(self.headers.get("Content-Type", ""))
+            if boundary is None:
+                self._reply(400, b'{"Message": "missing multipart boundary"}')
+                return
+            lines = []
+            for name, data in _parse_multipart(body, boundary.group(1).encode("ascii")):
+                cid = fake_cid(data)
+                with server.lock:
+                    server.objects[cid] = data
+                lines.append(json.dumps({"Name": name, "Hash": cid, "Size": str(len(data))}))
+            self._reply(200, ("\n".join(lines) + "\n").encode("utf8"))
+        elif url.path == "/api/v0/cat":
+            with server.lock:
+                data = server.objects.get(args.get("arg", [""])[0])
+            if data is None:
+                self._reply(500, b'{"Message": "not found"}')
+            else:
+                self._reply(200, data, "text/plain")
+        else:
+            self._reply(404, b'{"Message": "unknown command"}')
+
+
+class FakeIPFS(ThreadingMixIn, HTTPServer):
+    """
+    Fake ipfs daemon listening on 127.0.0.1
+    Use port 0 to get a free port, then read it back from .port
+    """
+    daemon_threads = True
+    # Like the real daemon, lets a burst of connections wait instead of dropping them
+    request_queue_size = 1024
+
+    def __init__(self, port: int = 0, peer_id: str = "QmFakePeer"):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.port = self.server_address[1]
+        self.peer_id = peer_id
+        self.objects = {}
+        self.calls = {}
+        self.online = True
+        self.delay = 0
+        self.delay_event = threading.Event()
+        self.lock = threading.Lock()
+        # Open keep-alive connections, cut by stop() like a daemon going down would
+        self.connections = set()
+        self._thread = None
+
+    def start(self) -> "FakeIPFS":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
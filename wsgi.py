@@ -17,7 +17,10 @@
 
 """
 wsgi.py - Barebones file to get wsgi working
+Set KAMINA_CONFIG_DIR to load the configuration from another directory.
 """
+import os
+
 from backend.api import API
 
-APP = API().app
+APP = API(os.environ.get("KAMINA_CONFIG_DIR")).app